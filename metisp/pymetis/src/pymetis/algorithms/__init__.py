@@ -0,0 +1,13 @@
+# Numerical building blocks shared by the recipes, working on NumPy arrays
+from .accumulator import WelfordAccumulator
+from .qc import QcDictionary, QcEngine, qc_dictionary
+from .rectification import DistortionTable, WavelengthSolution, RectificationOperator
+from .distortion import PinholeTable, DistortionSolution
+from .wavecal import ArcCalibration
+from .coadd import CubeGrid, CubeCoadder
+from .fluxcal import ResponseCache
+from .background import PairSubtractor
+from .cubewriter import CubeWriter
+from .mosaic import ChipLayout
+from .parallel import TilePool
+from .refpix import ReferencePixelCorrector
@@ -0,0 +1,93 @@
+from typing import Literal
+
+import numpy as np
+from astropy.io import fits
+
+
+class WelfordAccumulator:
+    """
+    Running per-pixel mean and sum of squared deviations from the mean (Welford's algorithm).
+
+    Frames are added one at a time, so a stack never has to be held in memory. Two accumulators
+    can be merged (Chan et al. 1979): this is what allows a combined product to be updated with new frames
+    without revisiting the old ones, as long as the product carries the accumulator state with it.
+    """
+    extname_mean: str = "ACC_MEAN"
+    extname_m2: str = "ACC_M2"
+
+    def __init__(self,
+                 count: int = 0,
+                 mean: np.ndarray | None = None,
+                 m2: np.ndarray | None = None):
+        self.count: int = count
+        self.mean: np.ndarray | None = mean
+        self.m2: np.ndarray | None = m2
+
+    def add(self, frame: np.ndarray) -> None:
+        """ Fold a single frame into the running statistics """
+        frame = np.asarray(frame, dtype=np.float64)
+
+        if self.mean is None:
+            self.mean = np.zeros_like(frame)
+            self.m2 = np.zeros_like(frame)
+        elif frame.shape != self.mean.shape:
+            raise ValueError(f"Cannot add a frame of shape {frame.shape} to an accumulator of shape {self.mean.shape}")
+
+        self.count += 1
+        delta = frame - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (frame - self.mean)
+
+    def merge(self, other: 'WelfordAccumulator') -> 'WelfordAccumulator':
+        """ Merge the statistics of another accumulator into this one (in place) and return self """
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        if other.mean.shape != self.mean.shape:
+            raise ValueError(f"Cannot merge accumulators of shapes {self.mean.shape} and {other.mean.shape}")
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.mean += delta * (other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def sum(self) -> np.ndarray:
+        return self.mean * self.count
+
+    @property
+    def variance(self) -> np.ndarray:
+        """ Unbiased per-pixel sample variance (zero for fewer than two frames) """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.count - 1)
+
+    def combined(self, method: Literal['add'] | Literal['average']) -> np.ndarray:
+        """ The combined frame for the stacking methods that can be expressed by running statistics """
+        match method:
+            case "add":
+                return self.sum
+            case "average":
+                return self.mean.copy()
+            case _:
+                raise ValueError(f"Stacking method {method!r} cannot be computed from running statistics")
+
+    @classmethod
+    def load(cls, filename: str, count: int) -> 'WelfordAccumulator':
+        """
+        Restore the accumulator state from the extensions of a previously saved product.
+        `count` is the number of frames combined in that product (`ESO PRO DATANCOM`).
+        """
+        with fits.open(filename, memmap=True) as hdus:
+            try:
+                mean = np.array(hdus[cls.extname_mean].data, dtype=np.float64)
+                m2 = np.array(hdus[cls.extname_m2].data, dtype=np.float64)
+            except KeyError as e:
+                raise KeyError(f"File {filename!r} does not contain the accumulator extensions "
+                               f"{cls.extname_mean} and {cls.extname_m2}") from e
+
+        return cls(count, mean, m2)
@@ -0,0 +1,90 @@
+from abc import ABC, abstractmethod
+from typing import Dict
+
+import numpy as np
+
+"""
+Compute backends for the elementary image operations of the recipes.
+
+All backends take and return NumPy arrays, so that they are interchangeable. The NumPy backend works
+on contiguous arrays (and thus also on memory maps and tiles of larger images), the CPL backend
+(in `backend_cpl`) converts to and from CPL images and is the reference implementation:
+the two are expected to agree to rounding.
+Stacks are three-dimensional arrays, with the frames along the first axis.
+"""
+
+
+class ArrayBackend(ABC):
+    name: str = None
+
+    @abstractmethod
+    def subtract(self, image: np.ndarray, other: np.ndarray) -> np.ndarray:
+        """ `image - other` """
+
+    @abstractmethod
+    def divide(self, image: np.ndarray, other: np.ndarray) -> np.ndarray:
+        """ `image / other`, zero where `other` is zero """
+
+    @abstractmethod
+    def mean(self, stack: np.ndarray) -> np.ndarray:
+        """ Mean of the stack along the first axis """
+
+    @abstractmethod
+    def median(self, stack: np.ndarray) -> np.ndarray:
+        """ Median of the stack along the first axis """
+
+    @abstractmethod
+    def clip(self, stack: np.ndarray, kappa: float = 3.0, keep: float = 0.5) -> np.ndarray:
+        """
+        Kappa-sigma clipped mean of the stack along the first axis: values further than `kappa` standard deviations
+        from the mean are rejected iteratively, while at least the fraction `keep` of the values remain
+        """
+
+    @abstractmethod
+    def statistics(self, image: np.ndarray) -> Dict[str, float]:
+        """ Mean, median, (sample) standard deviation, minimum and maximum of an image """
+
+
+class NumpyBackend(ArrayBackend):
+    name = "numpy"
+
+    def subtract(self, image: np.ndarray, other: np.ndarray) -> np.ndarray:
+        return np.subtract(image, other, dtype=np.float64)
+
+    def divide(self, image: np.ndarray, other: np.ndarray) -> np.ndarray:
+        zero = other == 0
+        return np.where(zero, 0.0, np.asarray(image, dtype=np.float64) / np.where(zero, 1, other))
+
+    def mean(self, stack: np.ndarray) -> np.ndarray:
+        return np.mean(stack, axis=0, dtype=np.float64)
+
+    def median(self, stack: np.ndarray) -> np.ndarray:
+        return np.median(np.asarray(stack, dtype=np.float64), axis=0)
+
+    def clip(self, stack: np.ndarray, kappa: float = 3.0, keep: float = 0.5) -> np.ndarray:
+        stack = np.asarray(stack, dtype=np.float64)
+        minimum = max(int(np.ceil(keep * len(stack))), 2)
+        kept = np.ones(stack.shape, dtype=bool)
+
+        # All pixels are clipped at once; a pixel stops changing as soon as it rejects nothing more
+        for _ in range(len(stack) - minimum):
+            count = kept.sum(axis=0)
+            mean = np.where(kept, stack, 0).sum(axis=0) / count
+            sigma = np.sqrt(np.where(kept, (stack - mean) ** 2, 0).sum(axis=0) / (count - 1))
+            clipped = kept & (np.abs(stack - mean) <= kappa * sigma)
+            short = clipped.sum(axis=0) < minimum
+            clipped[:, short] = kept[:, short]
+            if np.array_equal(clipped, kept):
+                break
+            kept = clipped
+
+        return np.where(kept, stack, 0).sum(axis=0) / kept.sum(axis=0)
+
+    def statistics(self, image: np.ndarray) -> Dict[str, float]:
+        return {
+            'mean': float(np.mean(image)),
+            'median': float(np.median(image)),
+            'stdev': float(np.std(image, ddof=1)),
+            'min': float(np.min(image)),
+            'max': float(np.max(image)),
+        }
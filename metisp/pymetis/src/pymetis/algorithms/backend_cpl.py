@@ -0,0 +1,51 @@
+from typing import Dict
+
+import cpl
+import numpy as np
+
+from pymetis.algorithms.backend import ArrayBackend
+from pymetis.algorithms.images import as_array, as_image
+
+"""
+The CPL implementation of the compute backend, the reference for the NumPy one.
+Every operation converts its inputs to CPL images and the result back to a NumPy array.
+"""
+
+
+class CplBackend(ArrayBackend):
+    name = "cpl"
+
+    @staticmethod
+    def _imagelist(stack: np.ndarray) -> cpl.core.ImageList:
+        return cpl.core.ImageList([as_image(np.asarray(frame, dtype=np.float64)) for frame in stack])
+
+    def subtract(self, image: np.ndarray, other: np.ndarray) -> np.ndarray:
+        result = as_image(np.asarray(image, dtype=np.float64))
+        result.subtract(as_image(np.asarray(other, dtype=np.float64)))
+        return np.array(as_array(result))
+
+    def divide(self, image: np.ndarray, other: np.ndarray) -> np.ndarray:
+        result = as_image(np.asarray(image, dtype=np.float64))
+        result.divide(as_image(np.asarray(other, dtype=np.float64)))
+        # CPL rejects the pixels divided by zero instead of setting them to a value
+        return np.where(other == 0, 0.0, as_array(result))
+
+    def mean(self, stack: np.ndarray) -> np.ndarray:
+        return np.array(as_array(self._imagelist(stack).collapse_create()))
+
+    def median(self, stack: np.ndarray) -> np.ndarray:
+        return np.array(as_array(self._imagelist(stack).collapse_median_create()))
+
+    def clip(self, stack: np.ndarray, kappa: float = 3.0, keep: float = 0.5) -> np.ndarray:
+        image, _ = self._imagelist(stack).collapse_sigclip_create(kappa, kappa, keep, cpl.core.Collapse.MEAN)
+        return np.array(as_array(image))
+
+    def statistics(self, image: np.ndarray) -> Dict[str, float]:
+        image = as_image(np.asarray(image, dtype=np.float64))
+        return {
+            'mean': image.get_mean(),
+            'median': image.get_median(),
+            'stdev': image.get_stdev(),
+            'min': image.get_min(),
+            'max': image.get_max(),
+        }
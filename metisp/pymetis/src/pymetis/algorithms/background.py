@@ -0,0 +1,97 @@
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, Tuple
+
+import numpy as np
+
+from pymetis.algorithms.accumulator import WelfordAccumulator
+
+"""
+Background subtraction of chopped and nodded exposures.
+
+In the thermal infrared the sky and the telescope outshine the target by orders of magnitude. The background is
+removed by alternating between two beams: nodding moves the telescope between positions A and B, chopping does
+the same with the secondary mirror, much faster. Every frame records its positions in the header (`A` or `B`);
+the beam of a frame is the product of the signs of all of them, so that chopped and nodded sequences
+(AB, BA, BA, AB, ...) reduce to the same problem as simple nodding.
+
+The frames are paired as they stream in: every frame is paired with the nearest (most recent) frame of the opposite
+beam still waiting for a partner. Runs of frames of the same beam (AABB, ABBA, ...) thus lose no frames, and
+at most a window of frames of one beam is ever waiting. Frames of the negative beam are also folded
+into a running estimate of the background.
+"""
+
+# Frames of one beam that may wait for a partner; the oldest are dropped beyond it
+PAIR_WINDOW = 4
+
+# Header keywords with the position (`A` or `B`) of the nodding and of the chopping
+BEAM_KEYWORDS = ('ESO SEQ NODPOS', 'ESO SEQ CHOPPOS')
+BEAM_SIGNS = {'A': 1, 'B': -1}
+
+
+def beam(positions: Dict[str, str]) -> int | None:
+    """
+    The beam (+1 or -1) of a frame from the values of those `BEAM_KEYWORDS` that are present in its header,
+    or None if neither nodding nor chopping is recorded.
+    """
+    if not positions:
+        return None
+
+    sign = 1
+    for keyword, position in positions.items():
+        try:
+            sign *= BEAM_SIGNS[position.strip().upper()]
+        except KeyError as e:
+            raise ValueError(f"Invalid beam position {position!r} in {keyword}, expected one of "
+                             f"{list(BEAM_SIGNS)}") from e
+    return sign
+
+
+class PairSubtractor:
+    """
+    Streaming pairwise subtraction of frames of opposite beams.
+
+    Feed `(beam, frame)` tuples to `subtract` and consume the differences (positive minus negative beam)
+    as they are produced. Every frame is paired with the nearest waiting frame of the opposite beam;
+    if more than `window` frames of a beam are waiting, the oldest of them is dropped.
+    """
+
+    def __init__(self, window: int = PAIR_WINDOW):
+        if window < 1:
+            raise ValueError(f"The pair window must hold at least one frame, got {window}")
+        self.window = window
+        self.background = WelfordAccumulator()      # Running statistics of the frames of the negative beam
+        self.pairs = 0
+        self.unpaired = 0
+        self._pending: Dict[int, Deque[np.ndarray]] = {1: deque(), -1: deque()}
+
+    def feed(self, sign: int, frame: np.ndarray) -> np.ndarray | None:
+        """ Add a single frame; return the difference if it completes a pair, None otherwise """
+        if sign not in (1, -1):
+            raise ValueError(f"Frame without a valid beam ({sign!r}) cannot be pair-subtracted")
+
+        frame = np.asarray(frame, dtype=np.float64)
+        if sign < 0:
+            self.background.add(frame)
+
+        if not (partners := self._pending[-sign]):
+            waiting = self._pending[sign]
+            waiting.append(frame)
+            if len(waiting) > self.window:
+                # The oldest frame of the beam would only be paired after all the others: give up on it
+                waiting.popleft()
+                self.unpaired += 1
+            return None
+
+        partner = partners.pop()
+        self.pairs += 1
+        return frame - partner if sign > 0 else partner - frame
+
+    def subtract(self, frames: Iterable[Tuple[int, np.ndarray]]) -> Iterator[np.ndarray]:
+        """ Stream the differences of all complete pairs in `frames` """
+        for sign, frame in frames:
+            if (difference := self.feed(sign, frame)) is not None:
+                yield difference
+
+        for waiting in self._pending.values():
+            self.unpaired += len(waiting)
+            waiting.clear()
@@ -0,0 +1,206 @@
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Tuple
+
+import numpy as np
+from astropy import units
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+"""
+Coaddition of data cubes with different pointings (e.g. dithered mosaics) on a common grid.
+
+The output grid is determined from the WCS headers of the input cubes alone, so no cube has to be loaded
+to set it up. The cubes are then resampled and accumulated into memory-mapped sum and weight cubes
+one at a time: the memory needed is bounded by the size of the output, not by the number of inputs.
+"""
+
+# Keywords describing a linear WCS, as written by `astropy.wcs.WCS.to_header`
+WCS_KEYWORDS = re.compile(r"^(WCSAXES|(CTYPE|CUNIT|CRPIX|CRVAL|CDELT)[0-9]+|PC[0-9]+_[0-9]+|LONPOLE|LATPOLE|RADESYS)$")
+
+
+@dataclass
+class CubeGrid:
+    """ The pixel grid of a cube: its WCS and shape (wavelength, y, x) """
+    wcs: WCS
+    shape: Tuple[int, int, int]
+
+    @classmethod
+    def from_header(cls, header: fits.Header) -> 'CubeGrid':
+        if header.get('NAXIS') != 3:
+            raise ValueError(f"A cube with three axes expected, got NAXIS = {header.get('NAXIS')}")
+        return cls(WCS(header), (header['NAXIS3'], header['NAXIS2'], header['NAXIS1']))
+
+    @classmethod
+    def from_file(cls, filename: str | Path) -> 'CubeGrid':
+        return cls.from_header(fits.getheader(filename, 0))
+
+    @property
+    def wavelengths(self) -> np.ndarray:
+        """ Wavelengths of the planes in micrometres (WCSLIB itself works in SI units) """
+        spectral = self.wcs.spectral
+        scale = units.Unit(spectral.wcs.cunit[0] or "m").to(units.um)
+        return spectral.all_pix2world(np.arange(self.shape[0]), 0)[0] * scale
+
+    def corners(self) -> np.ndarray:
+        """ World coordinates of the outer corners of the cube, shape (8, 3) """
+        edges = [(-0.5, n - 0.5) for n in reversed(self.shape)]
+        pixels = np.array(np.meshgrid(*edges, indexing='ij')).reshape(3, -1).T
+        return self.wcs.all_pix2world(pixels, 0)
+
+    def header(self) -> fits.Header:
+        header = self.wcs.to_header()
+        header['NAXIS'] = 3
+        for axis, size in enumerate(reversed(self.shape), start=1):
+            header[f'NAXIS{axis}'] = size
+        return header
+
+    def wcs_keywords(self) -> Dict[str, Any]:
+        """ The WCS of the grid as a dictionary of FITS keywords """
+        return {key: value for key, value in self.wcs.to_header().items() if WCS_KEYWORDS.match(key)}
+
+    @classmethod
+    def enclosing(cls, grids: Iterable['CubeGrid']) -> 'CubeGrid':
+        """
+        The smallest grid that contains all `grids`, with the pixel scales and orientation of the first one
+        (its reference pixel is shifted so that the grid starts at pixel 0 in every axis).
+        """
+        grids = list(grids)
+        if not grids:
+            raise ValueError("No cubes to coadd")
+
+        reference = grids[0].wcs.deepcopy()
+        pixels = reference.all_world2pix(np.concatenate([grid.corners() for grid in grids]), 0)
+
+        # Pixel centres covered by the corners (with a tolerance for rounding and projection effects)
+        low = np.floor(pixels.min(axis=0) + 0.5 + 0.01)
+        high = np.ceil(pixels.max(axis=0) - 0.5 - 0.01)
+        reference.wcs.crpix -= low
+        return cls(reference, tuple(int(n) for n in reversed(high - low + 1)))
+
+
+class CubeCoadder:
+    """
+    Accumulates cubes into memory-mapped sum, weight and variance cubes on the output grid.
+
+    Every input voxel is split linearly between the (up to eight) output voxels around its position.
+    Voxels are weighted either uniformly or by their inverse variance; flagged and non-finite voxels are skipped.
+    """
+
+    def __init__(self, grid: CubeGrid, directory: str | Path, *, weighting: str = "uniform"):
+        if weighting not in ["uniform", "variance"]:
+            raise ValueError(f"Unknown weighting {weighting!r}")
+
+        self.grid = grid
+        self.weighting = weighting
+        self.count = 0
+        self.flags = QualityFlag.GOOD                # Flags to be set on the whole output
+
+        directory = Path(directory)
+        self.sum, self.weight, self.variance = (
+            np.lib.format.open_memmap(directory / f"coadd_{name}.npy", mode='w+', dtype=np.float64, shape=grid.shape)
+            for name in ["sum", "weight", "variance"]
+        )
+
+    def _output_coordinates(self, grid: CubeGrid) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Output pixel coordinates of the voxel centres of `grid`. The celestial and spectral axes are
+        independent, so the spatial mapping is computed for a single plane and the spectral one for a single line.
+        """
+        n_wave, ny, nx = grid.shape
+        y, x = np.mgrid[0:ny, 0:nx]
+
+        ra, dec = grid.wcs.celestial.all_pix2world(x, y, 0)
+        ox, oy = self.grid.wcs.celestial.all_world2pix(ra, dec, 0)
+
+        wavelengths = grid.wcs.spectral.all_pix2world(np.arange(n_wave), 0)[0]
+        ow = self.grid.wcs.spectral.all_world2pix(wavelengths, 0)[0]
+        return ow, oy, ox
+
+    def _weights(self, planes: Planes) -> np.ndarray:
+        # Missing errors are flagged, but do not make the data themselves unusable
+        good = ((planes.quality & ~QualityFlag.NO_ERROR) == 0) & np.isfinite(planes.data)
+
+        if self.weighting == "variance":
+            has_error = planes.error > 0
+            if not has_error.any():
+                raise ValueError("Cannot weight by inverse variance: the cube has no errors")
+            return np.where(good & has_error, 1 / np.where(has_error, planes.error, 1) ** 2, 0)
+        else:
+            return good.astype(np.float64)
+
+    def add(self, planes: Planes, grid: CubeGrid) -> None:
+        """ Resample a single cube onto the output grid and accumulate it """
+        ow, oy, ox = self._output_coordinates(grid)
+        weight = self._weights(planes)
+        data = np.where(weight > 0, planes.data, 0) * weight
+        variance = np.where(weight > 0, planes.error, 0) ** 2 * weight ** 2
+        self.flags |= np.bitwise_or.reduce(planes.quality, axis=None) & QualityFlag.NO_ERROR
+
+        # Work within the bounding box of the cube on the output grid, which is about as large as the cube itself
+        w0, y0, x0 = np.floor(ow).astype(np.int64), np.floor(oy).astype(np.int64), np.floor(ox).astype(np.int64)
+        lo = np.maximum([w0.min(), y0.min(), x0.min()], 0)
+        hi = np.minimum(np.array([w0.max(), y0.max(), x0.max()]) + 2, self.grid.shape)
+        if (hi <= lo).any():
+            return
+
+        box = tuple(int(n) for n in hi - lo)
+        size = int(np.prod(box))
+        local = np.zeros((3, size))
+
+        for iw, fw in [(w0, 1 - (ow - w0)), (w0 + 1, ow - w0)]:
+            for iy, fy in [(y0, 1 - (oy - y0)), (y0 + 1, oy - y0)]:
+                for ix, fx in [(x0, 1 - (ox - x0)), (x0 + 1, ox - x0)]:
+                    fraction = fw[:, np.newaxis, np.newaxis] * (fy * fx)[np.newaxis]
+                    inside = (((iw >= lo[0]) & (iw < hi[0]))[:, np.newaxis, np.newaxis]
+                              & ((iy >= lo[1]) & (iy < hi[1]) & (ix >= lo[2]) & (ix < hi[2]))[np.newaxis]
+                              & (fraction > 0))
+                    index = np.ravel_multi_index(np.broadcast_arrays((iw - lo[0])[:, np.newaxis, np.newaxis],
+                                                                     (iy - lo[1])[np.newaxis],
+                                                                     (ix - lo[2])[np.newaxis]),
+                                                 box, mode='clip')[inside]
+
+                    local[0] += np.bincount(index, weights=(fraction * data)[inside], minlength=size)
+                    local[1] += np.bincount(index, weights=(fraction * weight)[inside], minlength=size)
+                    local[2] += np.bincount(index, weights=(fraction ** 2 * variance)[inside], minlength=size)
+
+        window = tuple(slice(a, b) for a, b in zip(lo, hi))
+        self.sum[window] += local[0].reshape(box)
+        self.weight[window] += local[1].reshape(box)
+        self.variance[window] += local[2].reshape(box)
+        self.count += 1
+
+    def chunks(self, size: int = 16) -> Iterator[Tuple[slice, Planes]]:
+        """
+        The normalized coadded cube, `size` planes at a time, as (planes along the wavelength axis, Planes).
+        Only a single chunk is in memory at a time, so the chunks can be written out as they come.
+        """
+        for start in range(0, self.grid.shape[0], size):
+            window = slice(start, min(start + size, self.grid.shape[0]))
+            weight = self.weight[window]
+            covered = weight > 0
+            divisor = np.where(covered, weight, 1)
+
+            data = np.where(covered, self.sum[window] / divisor, np.nan)
+            error = np.sqrt(self.variance[window]) / divisor
+            quality = np.full(weight.shape, self.flags, dtype=np.int32)
+            quality[~covered] |= QualityFlag.NO_DATA
+            yield window, Planes(data, error, quality)
+
+    def result(self) -> Planes:
+        """
+        Normalize the accumulated cubes and return the coadded planes.
+        The data and error planes reuse the memory-mapped sum and variance cubes.
+        """
+        data, error = self.sum, self.variance
+        quality = np.empty(self.grid.shape, dtype=np.int32)
+
+        for window, planes in self.chunks():
+            data[window], error[window], quality[window] = planes.data, planes.error, planes.quality
+
+        data.flush()
+        error.flush()
+        return Planes(data, error, quality)
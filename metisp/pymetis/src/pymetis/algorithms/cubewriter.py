@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+from astropy.io import fits
+
+from pymetis.algorithms.stacking import Planes
+
+"""
+Incremental writing of large data cubes.
+
+The FITS file with the DATA, ERR and DQ cubes is laid out in advance: all headers are written once,
+and the data units are allocated (as sparse, zero-filled regions) at their final offsets. The planes are then
+written in place through memory maps, one plane or a chunk of planes at a time, in any order.
+A cube can therefore be produced and saved without ever being held in memory as a whole.
+"""
+
+# Keywords that describe the structure of an HDU: they are set by the writer, never copied from a header
+STRUCTURAL = {'SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'EXTEND', 'PCOUNT', 'GCOUNT', 'EXTNAME',
+              'BSCALE', 'BZERO', 'CHECKSUM', 'DATASUM'}
+
+
+def _is_structural(keyword: str) -> bool:
+    return keyword in STRUCTURAL or (keyword.startswith('NAXIS') and keyword[5:].isdigit())
+
+
+class CubeWriter:
+    """
+    Writes DATA/ERR/DQ cubes of a fixed shape (wavelength, y, x) to a FITS file, plane by plane.
+    The data are in the primary HDU with the cards of `header`, ERR and DQ in image extensions.
+    """
+    blocksize = 2880
+
+    def __init__(self, filename: str | Path, shape: Tuple[int, int, int], header: fits.Header = None):
+        self.filename = Path(filename)
+        self.shape = tuple(int(n) for n in shape)
+        self.written = np.zeros(self.shape[0], dtype=bool)
+
+        units = [
+            (fits.PrimaryHDU, None, np.float64, header),
+            (fits.ImageHDU, Planes.extname_error, np.float64, None),
+            (fits.ImageHDU, Planes.extname_quality, np.int32, None),
+        ]
+
+        offsets = []
+        with open(self.filename, 'wb') as file:
+            for kind, name, dtype, cards in units:
+                block = self._header(kind, name, dtype, cards).tostring().encode('ascii')
+                file.write(block)
+                offsets.append(file.tell())
+                file.seek(self._padded(np.dtype(dtype).itemsize * int(np.prod(self.shape))), 1)
+            file.truncate(file.tell())
+
+        self.data, self.error, self.quality = (
+            np.memmap(self.filename, dtype=np.dtype(dtype).newbyteorder('>'), mode='r+', offset=offset,
+                      shape=self.shape)
+            for (_, _, dtype, _), offset in zip(units, offsets)
+        )
+
+    def _padded(self, size: int) -> int:
+        return -(-size // self.blocksize) * self.blocksize
+
+    def _header(self, kind: type, name: str | None, dtype: type, cards: fits.Header | None) -> fits.Header:
+        """ The header of an HDU with a cube of `dtype`, built from a tiny template so that astropy orders it """
+        hdu = kind(data=np.zeros((1, 1, 1), dtype=dtype))
+        if name is not None:
+            hdu.name = name
+        header = hdu.header
+        for axis, size in enumerate(reversed(self.shape), start=1):
+            header[f'NAXIS{axis}'] = size
+
+        if cards is not None:
+            for card in cards.cards:
+                if not _is_structural(card.keyword) and card.keyword not in ('', 'END'):
+                    header.append(card, end=True)
+        return header
+
+    def write(self, index: int | slice, planes: Planes) -> None:
+        """ Write a single plane (`index` is an integer) or a chunk of consecutive planes (a slice) """
+        self.data[index] = planes.data
+        self.error[index] = planes.error
+        self.quality[index] = planes.quality
+        self.written[index] = True
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.written.all())
+
+    def close(self) -> None:
+        """ Flush the planes to the file and release the memory maps """
+        for cube in (self.data, self.error, self.quality):
+            cube.flush()
+        del self.data, self.error, self.quality
+
+    def __enter__(self) -> 'CubeWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
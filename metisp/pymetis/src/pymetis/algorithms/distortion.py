@@ -0,0 +1,154 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from scipy import ndimage
+
+from pymetis.algorithms.rectification import DistortionTable, fit_polynomials, evaluate_polynomials
+
+"""
+Geometric calibration of the IFU from pinhole mask exposures.
+
+The PINHOLE_TABLE lists the pinholes of the mask, one per row, with the slice they fall on (`SLICE`)
+and their position along the slice in spaxels (`U`); its header gives the number of spaxels per slice (`NSPAX`).
+The rows are in the order in which the pinhole traces appear on the detector, from the bottom up.
+
+Every pinhole produces a row of spots along the dispersion direction. All spots are detected at once
+as connected regions above the background, and their centroids are computed from per-label sums
+over the whole image in a single pass. The spots are assigned to pinholes by their detector row,
+and the position along the slice `u(x, y)` is fitted for all slices in a single batched solution.
+"""
+
+
+@dataclass
+class PinholeTable:
+    slices: np.ndarray
+    positions: np.ndarray                       # [spaxels] Position of every pinhole along its slice
+    spaxels: int
+
+    @classmethod
+    def load(cls, filename: str | Path) -> 'PinholeTable':
+        with fits.open(filename) as hdus:
+            table, header = hdus[1].data, hdus[1].header
+            return cls(np.asarray(table['SLICE']), np.asarray(table['U'], dtype=np.float64), header['NSPAX'])
+
+
+@dataclass
+class Spots:
+    """ Centroids, fluxes and sizes (in pixels) of the detected spots """
+    x: np.ndarray
+    y: np.ndarray
+    flux: np.ndarray
+    size: np.ndarray
+
+
+def detect_spots(image: np.ndarray,
+                 *,
+                 threshold: float = 5.0,
+                 min_pixels: int = 3,
+                 mask: np.ndarray = None) -> Spots:
+    """
+    Detect spots as connected regions more than `threshold` robust standard deviations above the median.
+    Pixels where `mask` is True are ignored. Regions smaller than `min_pixels` are rejected as noise
+    (or hot pixels). The statistics of all regions are computed at once from the label image.
+    """
+    usable = np.isfinite(image) if mask is None else np.isfinite(image) & ~mask
+    background = np.median(image[usable])
+    sigma = 1.4826 * np.median(np.abs(image[usable] - background))
+    values = np.where(usable, image - background, 0)
+
+    labels, count = ndimage.label(values > threshold * sigma)
+    flat = labels.ravel()
+    weights = values.ravel()
+    y, x = np.indices(image.shape)
+
+    size = np.bincount(flat, minlength=count + 1)[1:]
+    flux = np.bincount(flat, weights=weights, minlength=count + 1)[1:]
+    cx = np.bincount(flat, weights=weights * x.ravel(), minlength=count + 1)[1:] / flux
+    cy = np.bincount(flat, weights=weights * y.ravel(), minlength=count + 1)[1:] / flux
+
+    keep = size >= min_pixels
+    return Spots(cx[keep], cy[keep], flux[keep], size[keep])
+
+
+def assign_pinholes(y: np.ndarray, count: int) -> np.ndarray:
+    """
+    Assign the spots to `count` pinholes by splitting their sorted rows at the `count - 1` widest gaps.
+    Returns the index of the pinhole of every spot.
+    """
+    if len(y) < count:
+        raise ValueError(f"Found only {len(y)} spots for {count} pinholes")
+
+    order = np.argsort(y)
+    breaks = np.sort(np.argsort(np.diff(y[order]))[len(y) - count:]) + 1
+    pinhole = np.empty(len(y), dtype=np.int64)
+    pinhole[order] = np.searchsorted(breaks, np.arange(len(y)), side='right')
+    return pinhole
+
+
+@dataclass
+class DistortionSolution:
+    """ The fitted distortion table and the statistics of the spots it was fitted to """
+    table: DistortionTable
+    spots: int
+    rms: float                                  # [spaxels] Robust RMS of the fit residuals
+
+
+def slice_rows(table: DistortionTable, columns: int = 5) -> np.ndarray:
+    """
+    First and last detector row of every slice: the rows where `0 <= u <= spaxels` at any of
+    `columns` columns evenly spread over the detector. Evaluated for all slices and rows at once.
+    """
+    ny, nx = table.detector_shape
+    n_slices = len(table.slices)
+
+    slices, y, x = np.meshgrid(np.arange(n_slices), np.arange(ny), np.linspace(0, nx - 1, columns), indexing='ij')
+    u = evaluate_polynomials(*table.normalize(x.ravel(), y.ravel()), slices.ravel(), table.coefficients)
+    inside = ((u >= 0) & (u <= table.spaxels)).reshape(slices.shape).any(axis=2)
+
+    if not inside.any(axis=1).all():
+        raise ValueError(f"Slices {table.slices[~inside.any(axis=1)].tolist()} do not fall on the detector")
+    return np.stack([inside.argmax(axis=1), ny - 1 - inside[:, ::-1].argmax(axis=1)], axis=1)
+
+
+def solve(image: np.ndarray,
+          pinholes: PinholeTable,
+          *,
+          degree: int = 2,
+          threshold: float = 5.0,
+          min_pixels: int = 3,
+          mask: np.ndarray = None,
+          rejection: float = 5.0) -> DistortionSolution:
+    """
+    Derive the distortion table from a (dark-subtracted) pinhole image.
+    After a first fit, spots deviating by more than `rejection` times the robust RMS are rejected and the fit is redone.
+    """
+    spots = detect_spots(image, threshold=threshold, min_pixels=min_pixels, mask=mask)
+    pinhole = assign_pinholes(spots.y, len(pinholes.slices))
+
+    slice_numbers, slice_index = np.unique(pinholes.slices, return_inverse=True)
+    n_slices = len(slice_numbers)
+    slices = slice_index[pinhole]
+    u = pinholes.positions[pinhole]
+
+    table = DistortionTable(slice_numbers, np.zeros((n_slices, degree + 1, degree + 1)), image.shape,
+                            rows=np.zeros((n_slices, 2), dtype=np.int64), spaxels=pinholes.spaxels)
+    xn, yn = table.normalize(spots.x, spots.y)
+
+    # The variation along the slice is only constrained by the different pinholes on it
+    distinct = np.bincount(slice_index, minlength=n_slices)
+    if (distinct <= degree).any():
+        raise ValueError(f"Slices {slice_numbers[distinct <= degree].tolist()} have too few pinholes "
+                         f"to fit a polynomial of degree {degree}")
+
+    use = np.ones(len(u), dtype=bool)
+    for _ in range(2):
+        table.coefficients = fit_polynomials(xn[use], yn[use], u[use], slices[use], n_slices, (degree, degree))
+        fitted = int(use.sum())
+        residuals = u - evaluate_polynomials(xn, yn, slices, table.coefficients)
+        rms = 1.4826 * np.median(np.abs(residuals[use] - np.median(residuals[use])))
+        use = np.abs(residuals) <= max(rejection * rms, 0.01)
+
+    table.rows = slice_rows(table)
+    return DistortionSolution(table, fitted, float(rms))
@@ -0,0 +1,143 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Tuple
+
+import numpy as np
+
+from pymetis.algorithms.stacking import Planes
+
+"""
+Lazy per-pixel arithmetic on DATA/ERR/DQ planes.
+
+Recipes describe the calibration of a frame as an expression, e.g. `(lazy(combined) - lazy(dark) * n) / lazy(flat)`,
+which builds a small graph instead of computing anything. `evaluate` then runs the whole expression
+tile by tile (blocks of rows) in a single pass: every operation works on a tile of its operands,
+so there are no full-size temporaries, only the output. The output may be one of the operands,
+as every tile is read completely before it is written. The tiles may also be computed on a pool
+of worker processes (see `parallel.TilePool`), every worker taking a band of rows.
+
+The operations have exactly the semantics of the corresponding in-place `Planes` methods,
+which are applied to copies of the tiles.
+"""
+
+
+class Expression(ABC):
+    """ A node of the expression graph: something that can produce a tile of planes """
+
+    @property
+    @abstractmethod
+    def shape(self) -> Tuple[int, ...]:
+        """ Shape of the planes produced by the expression """
+
+    @abstractmethod
+    def tile(self, window: slice) -> Planes:
+        """ Compute rows `window` of the result; the returned planes are owned by the caller """
+
+    def __sub__(self, other: 'Expression') -> 'Expression':
+        return Subtract(self, other)
+
+    def __truediv__(self, other: 'Expression') -> 'Expression':
+        return Divide(self, other)
+
+    def __mul__(self, factor: float) -> 'Expression':
+        return Scale(self, factor)
+
+    @abstractmethod
+    def with_sources(self, replace: Callable[['Source'], 'Expression']) -> 'Expression':
+        """ The same expression with every `Source` leaf replaced by `replace(source)` """
+
+    def evaluate(self, *, out: Planes = None, tile_pixels: int = 1 << 20, pool=None) -> Planes:
+        """
+        Compute the expression tile by tile (about `tile_pixels` pixels each) and store it in `out`,
+        which is allocated if not provided. If a `pool` of worker processes (`parallel.TilePool`) is given,
+        the tiles are computed there. Returns `out`.
+        """
+        if out is None:
+            out = Planes(np.empty(self.shape), np.empty(self.shape), np.empty(self.shape, dtype=np.int32))
+        elif out.data.shape != self.shape:
+            raise ValueError(f"Output of shape {out.data.shape} does not match the expression of shape {self.shape}")
+        else:
+            out.writable()
+
+        if pool is not None:
+            return pool.evaluate(self, out, tile_pixels)
+
+        self.evaluate_band(out, slice(0, self.shape[0]), tile_pixels)
+        return out
+
+    def evaluate_band(self, out: Planes, band: slice, tile_pixels: int) -> None:
+        """ Compute the rows `band` of the expression into the same rows of `out`, tile by tile """
+        rows = max(1, tile_pixels // max(1, int(np.prod(self.shape[1:]))))
+        for start in range(band.start, band.stop, rows):
+            window = slice(start, min(start + rows, band.stop))
+            result = self.tile(window)
+            out.data[window], out.error[window], out.quality[window] = result.data, result.error, result.quality
+
+
+class Source(Expression):
+    """ Existing planes (possibly memory-mapped): a leaf of the graph """
+
+    def __init__(self, planes: Planes):
+        self.planes = planes
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.planes.data.shape
+
+    def tile(self, window: slice) -> Planes:
+        return Planes(np.array(self.planes.data[window], dtype=np.float64),
+                      np.array(self.planes.error[window], dtype=np.float64),
+                      np.array(self.planes.quality[window], dtype=np.int32))
+
+    def with_sources(self, replace: Callable[['Source'], Expression]) -> Expression:
+        return replace(self)
+
+
+class Scale(Expression):
+    """ Multiplication by a constant: the error scales with its absolute value """
+
+    def __init__(self, operand: Expression, factor: float):
+        self.operand = operand
+        self.factor = factor
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.operand.shape
+
+    def tile(self, window: slice) -> Planes:
+        planes = self.operand.tile(window)
+        planes.data *= self.factor
+        planes.error *= abs(self.factor)
+        return planes
+
+    def with_sources(self, replace: Callable[['Source'], Expression]) -> Expression:
+        return Scale(self.operand.with_sources(replace), self.factor)
+
+
+class BinaryOperation(Expression, ABC):
+    def __init__(self, left: Expression, right: Expression):
+        if left.shape != right.shape:
+            raise ValueError(f"Cannot combine planes of shapes {left.shape} and {right.shape}")
+        self.left = left
+        self.right = right
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.left.shape
+
+    def with_sources(self, replace: Callable[['Source'], Expression]) -> Expression:
+        return type(self)(self.left.with_sources(replace), self.right.with_sources(replace))
+
+
+class Subtract(BinaryOperation):
+    def tile(self, window: slice) -> Planes:
+        return self.left.tile(window).subtract(self.right.tile(window))
+
+
+class Divide(BinaryOperation):
+    def tile(self, window: slice) -> Planes:
+        return self.left.tile(window).divide(self.right.tile(window))
+
+
+def lazy(planes: Planes | Expression) -> Expression:
+    """ Wrap planes as a leaf of an expression (expressions are returned as they are) """
+    return planes if isinstance(planes, Expression) else Source(planes)
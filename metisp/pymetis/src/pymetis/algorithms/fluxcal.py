@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+from astropy import units
+from astropy.io import fits
+
+from pymetis.algorithms.coadd import CubeGrid
+from pymetis.algorithms.stacking import Planes, QualityFlag
+from pymetis.algorithms.telluric import resample
+
+"""
+Flux calibration of IFU cubes.
+
+The response (the conversion from ADU to Jy) is measured on a standard star and stored in the FLUXCAL_TAB.
+Where the standard star does not constrain it (outside its wavelength range, or in saturated
+telluric bands), the response follows the throughput of the instrument, the product of the quantum efficiency
+of the detector and the efficiency of the grating, scaled to the measured response. The throughput is looked up
+by the detector name; the quantum efficiency table shipped in `metis-calib/spec/spec_quantum_efficiency.fits`
+only describes VISIR detectors, so with it there is no throughput for the METIS detectors and no fallback.
+
+The response is resampled onto the wavelength grid of a cube only once per grid definition,
+and then applied to the cube as a single broadcast multiplication.
+"""
+
+# Keywords that define the spectral axis of a cube, and thus the key of a resampled response
+SPECTRAL_KEYWORDS = ('NAXIS3', 'CTYPE3', 'CUNIT3', 'CRPIX3', 'CRVAL3', 'CDELT3')
+
+
+def read_throughput(filename: str | Path, chip: str | None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Wavelengths (in micrometres) and throughput (quantum times grating efficiency) of detector `chip`,
+    the extension of the quantum efficiency file named after `ESO DET CHIP NAME`.
+    Raises a KeyError if the file does not describe the detector (or it has no name).
+    """
+    with fits.open(filename) as hdus:
+        names = [hdu.name for hdu in hdus[1:]]
+        if chip is None or chip.upper() not in map(str.upper, names):
+            raise KeyError(f"No quantum efficiency for detector {chip!r} in {filename}, only for {names}")
+
+        table = hdus[chip].data
+        unit = units.Unit((hdus[chip].columns['Wavelength'].unit or "m").strip().lower())
+        wavelengths = np.asarray(table['Wavelength'], dtype=np.float64) * unit.to(units.um)
+        throughput = np.asarray(table['Quantum_Efficiency'], dtype=np.float64) \
+            * np.asarray(table['Grating_Efficiency'], dtype=np.float64)
+
+    order = np.argsort(wavelengths)
+    return wavelengths[order], throughput[order]
+
+
+def spectral_key(header: fits.Header) -> Tuple:
+    """ The definition of the spectral axis of a cube, as a hashable key """
+    return tuple(header.get(keyword) for keyword in SPECTRAL_KEYWORDS)
+
+
+class ResponseCache:
+    """
+    The instrument response, resampled onto the wavelength grids of the cubes it is applied to.
+    Resampled responses are kept for every distinct spectral axis, so cubes sharing a grid reuse them.
+    """
+
+    def __init__(self,
+                 wavelengths: np.ndarray,
+                 conversion: np.ndarray,
+                 throughput: Tuple[np.ndarray, np.ndarray] = None):
+        order = np.argsort(wavelengths)
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float64)[order]
+        self.conversion = np.asarray(conversion, dtype=np.float64)[order]
+        self.throughput = throughput
+        self._responses: Dict[Tuple, np.ndarray] = {}
+        self.hits = 0
+
+        # The throughput is only known in relative terms: scale it to the measured response where both are known
+        self.scale = None
+        if throughput is not None:
+            model = 1 / self._throughput(self.wavelengths)
+            valid = np.isfinite(self.conversion) & np.isfinite(model)
+            if valid.any():
+                self.scale = np.median(self.conversion[valid] / model[valid])
+
+    def _throughput(self, wavelengths: np.ndarray) -> np.ndarray:
+        t = np.interp(wavelengths, *self.throughput, left=np.nan, right=np.nan)
+        return np.where(t > 0, t, np.nan)
+
+    def resample(self, wavelengths: np.ndarray) -> np.ndarray:
+        """ The response at `wavelengths`: measured where available, scaled throughput elsewhere, or NaN """
+        response = resample(wavelengths, self.wavelengths, self.conversion)
+        if self.scale is not None:
+            response = np.where(np.isfinite(response), response, self.scale / self._throughput(wavelengths))
+        return response
+
+    def response(self, header: fits.Header) -> np.ndarray:
+        """ The response on the wavelength grid of the cube described by `header`, resampled at most once """
+        key = spectral_key(header)
+        if key in self._responses:
+            self.hits += 1
+        else:
+            self._responses[key] = self.resample(CubeGrid.from_header(header).wavelengths)
+        return self._responses[key]
+
+    def __len__(self) -> int:
+        return len(self._responses)
+
+
+def apply(cube: Planes, response: np.ndarray) -> Planes:
+    """
+    Multiply the cube (in place) by the response, broadcast along the spatial axes.
+    Planes without a known response are flagged as NO_DATA.
+    """
+    unknown = ~np.isfinite(response)
+    factor = response[:, np.newaxis, np.newaxis]
+
+    cube.writable()
+    cube.data *= factor
+    cube.error *= np.abs(factor)
+    cube.quality[unknown] |= QualityFlag.NO_DATA
+    return cube
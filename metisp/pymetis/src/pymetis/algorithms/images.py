@@ -0,0 +1,32 @@
+import cpl
+import numpy as np
+from astropy.io import fits
+
+"""
+Conversions between CPL images and NumPy arrays (and between CPL property lists and FITS headers).
+CPL images are the currency of recipes and products, while the streaming algorithms work on plain arrays.
+"""
+
+
+def as_array(image: cpl.core.Image) -> np.ndarray:
+    """ View (or copy, if a view is not possible) of the pixel data of a CPL image """
+    return np.asarray(image)
+
+
+def as_image(array: np.ndarray) -> cpl.core.Image:
+    """ Create a CPL image from a 2D array """
+    return cpl.core.Image(np.ascontiguousarray(array))
+
+
+def as_imagelist(array: np.ndarray) -> cpl.core.ImageList:
+    """ Create a CPL image list from a 3D array, one image per plane along the first axis """
+    return cpl.core.ImageList([as_image(plane) for plane in array])
+
+
+def as_header(properties: cpl.core.PropertyList) -> fits.Header:
+    """ Create a FITS header from a CPL property list, with HIERARCH cards for the ESO keywords """
+    header = fits.Header()
+    for prop in properties:
+        keyword = prop.name if len(prop.name) <= 8 and ' ' not in prop.name else f"HIERARCH {prop.name}"
+        header[keyword] = (prop.value, prop.comment)
+    return header
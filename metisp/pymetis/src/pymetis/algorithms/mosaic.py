@@ -0,0 +1,108 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Sequence, Tuple, TypeVar
+
+import numpy as np
+from astropy.io import fits
+
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+"""
+Detector arrays read out as several chips, one image extension per chip.
+
+Calibrations and reduced frames cover the whole array as a single mosaic image. The raw chips are placed
+into it according to their `ESO DET CHIP X` and `ESO DET CHIP Y` positions (1-based columns and rows of the array),
+or side by side in extension order if the positions are not recorded. Every chip is processed independently
+on its own region of the calibrations, in parallel, and the results are put back together in extension order.
+"""
+
+T = TypeVar('T')
+
+
+def image_headers(hdus: fits.HDUList) -> List[Tuple[int, fits.Header]]:
+    """ Indices and headers of the chips: all two-dimensional image extensions, or the primary HDU if there are none """
+    chips = [(index, hdu.header) for index, hdu in enumerate(hdus)
+             if index > 0 and hdu.is_image and hdu.header.get('NAXIS') == 2]
+    if not chips and hdus[0].header.get('NAXIS') == 2:
+        chips = [(0, hdus[0].header)]
+    return chips
+
+
+@dataclass
+class ChipLayout:
+    """ The image extensions of the chips and the region of every chip in the mosaic """
+    extensions: List[int]
+    windows: List[Tuple[slice, slice]]
+    shape: Tuple[int, int]
+
+    @classmethod
+    def from_headers(cls, extensions: [int], headers: [fits.Header]) -> 'ChipLayout':
+        shapes = [(header['NAXIS2'], header['NAXIS1']) for header in headers]
+        if all('ESO DET CHIP X' in header and 'ESO DET CHIP Y' in header for header in headers):
+            positions = [(header['ESO DET CHIP Y'] - 1, header['ESO DET CHIP X'] - 1) for header in headers]
+        else:
+            positions = [(0, index) for index in range(len(headers))]
+
+        if len(set(positions)) != len(positions):
+            raise ValueError(f"Chips in extensions {extensions} overlap: positions {positions}")
+
+        # Every row of the array is as high as its highest chip, every column as wide as its widest one
+        rows, columns = (np.zeros(max(p[axis] for p in positions) + 1, dtype=np.int64) for axis in (0, 1))
+        for (row, column), (ny, nx) in zip(positions, shapes):
+            rows[row] = max(rows[row], ny)
+            columns[column] = max(columns[column], nx)
+        y0, x0 = np.concatenate([[0], np.cumsum(rows)]), np.concatenate([[0], np.cumsum(columns)])
+
+        windows = [(slice(int(y0[row]), int(y0[row] + ny)), slice(int(x0[column]), int(x0[column] + nx)))
+                   for (row, column), (ny, nx) in zip(positions, shapes)]
+        return cls(list(extensions), windows, (int(y0[-1]), int(x0[-1])))
+
+    @classmethod
+    def from_file(cls, filename: str | Path) -> 'ChipLayout':
+        """ The layout of a raw file: all two-dimensional image extensions, or the primary HDU if there are none """
+        with fits.open(filename, memmap=True) as hdus:
+            chips = image_headers(hdus)
+
+        if not chips:
+            raise ValueError(f"No two-dimensional images in {filename}")
+        return cls.from_headers(*zip(*chips))
+
+    def __len__(self) -> int:
+        return len(self.extensions)
+
+    def read(self, filename: str | Path, chip: int) -> np.ndarray:
+        """ The pixels of a single chip """
+        return np.asarray(fits.getdata(filename, self.extensions[chip]), dtype=np.float64)
+
+    def split(self, planes: Planes, chip: int) -> Planes:
+        """ The region of a chip in mosaic planes (views, not copies) """
+        window = self.windows[chip]
+        return Planes(planes.data[window], planes.error[window], planes.quality[window])
+
+    def assemble(self, chips: Sequence[np.ndarray], fill: float = 0) -> np.ndarray:
+        """ Put the images of all chips into a mosaic; pixels between the chips are set to `fill` """
+        mosaic = np.full(self.shape, fill, dtype=np.result_type(*chips))
+        for window, image in zip(self.windows, chips):
+            mosaic[window] = image
+        return mosaic
+
+    def assemble_planes(self, chips: Sequence[Planes]) -> Planes:
+        """ Put the planes of all chips into mosaic planes, with the gaps between the chips flagged as NO_DATA """
+        return Planes(self.assemble([planes.data for planes in chips]),
+                      self.assemble([planes.error for planes in chips]),
+                      self.assemble([planes.quality for planes in chips], fill=QualityFlag.NO_DATA))
+
+
+def map_chips(function: Callable[[int], T], count: int, workers: int | None = None) -> List[T]:
+    """
+    Call `function` for every chip on a pool of threads and return the results in chip order.
+    NumPy releases the GIL in its heavy loops, so independent chips scale almost linearly with threads.
+    """
+    workers = min(count, workers or os.cpu_count() or 1)
+    if workers <= 1:
+        return [function(chip) for chip in range(count)]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chip") as executor:
+        return list(executor.map(function, range(count)))
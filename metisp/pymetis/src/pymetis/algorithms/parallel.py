@@ -0,0 +1,194 @@
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Literal, Tuple
+
+import numpy as np
+
+from pymetis.algorithms.backend import ArrayBackend
+from pymetis.algorithms.expression import Expression, Source
+from pymetis.algorithms.stacking import Planes, collapse
+
+"""
+Row bands of images computed on a pool of worker processes, for the per-pixel work that threads do not speed up.
+
+Images are exchanged through shared memory (`multiprocessing.shared_memory`) or memory-mapped files:
+only their descriptions (`SharedArray`) are pickled, never the pixels. Every worker attaches to the inputs
+and the output and computes its own band of rows, disjoint from those of the other workers, so no locking
+is needed. The shared memory segments are created and unlinked by the pool in the recipe process;
+the workers keep their attachments until they exit with the pool.
+"""
+
+# Segments attached to by a worker process, by name
+_attached: Dict[str, SharedMemory] = {}
+
+
+def _address(array: np.ndarray) -> int:
+    return array.__array_interface__['data'][0]
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """ Where another process finds an array: a shared memory segment, or a memory-mapped file if `file` """
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    offset: int = 0
+    file: bool = False
+
+    @classmethod
+    def of_memmap(cls, array: np.memmap) -> 'SharedArray':
+        """ The description of a (C-contiguous) memory-mapped array, possibly a slice of a larger map """
+        if not array.flags.c_contiguous:
+            raise ValueError("Only contiguous memory-mapped arrays can be shared")
+        root = array
+        while not isinstance(root.base, mmap.mmap):
+            root = root.base
+        return cls(array.filename, array.shape, array.dtype.str,
+                   root.offset + _address(array) - _address(root), file=True)
+
+    def attach(self) -> np.ndarray:
+        """ The array, in the memory shared with the process that described it """
+        if self.file:
+            return np.memmap(self.name, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+        if (segment := _attached.get(self.name)) is None:
+            segment = _attached[self.name] = SharedMemory(self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=segment.buf, offset=self.offset)
+
+
+class SharedSource(Expression):
+    """ A leaf of an expression whose planes are in shared memory, evaluated in a worker process """
+
+    def __init__(self, data: SharedArray, error: SharedArray, quality: SharedArray):
+        self.planes = (data, error, quality)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.planes[0].shape
+
+    def tile(self, window: slice) -> Planes:
+        data, error, quality = (plane.attach()[window] for plane in self.planes)
+        return Planes(np.array(data, dtype=np.float64), np.array(error, dtype=np.float64),
+                      np.array(quality, dtype=np.int32))
+
+    def with_sources(self, replace: Callable[[Source], Expression]) -> Expression:
+        return self
+
+
+class _Segment:
+    """ A shared memory segment created by the recipe process, and an array in it """
+
+    def __init__(self, shape: Tuple[int, ...], dtype):
+        dtype = np.dtype(dtype)
+        self.memory = SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf)
+        self.shared = SharedArray(self.memory.name, tuple(shape), dtype.str)
+
+    def release(self) -> None:
+        # The array must go first: a segment cannot be closed while it is still exported
+        del self.array
+        self.memory.close()
+        self.memory.unlink()
+
+
+def _collapse_band(stack: SharedArray, out: SharedArray, band: slice,
+                   method: str, backend: ArrayBackend, rows: int | None) -> None:
+    out.attach()[band] = collapse(stack.attach()[:, band], method, backend, rows)
+
+
+def _evaluate_band(expression: Expression, out: Tuple[SharedArray, SharedArray, SharedArray],
+                   band: slice, tile_pixels: int) -> None:
+    expression.evaluate_band(Planes(*(plane.attach() for plane in out)), band, tile_pixels)
+
+
+class TilePool:
+    """
+    A pool of worker processes (all cores by default) computing disjoint bands of rows, used as a context manager.
+    The workers are started with `spawn`, so that it is safe to create a pool from a multithreaded recipe.
+    """
+
+    def __init__(self, processes: int = None):
+        self.processes = processes or os.cpu_count() or 1
+        self._executor: ProcessPoolExecutor | None = None
+
+    def __enter__(self) -> 'TilePool':
+        self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._executor.shutdown()
+        self._executor = None
+
+    def bands(self, rows: int) -> List[slice]:
+        """ Disjoint bands covering `rows` rows, one for every worker """
+        edges = np.linspace(0, rows, min(self.processes, rows) + 1).astype(int)
+        return [slice(int(start), int(stop)) for start, stop in zip(edges[:-1], edges[1:])]
+
+    def _run(self, function: Callable, arguments: List[tuple]) -> None:
+        if self._executor is None:
+            raise RuntimeError("The pool has to be entered as a context manager before use")
+        for future in [self._executor.submit(function, *args) for args in arguments]:
+            future.result()
+
+    def collapse(self,
+                 stack: np.ndarray | List[np.ndarray],
+                 method: Literal['median'] | Literal['sigclip'],
+                 backend: ArrayBackend,
+                 rows: int = None) -> np.ndarray:
+        """
+        `stacking.collapse` on the workers, every one collapsing its band `rows` rows at a time.
+        A memory-mapped stack is used in place. Any other stack is copied to shared memory;
+        a list of frames is emptied on the way, so that every frame is held only once.
+        """
+        segments = []
+        try:
+            if isinstance(stack, np.memmap) and stack.filename is not None:
+                shape, shared = stack.shape, SharedArray.of_memmap(stack)
+            else:
+                shape = (len(stack), *np.shape(stack[0]))
+                segments.append(copy := _Segment(shape, np.float64))
+                for index in range(len(stack)):
+                    copy.array[index] = stack[index]
+                    if isinstance(stack, list):
+                        stack[index] = None
+                shared = copy.shared
+
+            segments.append(result := _Segment(shape[1:], np.float64))
+            self._run(_collapse_band, [(shared, result.shared, band, method, backend, rows)
+                                       for band in self.bands(shape[1])])
+            return result.array.copy()
+        finally:
+            for segment in segments:
+                segment.release()
+
+    def evaluate(self, expression: Expression, out: Planes, tile_pixels: int) -> Planes:
+        """
+        `Expression.evaluate` on the workers, every one computing its band tile by tile.
+        The planes of the sources are copied to shared memory first, so `out` may be one of them.
+        """
+        segments = []
+
+        def share(source: Source) -> SharedSource:
+            planes = []
+            for plane, dtype in zip([source.planes.data, source.planes.error, source.planes.quality],
+                                    [np.float64, np.float64, np.int32]):
+                segments.append(segment := _Segment(plane.shape, dtype))
+                segment.array[...] = plane
+                planes.append(segment.shared)
+            return SharedSource(*planes)
+
+        try:
+            shared = expression.with_sources(share)
+            output = [_Segment(out.data.shape, dtype) for dtype in [np.float64, np.float64, np.int32]]
+            segments += output
+            self._run(_evaluate_band, [(shared, tuple(segment.shared for segment in output), band, tile_pixels)
+                                       for band in self.bands(out.data.shape[0])])
+            out.data[...], out.error[...], out.quality[...] = (segment.array for segment in output)
+            return out
+        finally:
+            for segment in segments:
+                segment.release()
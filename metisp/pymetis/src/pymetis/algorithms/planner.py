@@ -0,0 +1,165 @@
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Literal, Tuple
+
+from astropy.io import fits
+
+from pymetis.algorithms.mosaic import ChipLayout, image_headers
+
+"""
+Memory planning of the combine and calibration stages, from the headers of the raw frames only.
+
+The footprint of every stage is estimated from the geometry of the frames (chips, their size and BITPIX)
+and their number, with the per-pixel costs below: what a stage holds for the whole run plus the temporaries
+of the NumPy operations. Within a memory budget the planner then chooses
+
+-   the number of chips processed concurrently,
+-   the number of rows collapsed at a time by the stacked methods (`median`, `sigclip`), and whether the stack
+    itself has to be kept in a memory-mapped file rather than in memory,
+-   the tile size of the lazy calibration arithmetic (see `expression.Expression.evaluate`).
+
+With a pool of worker processes (see `parallel.TilePool`) every process collapses and calibrates its own band
+of rows at the same time, and the inputs of the calibration are copied to shared memory.
+
+The estimates are deliberately on the safe side; they do not include the interpreter and the libraries.
+"""
+
+MiB = 1 << 20
+
+# Bytes per pixel
+PLANES_BYTES = 20           # DATA and ERR (float64) and DQ (int32)
+FRAME_BYTES = 8             # A frame converted to float64, in addition to the raw pixels
+RUNNING_BYTES = 48          # Welford mean and M2, DQ and its flags, and the temporaries of the update
+STACK_BYTES = 8             # A frame in the stack of the stacked methods
+TILE_COPIES = 4             # Planes tiles alive at once while evaluating a calibration expression
+
+# Bytes per pixel of the stack, while collapsing it
+COLLAPSE_BYTES: Dict[str, int] = {
+    'median': 8,            # The partitioned copy made by `np.median`
+    'sigclip': 25,          # Mask of kept values and the masked and squared deviations
+}
+
+# Default tile size of the calibration stage, when memory is not a concern
+DEFAULT_TILE_PIXELS = 1 << 20
+
+
+@dataclass(frozen=True)
+class FrameGeometry:
+    """ What the memory footprint depends on: the chips of the raw frames, their BITPIX and number """
+    layout: ChipLayout
+    bitpix: int
+    count: int
+
+    @classmethod
+    def from_files(cls, files: [str | Path]) -> 'FrameGeometry':
+        """ The geometry of a set of raw frames, from the headers of the first one (the others should match) """
+        files = list(files)
+        if not files:
+            raise ValueError("No raw frames to plan for")
+
+        with fits.open(files[0], memmap=True) as hdus:
+            chips = image_headers(hdus)
+            if not chips:
+                raise ValueError(f"No two-dimensional images in {files[0]}")
+            bitpix = max(abs(header['BITPIX']) for _, header in chips)
+            layout = ChipLayout.from_headers(*zip(*chips))
+
+        return cls(layout, bitpix, len(files))
+
+    @property
+    def chips(self) -> List[Tuple[int, int]]:
+        """ Shapes of the chips """
+        return [(rows.stop - rows.start, columns.stop - columns.start) for rows, columns in self.layout.windows]
+
+
+@dataclass
+class MemoryPlan:
+    """ How to run the combine and calibration stages, and their estimated peak memory in bytes """
+    geometry: FrameGeometry
+    method: str
+    budget: int | None
+    workers: int
+    combine_rows: int | None                # Rows of the stack collapsed at a time, None for all
+    spill: bool                             # Keep the stack in a memory-mapped file
+    tile_pixels: int
+    per_chip: bool = False
+    processes: int = 1                      # Worker processes computing bands of rows, 1 for none
+    estimates: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def within_budget(self) -> bool:
+        return self.budget is None or max(self.estimates.values(), default=0) <= self.budget
+
+    def report(self) -> List[str]:
+        """ The plan, line by line, for the log """
+        geometry = self.geometry
+        chips = ', '.join(f"{nx}x{ny}" for ny, nx in geometry.chips)
+        mode = "chip by chip" if self.per_chip else "as a mosaic"
+        budget = "unlimited" if self.budget is None else f"{self.budget / MiB:.0f} MiB"
+        lines = [
+            f"{geometry.count} frames of {len(geometry.chips)} chip(s) {chips}, BITPIX {geometry.bitpix}, "
+            f"method {self.method!r}, memory budget {budget}",
+            f"combine {mode}: {self.workers} at a time"
+            + (f", stack collapsed {self.combine_rows} rows at a time" if self.combine_rows else "")
+            + (", stack memory-mapped on disk" if self.spill else "")
+            + (f", collapsed by {self.processes} processes" if self.processes > 1 else ""),
+            f"calibration: tiles of {self.tile_pixels} pixels"
+            + (f" on {self.processes} processes" if self.processes > 1 else ""),
+        ]
+        lines += [f"estimated peak of {stage}: {size / MiB:.1f} MiB" for stage, size in self.estimates.items()]
+        if not self.within_budget:
+            lines.append("the budget cannot be met even with the smallest tiles and a single worker")
+        return lines
+
+
+def plan_memory(geometry: FrameGeometry,
+                method: Literal['add'] | Literal['average'] | Literal['median'] | Literal['sigclip'],
+                max_memory: int | None = None,
+                *,
+                per_chip: bool = False,
+                processes: int = 1,
+                cpus: int = None) -> MemoryPlan:
+    """
+    Choose worker counts and tile sizes so that every stage fits into `max_memory` bytes (None or 0: no limit).
+    The frames are combined either as mosaics of all chips, or `per_chip` (see `RawImageProcessor.process_chips`).
+    The stack is collapsed and the calibration computed by `processes` worker processes at once.
+    """
+    cpus = cpus or os.cpu_count() or 1
+    pixels = geometry.layout.shape[0] * geometry.layout.shape[1]
+    ny, nx = max(geometry.chips, key=lambda shape: shape[0] * shape[1]) if per_chip else geometry.layout.shape
+    frame = ny * nx * (geometry.bitpix // 8 + FRAME_BYTES)
+    output = pixels * PLANES_BYTES
+    stacked = method in COLLAPSE_BYTES
+    budget = max_memory or None
+    available = None if budget is None else budget - output
+
+    # Combine: one frame in flight per worker, plus the running statistics or the stack of its chip
+    holds = ny * nx * (STACK_BYTES * geometry.count if stacked else RUNNING_BYTES)
+    workers = min(len(geometry.chips), cpus) if per_chip else 1
+    if available is not None:
+        workers = int(max(1, min(workers, available // (frame + holds))))
+
+    combine_rows, spill, collapse = None, False, 0
+    if stacked:
+        row = COLLAPSE_BYTES[method] * geometry.count * nx
+        if available is not None:
+            if (frame + holds + row) * workers > available:
+                # The stack goes to disk: the page cache holding it can be reclaimed by the system
+                spill, holds = True, 0
+            rows = max(1, (available - (frame + holds) * workers) // (row * workers * processes))
+            combine_rows = None if rows * processes >= ny else int(rows)
+        collapse = row * min(ny, (combine_rows or ny) * processes)
+
+    # Calibration: the output planes are calibrated in place; full-size calibrations plus tiles of everything.
+    # Worker processes get shared copies of the combined planes and the calibrations, and a shared output.
+    calibrations = pixels * PLANES_BYTES * (1 if processes == 1 else 4)
+    tile_pixels = DEFAULT_TILE_PIXELS
+    if available is not None:
+        affordable = (available - calibrations) // (TILE_COPIES * PLANES_BYTES * processes)
+        tile_pixels = int(max(nx, min(DEFAULT_TILE_PIXELS, affordable)))
+
+    return MemoryPlan(geometry, method, budget, workers, combine_rows, spill, tile_pixels, per_chip, processes, {
+        'combine': output + (frame + holds + collapse) * workers,
+        'calibration': output + calibrations + TILE_COPIES * PLANES_BYTES * tile_pixels * processes,
+    })
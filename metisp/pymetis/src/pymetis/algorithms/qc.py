@@ -0,0 +1,182 @@
+import functools
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+
+"""
+Quality control parameters.
+
+The names, types and comments of QC parameters are defined by the METIS QC dictionary
+(`metisc/dic/ESO-DFS-DIC.METIS_QC`), which is the single source of truth for them. It is found in the source
+tree next to the pipeline, or wherever the `METIS_QC_DICTIONARY` environment variable points. Indexed parameters
+are written with a lowercase `i` in the dictionary (e.g. `QC RONi`) and match any number in its place.
+
+The `QcEngine` is fed the frames of a recipe as they stream through it and computes all parameters
+on sub-sampled pixel grids with vectorized reductions, so that QC costs a small fraction of the recipe itself.
+"""
+
+QC_DICTIONARY_ENV = "METIS_QC_DICTIONARY"
+# Only valid in a source checkout: installed pipelines have to set `METIS_QC_DICTIONARY`
+QC_DICTIONARY_DEFAULT = Path(__file__).parents[5] / "metisc" / "dic" / "ESO-DFS-DIC.METIS_QC"
+
+
+def qc_dictionary_file() -> Path:
+    """ The location of the METIS QC dictionary: `$METIS_QC_DICTIONARY`, or the source tree if it is not set """
+    if filename := os.environ.get(QC_DICTIONARY_ENV):
+        if not Path(filename).is_file():
+            raise FileNotFoundError(f"The METIS QC dictionary {filename!r} given by {QC_DICTIONARY_ENV} does not exist")
+        return Path(filename)
+
+    if not QC_DICTIONARY_DEFAULT.is_file():
+        raise FileNotFoundError(f"The METIS QC dictionary was not found in the source tree ({QC_DICTIONARY_DEFAULT}): "
+                                f"set {QC_DICTIONARY_ENV} to the location of ESO-DFS-DIC.METIS_QC")
+    return QC_DICTIONARY_DEFAULT
+
+
+@dataclass(frozen=True)
+class QcDefinition:
+    """ One `Parameter Name` entry of a DFS dictionary """
+    name: str
+    type: str = "double"
+    unit: str = ""
+    comment: str = ""
+
+    @property
+    def pattern(self) -> re.Pattern:
+        """ Regular expression matching the parameter name, with `i` standing for an index """
+        words = [re.escape(word[:-1]) + r"\d+" if word.endswith('i') and word[:-1].isupper() else re.escape(word)
+                 for word in self.name.split()]
+        return re.compile(' '.join(words) + '$')
+
+
+class QcDictionary:
+    """ The QC parameter definitions of a DFS dictionary file, looked up by parameter name """
+    def __init__(self, definitions: [QcDefinition]):
+        self.definitions: List[QcDefinition] = list(definitions)
+        self._patterns = [(definition.pattern, definition) for definition in self.definitions]
+
+    @classmethod
+    def load(cls, filename: str | Path = None) -> 'QcDictionary':
+        """
+        Parse a dictionary file. By default the METIS QC dictionary is used (see `qc_dictionary_file`),
+        its location can be overridden with the `METIS_QC_DICTIONARY` environment variable.
+        """
+        filename = Path(filename) if filename else qc_dictionary_file()
+        definitions = []
+        entry: Dict[str, str] = {}
+
+        def flush():
+            if 'Parameter Name' in entry:
+                definitions.append(QcDefinition(name=entry['Parameter Name'],
+                                                type=entry.get('Type', 'double'),
+                                                unit=entry.get('Unit', ''),
+                                                comment=entry.get('Comment Field', '')))
+
+        for line in filename.read_text().splitlines():
+            if line.startswith('#') or ':' not in line:
+                continue
+
+            key, value = (part.strip() for part in line.split(':', 1))
+            if key == 'Parameter Name':
+                flush()
+                entry = {}
+            entry[key] = value
+
+        flush()
+        return cls(definitions)
+
+    def lookup(self, name: str) -> QcDefinition:
+        for pattern, definition in self._patterns:
+            if pattern.match(name):
+                return definition
+
+        raise KeyError(f"QC parameter {name!r} is not defined in the QC dictionary")
+
+
+@functools.cache
+def qc_dictionary() -> QcDictionary:
+    """ The METIS QC dictionary, loaded once per process """
+    return QcDictionary.load()
+
+
+class QcEngine:
+    """
+    Computes QC parameters from frames streamed through a recipe and from its combined product.
+
+    -   read-out noise from differences of consecutive frames (which removes the fixed pattern),
+        estimated robustly from the median absolute deviation,
+    -   median level of every read-out channel,
+    -   median level and number of hot pixels of the combined image.
+
+    Per-frame statistics are computed on a grid sub-sampled by `stride` in both axes.
+    Only the sub-sampled previous frame is kept between calls.
+    """
+    mad_to_sigma = 1.4826
+
+    def __init__(self, *, stride: int = 4, channels: int = 32, hot_sigma: float = 5.0):
+        self.stride = stride
+        self.channels = channels
+        self.hot_sigma = hot_sigma
+
+        self._previous: np.ndarray | None = None
+        self.ron: List[float] = []
+        self.channel_medians: List[np.ndarray] = []
+
+    def feed(self, frame: np.ndarray) -> None:
+        """ Update the per-frame statistics with another frame """
+        sample = np.asarray(frame, dtype=np.float64)[::self.stride, ::self.stride]
+
+        if self._previous is not None and self._previous.shape == sample.shape:
+            difference = sample - self._previous
+            mad = np.nanmedian(np.abs(difference - np.nanmedian(difference)))
+            # The difference of two frames has sqrt(2) times the noise of a single frame
+            self.ron.append(float(self.mad_to_sigma * mad / np.sqrt(2)))
+        self._previous = sample
+
+        # Channels are contiguous blocks of columns: reshape the sub-sampled rows and reduce per block
+        width = frame.shape[1] // self.channels
+        if width > 0 and frame.shape[1] % self.channels == 0:
+            rows = np.asarray(frame)[::self.stride]
+            blocks = rows.reshape(rows.shape[0], self.channels, width)[:, :, ::self.stride]
+            self.channel_medians.append(np.nanmedian(blocks, axis=(0, 2)))
+
+    @classmethod
+    def merge(cls, engines: ['QcEngine']) -> 'QcEngine':
+        """
+        Merge the per-frame statistics of engines fed with different chips of the same frames:
+        the read-out noise of a frame is averaged over the chips, the channels of all chips are numbered in turn.
+        """
+        merged = cls(stride=engines[0].stride, channels=engines[0].channels, hot_sigma=engines[0].hot_sigma)
+        if all(engine.ron for engine in engines):
+            merged.ron = [float(np.mean(values)) for values in zip(*(engine.ron for engine in engines))]
+        if all(engine.channel_medians for engine in engines):
+            merged.channel_medians = [np.concatenate(medians)
+                                      for medians in zip(*(engine.channel_medians for engine in engines))]
+        return merged
+
+    def parameters(self, combined: np.ndarray | None = None) -> Dict[str, Any]:
+        """ All QC parameters computed so far, named as in the QC dictionary (without the `ESO` prefix) """
+        qc: Dict[str, Any] = {}
+
+        if self.ron:
+            qc["QC RON MEAN"] = float(np.mean(self.ron))
+            for index, ron in enumerate(self.ron, start=1):
+                qc[f"QC RON{index}"] = ron
+
+        if self.channel_medians:
+            for index, median in enumerate(np.mean(self.channel_medians, axis=0), start=1):
+                qc[f"QC CHAN{index} MED"] = float(median)
+
+        if combined is not None:
+            sample = combined[::self.stride, ::self.stride]
+            median = np.nanmedian(sample)
+            sigma = self.mad_to_sigma * np.nanmedian(np.abs(sample - median))
+            qc["QC MED"] = float(median)
+            # The threshold comes from the sub-sample, but hot pixels have to be counted on the full image
+            qc["QC HOTPIX NUM"] = int(np.count_nonzero(combined > median + self.hot_sigma * sigma))
+
+        return qc
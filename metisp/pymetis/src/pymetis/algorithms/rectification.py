@@ -0,0 +1,350 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from astropy.io import fits
+from numpy.polynomial import polynomial
+from scipy import sparse
+
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+"""
+Reconstruction of IFU data cubes from detector images.
+
+The geometry of the IFU is described by two calibration tables, both with one row per slice
+and a 2D polynomial in normalized detector coordinates `xn, yn` (mapped to [-1, 1] over the detector):
+
+ -  IFU_DISTORTION_TABLE: the detector rows `YMIN`..`YMAX` covered by the slice and the position `u(x, y)`
+    along the slice in spaxels (spaxel `i` spans `i <= u < i + 1`),
+ -  IFU_WAVECAL: the wavelength `lambda(x, y)` in micrometres, and the wavelength grid of the output cube.
+
+Since the geometry is the same for every exposure, the mapping from detector pixels to cube voxels
+is precomputed once as a sparse matrix (the rectification operator). Reconstructing a cube is then
+a single sparse matrix-vector product. Operators may be cached on disk, keyed by the digests of both tables,
+in a directory given explicitly or by `$PYMETIS_CACHE_DIR`; without one nothing is written.
+"""
+
+CACHE_DIR_ENV = "PYMETIS_CACHE_DIR"
+
+
+def default_cache_dir() -> Path | None:
+    """ Where precomputed operators are kept unless a directory is requested explicitly, None for no cache """
+    return Path(directory) if (directory := os.environ.get(CACHE_DIR_ENV)) else None
+
+
+def file_digest(filename: str | Path) -> str:
+    """ SHA-256 digest of a file's contents, read in chunks """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class SlicePolynomials:
+    """
+    One 2D polynomial per slice, `coefficients[s, i, j]` multiplying `xn ** i * yn ** j`.
+    This is the common part of the IFU distortion table and the wavelength calibration.
+    """
+    slices: np.ndarray
+    coefficients: np.ndarray
+    detector_shape: Tuple[int, int]             # (ny, nx)
+
+    def normalize(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ Detector pixel coordinates to the [-1, 1] range the polynomials are defined on """
+        ny, nx = self.detector_shape
+        return 2 * x / (nx - 1) - 1, 2 * y / (ny - 1) - 1
+
+    def evaluate(self, index: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """ Evaluate the polynomial of the slice in row `index` at detector pixel coordinates """
+        return polynomial.polyval2d(*self.normalize(x, y), self.coefficients[index])
+
+    def index(self, slice_number: int) -> int:
+        """ Row of the table describing slice `slice_number` """
+        found = np.flatnonzero(self.slices == slice_number)
+        if len(found) == 0:
+            raise KeyError(f"Slice {slice_number} is not present in the table")
+        return int(found[0])
+
+    @staticmethod
+    def _read(filename: str | Path) -> Tuple[fits.FITS_rec, fits.Header, np.ndarray, Tuple[int, int]]:
+        with fits.open(filename) as hdus:
+            table, header = hdus[1].data, hdus[1].header
+
+            degree = header['DEGREE']
+            coefficients = np.asarray(table['COEFFS'], dtype=np.float64).reshape(-1, degree + 1, degree + 1)
+            return table.copy(), header.copy(), coefficients, (header['DETNY'], header['DETNX'])
+
+    def _columns(self) -> [fits.Column]:
+        degree = self.coefficients.shape[1] - 1
+        return [
+            fits.Column(name='SLICE', format='J', array=self.slices),
+            fits.Column(name='COEFFS', format=f'{(degree + 1) ** 2}D',
+                        array=self.coefficients.reshape(len(self.slices), -1)),
+        ]
+
+    def _header(self) -> fits.Header:
+        header = fits.Header()
+        header['DEGREE'] = (self.coefficients.shape[1] - 1, "Degree of the polynomials in x and y")
+        header['DETNY'] = (self.detector_shape[0], "Detector rows")
+        header['DETNX'] = (self.detector_shape[1], "Detector columns")
+        return header
+
+
+def fit_polynomials(xn: np.ndarray,
+                    yn: np.ndarray,
+                    values: np.ndarray,
+                    slices: np.ndarray,
+                    n_slices: int,
+                    degrees: Tuple[int, int]) -> np.ndarray:
+    """
+    Least-squares fit of a 2D polynomial of `degrees` (in x, y) to the values of every slice.
+    The normal equations of all slices are accumulated and solved together.
+    Returns the coefficients in the layout of `SlicePolynomials`, shape (n_slices, d + 1, d + 1).
+    """
+    dx, dy = degrees
+    design = polynomial.polyvander2d(xn, yn, [dx, dy])
+    terms = design.shape[1]
+
+    order = np.argsort(slices, kind='stable')
+    counts = np.bincount(slices, minlength=n_slices)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    present = counts > 0
+
+    normal = np.zeros((n_slices, terms, terms))
+    rhs = np.zeros((n_slices, terms))
+    sorted_design = design[order]
+    normal[present] = np.add.reduceat(sorted_design[:, :, np.newaxis] * sorted_design[:, np.newaxis, :],
+                                      starts[present], axis=0)
+    rhs[present] = np.add.reduceat(sorted_design * values[order, np.newaxis], starts[present], axis=0)
+
+    # The pseudo-inverse copes with terms that a slice does not constrain (e.g. a tilt within a single row)
+    solution = np.einsum('sij,sj->si', np.linalg.pinv(normal), rhs)
+
+    degree = max(dx, dy)
+    coefficients = np.zeros((n_slices, degree + 1, degree + 1))
+    coefficients[:, :dx + 1, :dy + 1] = solution.reshape(n_slices, dx + 1, dy + 1)
+    return coefficients
+
+
+def evaluate_polynomials(xn: np.ndarray, yn: np.ndarray, slices: np.ndarray, coefficients: np.ndarray) -> np.ndarray:
+    """ Evaluate the polynomial of the respective slice at every point, all slices at once """
+    degree = coefficients.shape[1] - 1
+    design = polynomial.polyvander2d(xn, yn, [degree, degree])
+    return np.einsum('mk,mk->m', design, coefficients.reshape(len(coefficients), -1)[slices])
+
+
+@dataclass
+class DistortionTable(SlicePolynomials):
+    """ The IFU_DISTORTION_TABLE: position along the slice, in spaxels, per slice """
+    rows: np.ndarray                            # (n_slices, 2): first and last detector row of every slice
+    spaxels: int                                # Number of spaxels along a slice
+    spaxel_scale: float = 0.0082                # [arcsec] Size of a spaxel along the slice
+    slice_scale: float = 0.0207                 # [arcsec] Width of a slice
+
+    @classmethod
+    def load(cls, filename: str | Path) -> 'DistortionTable':
+        table, header, coefficients, shape = cls._read(filename)
+        return cls(np.asarray(table['SLICE']), coefficients, shape,
+                   rows=np.stack([table['YMIN'], table['YMAX']], axis=1).astype(np.int64),
+                   spaxels=header['NSPAX'],
+                   spaxel_scale=header.get('SPAXSCAL', cls.spaxel_scale),
+                   slice_scale=header.get('SLICESCL', cls.slice_scale))
+
+    def to_hdu(self) -> fits.BinTableHDU:
+        hdu = fits.BinTableHDU.from_columns(self._columns() + [
+            fits.Column(name='YMIN', format='J', array=self.rows[:, 0]),
+            fits.Column(name='YMAX', format='J', array=self.rows[:, 1]),
+        ], header=self._header())
+        hdu.header['NSPAX'] = (self.spaxels, "Spaxels along a slice")
+        hdu.header['SPAXSCAL'] = (self.spaxel_scale, "[arcsec] Spaxel size along the slice")
+        hdu.header['SLICESCL'] = (self.slice_scale, "[arcsec] Slice width")
+        return hdu
+
+
+@dataclass
+class WavelengthSolution(SlicePolynomials):
+    """ The IFU_WAVECAL: wavelength in micrometres per slice, and the wavelength grid for the cubes """
+    start: float                                # Wavelength of the first plane of the cube
+    step: float                                 # Wavelength step between planes
+    count: int                                  # Number of planes
+
+    @classmethod
+    def load(cls, filename: str | Path) -> 'WavelengthSolution':
+        table, header, coefficients, shape = cls._read(filename)
+        return cls(np.asarray(table['SLICE']), coefficients, shape,
+                   start=header['WSTART'], step=header['WSTEP'], count=header['NWAVE'])
+
+    def to_hdu(self) -> fits.BinTableHDU:
+        hdu = fits.BinTableHDU.from_columns(self._columns(), header=self._header())
+        hdu.header['WSTART'] = (self.start, "[um] Wavelength of the first cube plane")
+        hdu.header['WSTEP'] = (self.step, "[um] Wavelength step of the cube")
+        hdu.header['NWAVE'] = (self.count, "Number of cube planes")
+        return hdu
+
+    @property
+    def wavelengths(self) -> np.ndarray:
+        return self.start + self.step * np.arange(self.count)
+
+
+class RectificationOperator:
+    """
+    Sparse linear operator mapping a detector image to a data cube of shape (wavelength, slice, spaxel).
+
+    Every detector pixel is split bilinearly between the four voxels whose centres surround its position
+    in (spaxel, wavelength), and every voxel is the weighted mean of the pixels contributing to it,
+    so that the rows of the matrix sum to one. Voxels no pixel contributes to are flagged as NO_DATA.
+    """
+    version: int = 2                            # Increase whenever the construction changes, invalidates caches
+
+    def __init__(self,
+                 matrix: sparse.csr_matrix,
+                 cube_shape: Tuple[int, int, int],
+                 wavelengths: np.ndarray,
+                 scales: Tuple[float, float] = (DistortionTable.spaxel_scale, DistortionTable.slice_scale)):
+        self.matrix = matrix.tocsr()
+        self.cube_shape = tuple(cube_shape)
+        self.wavelengths = wavelengths
+        self.scales = tuple(scales)                 # [arcsec] Spaxel size along the slice and slice width
+        self._squared = None
+
+    @classmethod
+    def build(cls, distortion: DistortionTable, wavecal: WavelengthSolution) -> 'RectificationOperator':
+        if tuple(distortion.detector_shape) != tuple(wavecal.detector_shape):
+            raise ValueError(f"Distortion table and wavelength calibration are defined for different detectors: "
+                             f"{distortion.detector_shape} and {wavecal.detector_shape}")
+
+        ny, nx = distortion.detector_shape
+        n_slices, n_spatial, n_wave = len(distortion.slices), distortion.spaxels, wavecal.count
+        voxels, pixels, weights = [], [], []
+
+        for index, slice_number in enumerate(distortion.slices):
+            ymin, ymax = distortion.rows[index]
+            y, x = np.mgrid[ymin:ymax + 1, 0:nx]
+
+            # Fractional voxel coordinates, measured from the centre of the first voxel
+            u = distortion.evaluate(index, x, y).ravel() - 0.5
+            w = ((wavecal.evaluate(wavecal.index(slice_number), x, y) - wavecal.start) / wavecal.step).ravel()
+            pixel = (y * nx + x).ravel()
+
+            u0, w0 = np.floor(u), np.floor(w)
+            fu, fw = u - u0, w - w0
+
+            for du, dw in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+                iu, iw = (u0 + du).astype(np.int64), (w0 + dw).astype(np.int64)
+                weight = (fu if du else 1 - fu) * (fw if dw else 1 - fw)
+                valid = (iu >= 0) & (iu < n_spatial) & (iw >= 0) & (iw < n_wave) & (weight > 0)
+
+                voxels.append((iw[valid] * n_slices + index) * n_spatial + iu[valid])
+                pixels.append(pixel[valid])
+                weights.append(weight[valid])
+
+        matrix = sparse.csr_matrix((np.concatenate(weights), (np.concatenate(voxels), np.concatenate(pixels))),
+                                   shape=(n_wave * n_slices * n_spatial, ny * nx))
+
+        # Normalize the rows: every voxel is the weighted mean of its pixels
+        total = np.asarray(matrix.sum(axis=1)).ravel()
+        matrix = sparse.diags(np.divide(1, total, out=np.zeros_like(total), where=total > 0)) @ matrix
+
+        return cls(matrix, (n_wave, n_slices, n_spatial), wavecal.wavelengths,
+                   (distortion.spaxel_scale, distortion.slice_scale))
+
+    @property
+    def coverage(self) -> np.ndarray:
+        """ Cube of booleans, True where at least one pixel contributes """
+        return (np.diff(self.matrix.indptr) > 0).reshape(self.cube_shape)
+
+    def rectify(self, image: np.ndarray) -> np.ndarray:
+        """ Reconstruct the cube from a detector image (data only) """
+        if image.size != self.matrix.shape[1]:
+            raise ValueError(f"Image of shape {image.shape} does not match the operator "
+                             f"built for {self.matrix.shape[1]} pixels")
+
+        cube = self.matrix @ np.asarray(image, dtype=np.float64).ravel()
+        cube[np.diff(self.matrix.indptr) == 0] = np.nan
+        return cube.reshape(self.cube_shape)
+
+    def apply(self, planes: Planes) -> Planes:
+        """ Reconstruct the cube planes from detector planes, propagating the errors and quality flags """
+        if self._squared is None:
+            self._squared = self.matrix.power(2)
+
+        data = self.rectify(planes.data)
+        error = np.sqrt(self._squared @ planes.error.ravel() ** 2).reshape(self.cube_shape)
+
+        # A voxel gets every flag that is set in any of the pixels contributing to it
+        quality = np.where(self.coverage, QualityFlag.GOOD, QualityFlag.NO_DATA).astype(np.int32)
+        for flag in QualityFlag:
+            if flag and (flagged := (planes.quality.ravel() & flag) != 0).any():
+                quality[(self.matrix @ flagged.astype(np.float64)).reshape(self.cube_shape) > 0] |= flag
+
+        return Planes(data, error, quality)
+
+    def wcs(self, ra: float = 0.0, dec: float = 0.0) -> Dict[str, Any]:
+        """
+        WCS keywords of the reconstructed cubes, centred on the pointing (`ra`, `dec`) in degrees.
+        The spaxels run along the first axis, the slices along the second one.
+        """
+        n_wave, n_slices, n_spatial = self.cube_shape
+        return {
+            'CTYPE1': 'RA---TAN',
+            'CUNIT1': 'deg',
+            'CRPIX1': (n_spatial + 1) / 2,
+            'CRVAL1': float(ra),
+            'CDELT1': -self.scales[0] / 3600,
+            'CTYPE2': 'DEC--TAN',
+            'CUNIT2': 'deg',
+            'CRPIX2': (n_slices + 1) / 2,
+            'CRVAL2': float(dec),
+            'CDELT2': self.scales[1] / 3600,
+            'CTYPE3': 'WAVE',
+            'CUNIT3': 'um',
+            'CRPIX3': 1.0,
+            'CRVAL3': float(self.wavelengths[0]),
+            'CDELT3': float(self.wavelengths[1] - self.wavelengths[0]) if len(self.wavelengths) > 1 else 1.0,
+        }
+
+    def save(self, filename: str | Path) -> None:
+        """ Save the operator; written to a temporary file first, so that concurrent readers never see half of it """
+        filename = Path(filename)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        temporary = filename.with_suffix(f'.{os.getpid()}.tmp')
+
+        with open(temporary, 'wb') as f:
+            np.savez(f, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                     shape=self.matrix.shape, cube_shape=self.cube_shape, wavelengths=self.wavelengths,
+                     scales=self.scales)
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename: str | Path) -> 'RectificationOperator':
+        with np.load(filename) as npz:
+            matrix = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+            return cls(matrix, tuple(npz['cube_shape']), npz['wavelengths'], tuple(npz['scales']))
+
+    @classmethod
+    def cached(cls,
+               distortion_file: str | Path,
+               wavecal_file: str | Path,
+               cache_dir: str | Path = None) -> Tuple['RectificationOperator', bool]:
+        """
+        Load the operator for the given calibration tables from the cache, or build and cache it.
+        Without a `cache_dir` (or `$PYMETIS_CACHE_DIR`) the operator is just built.
+        Returns the operator and whether it was found in the cache.
+        """
+        if (directory := cache_dir or default_cache_dir()) is None:
+            filename = None
+        else:
+            key = hashlib.sha256(f"{cls.version}:{file_digest(distortion_file)}:{file_digest(wavecal_file)}".encode())
+            filename = Path(directory) / f"rectification-{key.hexdigest()}.npz"
+            if filename.exists():
+                return cls.load(filename), True
+
+        operator = cls.build(DistortionTable.load(distortion_file), WavelengthSolution.load(wavecal_file))
+        if filename is not None:
+            operator.save(filename)
+        return operator, False
@@ -0,0 +1,84 @@
+from dataclasses import dataclass
+from typing import Tuple
+
+import numpy as np
+
+"""
+Reference pixel correction of HAWAII-2RG frames.
+
+The outermost rows and columns of a HAWAII-2RG array (four on every side) are reference pixels: they are
+not sensitive to light, but share the electronics of the active pixels. The array is read out in channels,
+vertical stripes of equal width, and every channel drifts by its own offset, in general different for
+the even and odd columns. The offsets are measured by the reference rows at the top and the bottom of every
+channel. What remains is noise common to all channels that varies from row to row; it is measured by the
+reference columns on both sides, averaged over a few rows to reduce their own noise.
+
+Both corrections are computed from the reference pixels alone, with reductions over reshaped views of the
+channel blocks, and applied in two passes over the frame.
+"""
+
+# Width of the reference pixel border
+REFERENCE_BORDER = 4
+# Readout channels of a HAWAII-2RG array
+CHANNELS = 32
+
+
+def running_mean(values: np.ndarray, length: int) -> np.ndarray:
+    """ Mean of `values` over windows of `length` elements centred on every element, shorter at the ends """
+    half = length // 2
+    cumulative = np.concatenate([[0.0], np.cumsum(values, dtype=np.float64)])
+    index = np.arange(len(values))
+    lo, hi = np.maximum(index - half, 0), np.minimum(index + half + 1, len(values))
+    return (cumulative[hi] - cumulative[lo]) / (hi - lo)
+
+
+@dataclass(frozen=True)
+class ReferencePixelCorrector:
+    border: int = REFERENCE_BORDER
+    channels: int = CHANNELS
+    smoothing: int = 11         # Rows averaged for the common-mode noise
+    odd_even: bool = True       # Separate offsets for the even and odd columns of every channel
+
+    @property
+    def parities(self) -> int:
+        return 2 if self.odd_even else 1
+
+    def applies(self, shape: Tuple[int, ...]) -> bool:
+        """ Whether a chip of this shape can be corrected: it has to be split evenly into channels """
+        if len(shape) != 2:
+            return False
+        ny, nx = shape
+        return ny > 2 * self.border and nx > 2 * self.border and nx % (self.channels * self.parities) == 0
+
+    def channel_offsets(self, frame: np.ndarray) -> np.ndarray:
+        """ The offset of every channel and column parity, from the top and bottom reference rows """
+        b = self.border
+        rows = np.concatenate([frame[:b], frame[-b:]])
+        return rows.reshape(2 * b, self.channels, -1, self.parities).mean(axis=(0, 2))
+
+    def column_offsets(self, offsets: np.ndarray, width: int) -> np.ndarray:
+        """ The offsets of the channels expanded to every column of a frame `width` columns wide """
+        per_channel = width // (self.channels * self.parities)
+        return np.broadcast_to(offsets[:, np.newaxis, :], (self.channels, per_channel, self.parities)).reshape(width)
+
+    def row_noise(self, frame: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """ The common-mode noise of every row, from the side reference columns with their offsets removed """
+        b = self.border
+        side = np.concatenate([frame[:, :b] - columns[:b], frame[:, -b:] - columns[-b:]], axis=1)
+        return running_mean(side.mean(axis=1), self.smoothing)
+
+    def correct(self, frame: np.ndarray, *, out: np.ndarray = None) -> np.ndarray:
+        """
+        The frame with the channel offsets and the common-mode row noise subtracted,
+        in `out` if given (which may be the frame itself), otherwise in a new array.
+        """
+        if not self.applies(np.shape(frame)):
+            raise ValueError(f"A frame of shape {np.shape(frame)} cannot be split into {self.channels} channels "
+                             f"with a reference border of {self.border} pixels")
+
+        columns = self.column_offsets(self.channel_offsets(frame), frame.shape[1])
+        rows = self.row_noise(frame, columns)
+
+        out = np.subtract(frame, columns, out=out, dtype=np.float64)
+        out -= rows[:, np.newaxis]
+        return out
@@ -0,0 +1,217 @@
+from dataclasses import dataclass
+from enum import IntFlag
+from typing import Iterable, Literal
+
+import numpy as np
+from astropy.io import fits
+
+from pymetis.algorithms.accumulator import WelfordAccumulator
+from pymetis.algorithms.backend import ArrayBackend, NumpyBackend
+
+
+# Stacking methods that need the whole stack, rather than running statistics
+STACKED_METHODS = ("median", "sigclip")
+
+
+class QualityFlag(IntFlag):
+    """ Bits of the DQ plane. Flags are combined with bitwise OR whenever planes are combined. """
+    GOOD = 0
+    BAD_PIXEL = 1           # Flagged in a bad pixel map
+    NON_FINITE = 2          # NaN or infinite value in at least one input
+    NO_ERROR = 4            # Too few frames to estimate the error
+    ZERO_DIVISION = 8       # Division by zero during calibration
+    NO_DATA = 16            # No detector pixel contributes to the voxel of a reconstructed cube
+    LOW_TRANSMISSION = 32   # Atmospheric transmission too low for a reliable telluric correction
+
+
+@dataclass
+class Planes:
+    """
+    An image with its error (1-sigma) and data quality planes.
+    Arithmetic propagates the errors in quadrature (assuming independent errors) and ORs the DQ flags.
+    """
+    data: np.ndarray
+    error: np.ndarray
+    quality: np.ndarray
+
+    extname_error = "ERR"
+    extname_quality = "DQ"
+
+    @classmethod
+    def from_data(cls, data: np.ndarray) -> 'Planes':
+        """ Planes for data without an error estimate, e.g. a calibration product without ERR/DQ """
+        data = np.asarray(data, dtype=np.float64)
+        quality = np.where(np.isfinite(data), QualityFlag.GOOD, QualityFlag.NON_FINITE).astype(np.int32)
+        return cls(data, np.zeros_like(data), quality)
+
+    @classmethod
+    def from_accumulator(cls,
+                         accumulator: WelfordAccumulator,
+                         method: Literal['add'] | Literal['average'] | Literal['median'] | Literal['sigclip'],
+                         *,
+                         quality: np.ndarray = None,
+                         stacked: np.ndarray = None) -> 'Planes':
+        """
+        Build the combined planes from running statistics. The error is the standard error
+        of the combined value as estimated from the scatter of the frames.
+        For `median` and `sigclip` the combined data have to be provided as `stacked`,
+        as they cannot be computed from running statistics.
+        """
+        variance = accumulator.variance
+        count = accumulator.count
+
+        match method:
+            case "add":
+                data = accumulator.sum
+                error = np.sqrt(variance * count)
+            case "average":
+                data = accumulator.mean.copy()
+                error = np.sqrt(variance / count)
+            case "median":
+                if stacked is None:
+                    raise ValueError("The median has to be computed from the full stack")
+                data = stacked
+                # Asymptotic efficiency of the median for normally distributed data
+                error = np.sqrt(variance * (np.pi / 2) / count)
+            case "sigclip":
+                if stacked is None:
+                    raise ValueError("The clipped mean has to be computed from the full stack")
+                data = stacked
+                error = np.sqrt(variance / count)
+            case _:
+                raise ValueError(f"Unknown stacking method {method!r}")
+
+        if quality is None:
+            quality = np.zeros(data.shape, dtype=np.int32)
+
+        quality |= np.where(np.isfinite(data), QualityFlag.GOOD, QualityFlag.NON_FINITE).astype(np.int32)
+        if count < 2:
+            quality |= QualityFlag.NO_ERROR
+
+        return cls(data, error, quality)
+
+    def copy(self) -> 'Planes':
+        return Planes(self.data.copy(), self.error.copy(), self.quality.copy())
+
+    def shared(self) -> 'Planes':
+        """ Read-only views of the planes, to be shared without copying (see `writable`) """
+        planes = Planes(self.data.view(), self.error.view(), self.quality.view())
+        for plane in (planes.data, planes.error, planes.quality):
+            plane.flags.writeable = False
+        return planes
+
+    def writable(self) -> 'Planes':
+        """ Copy on write: replace the read-only (shared) planes with copies before modifying them in place """
+        for name in ('data', 'error', 'quality'):
+            if not (plane := getattr(self, name)).flags.writeable:
+                setattr(self, name, plane.copy())
+        return self
+
+    def subtract(self, other: 'Planes', *, scale: float = 1.0) -> 'Planes':
+        """ In place `self - scale * other` """
+        self.writable()
+        self.data -= scale * other.data
+        self.error = np.hypot(self.error, scale * other.error)
+        self.quality |= other.quality
+        return self
+
+    def divide(self, other: 'Planes') -> 'Planes':
+        """ In place `self / other`, pixels with zero divisor are set to zero and flagged """
+        self.writable()
+        zero = other.data == 0
+        divisor = np.where(zero, 1.0, other.data)
+
+        self.error = np.hypot(self.error / divisor, self.data * other.error / divisor ** 2)
+        self.data /= divisor
+        self.data[zero] = 0
+        self.quality |= other.quality
+        self.quality[zero] |= QualityFlag.ZERO_DIVISION
+        return self
+
+    @classmethod
+    def load(cls, filename: str) -> 'Planes':
+        """
+        Load a product saved with error and quality planes: the data are in the primary HDU,
+        the error and quality in the ERR and DQ extensions. Products without them get zero errors.
+        """
+        with fits.open(filename, memmap=True) as hdus:
+            planes = cls.from_data(hdus[0].data)
+
+            if cls.extname_error in hdus:
+                planes.error = np.array(hdus[cls.extname_error].data, dtype=np.float64)
+            if cls.extname_quality in hdus:
+                planes.quality |= np.asarray(hdus[cls.extname_quality].data, dtype=np.int32)
+
+        return planes
+
+
+def collapse(stack: np.ndarray,
+             method: Literal['median'] | Literal['sigclip'],
+             backend: ArrayBackend,
+             rows: int = None) -> np.ndarray:
+    """
+    Collapse a stack along the frames with the `backend`, `rows` rows at a time if requested:
+    this bounds the temporaries of the backend to those of a band of rows.
+    """
+    reduce = backend.median if method == "median" else backend.clip
+    if rows is None or rows >= stack.shape[1]:
+        return reduce(stack)
+
+    result = np.empty(stack.shape[1:], dtype=np.float64)
+    for start in range(0, stack.shape[1], rows):
+        result[start:start + rows] = reduce(stack[:, start:start + rows])
+    return result
+
+
+def combine_planes(frames: Iterable[np.ndarray],
+                   method: Literal['add'] | Literal['average'] | Literal['median'] | Literal['sigclip'],
+                   *,
+                   accumulator: WelfordAccumulator = None,
+                   backend: ArrayBackend = None,
+                   rows: int = None,
+                   stack: np.ndarray = None,
+                   pool=None) -> Planes:
+    """
+    Combine a stream of frames into DATA/ERR/DQ planes in a single pass.
+    The frames are consumed one at a time; only `median` and `sigclip` have to keep the whole stack,
+    which is then collapsed by the compute `backend` (NumPy by default), `rows` rows at a time if requested.
+    The stack is kept in `stack` if provided (with room for all frames, e.g. a memory-mapped file).
+    If a `pool` of worker processes (`parallel.TilePool`) is given, the stack is collapsed there in bands of rows.
+    If an `accumulator` is provided, the frames are folded into it (e.g. to continue a previous combination),
+    and it is left updated for the caller.
+    """
+    if accumulator is None:
+        accumulator = WelfordAccumulator()
+    if backend is None:
+        backend = NumpyBackend()
+    if method in STACKED_METHODS and accumulator.count > 0:
+        raise ValueError(f"Stacking method {method!r} cannot be computed from previously accumulated statistics")
+
+    frames_kept = ([] if stack is None else stack) if method in STACKED_METHODS else None
+    quality = None
+
+    for index, frame in enumerate(frames):
+        frame = np.asarray(frame, dtype=np.float64)
+        accumulator.add(frame)
+
+        flags = np.where(np.isfinite(frame), QualityFlag.GOOD, QualityFlag.NON_FINITE).astype(np.int32)
+        quality = flags if quality is None else quality | flags
+
+        if isinstance(frames_kept, list):
+            frames_kept.append(frame)
+        elif frames_kept is not None:
+            frames_kept[index] = frame
+
+    if accumulator.count == 0:
+        raise ValueError("No frames to combine")
+
+    stacked = None
+    if method in STACKED_METHODS:
+        if isinstance(frames_kept, list):
+            # The pool moves the frames to shared memory one by one, rather than stacking them here first
+            kept = frames_kept if pool is not None else np.asarray(frames_kept)
+        else:
+            kept = frames_kept[:accumulator.count]
+        stacked = collapse(kept, method, backend, rows) if pool is None else pool.collapse(kept, method, backend, rows)
+
+    return Planes.from_accumulator(accumulator, method, quality=quality, stacked=stacked)
@@ -0,0 +1,116 @@
+from typing import Tuple
+
+import numpy as np
+from numpy.polynomial import polynomial
+
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+"""
+Telluric correction of IFU cubes.
+
+The transmission of the atmosphere is derived from the spectrum of a standard star, extracted from its combined cube
+and divided by its fitted continuum. It is applied to a science cube as a single broadcast division of all spaxels.
+All operations work on whole cubes at once; there is no loop over spaxels.
+"""
+
+# Physical constants in SI units, for the blackbody model of the standard star
+PLANCK = 6.62607015e-34
+SPEED_OF_LIGHT = 2.99792458e8
+BOLTZMANN = 1.380649e-23
+
+
+def extract_spectrum(cube: Planes, *, threshold: float = 0.1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sum the spectra of all spaxels brighter than `threshold` times the peak of the collapsed cube.
+    Returns the spectrum, its error and the aperture mask.
+    """
+    usable = ((cube.quality & ~QualityFlag.NO_ERROR) == 0) & np.isfinite(cube.data)
+    data = np.where(usable, cube.data, 0)
+
+    image = np.median(data, axis=0)
+    aperture = image >= threshold * image.max()
+
+    spectrum = data[:, aperture].sum(axis=1)
+    error = np.sqrt((np.where(usable, cube.error, 0)[:, aperture] ** 2).sum(axis=1))
+    return spectrum, error, aperture
+
+
+def fit_continuum(wavelengths: np.ndarray,
+                  spectrum: np.ndarray,
+                  *,
+                  degree: int = 3,
+                  iterations: int = 5,
+                  rejection: float = 2.0) -> np.ndarray:
+    """
+    Fit the continuum of a spectrum with absorption lines: a polynomial fit, iterated rejecting points that lie
+    more than `rejection` standard deviations below the fit (absorption), but keeping those above it.
+    """
+    x = (wavelengths - wavelengths.mean()) / np.ptp(wavelengths) if len(wavelengths) > 1 else wavelengths * 0
+    use = np.isfinite(spectrum)
+
+    for _ in range(iterations):
+        coefficients = polynomial.polyfit(x[use], spectrum[use], degree)
+        fit = polynomial.polyval(x, coefficients)
+        residuals = spectrum - fit
+        sigma = np.std(residuals[use])
+
+        keep = np.isfinite(spectrum) & (residuals > -rejection * sigma)
+        if (keep == use).all():
+            break
+        use = keep
+
+    return polynomial.polyval(x, coefficients)
+
+
+def transmission(wavelengths: np.ndarray,
+                 spectrum: np.ndarray,
+                 error: np.ndarray,
+                 **kwargs) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Atmospheric transmission (with its error) as the ratio of the spectrum to its continuum """
+    continuum = fit_continuum(wavelengths, spectrum, **kwargs)
+    safe = np.where(continuum > 0, continuum, np.nan)
+    return spectrum / safe, error / safe, continuum
+
+
+def blackbody(wavelengths: np.ndarray, temperature: float) -> np.ndarray:
+    """ Spectral radiance per unit frequency (up to a constant) at wavelengths in micrometres """
+    frequency = SPEED_OF_LIGHT / (wavelengths * 1e-6)
+    return frequency ** 3 / np.expm1(PLANCK * frequency / (BOLTZMANN * temperature))
+
+
+def resample(wavelengths: np.ndarray, source_wavelengths: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Values on `source_wavelengths` resampled to `wavelengths`. If both grids are the same (which is the usual case),
+    the values are returned as they are; otherwise they are linearly interpolated, which is accurate for grids
+    differing only slightly. Values outside the source grid are NaN.
+    """
+    if wavelengths.shape == source_wavelengths.shape and np.allclose(wavelengths, source_wavelengths,
+                                                                     rtol=0, atol=1e-6 * np.ptp(wavelengths)):
+        return values
+    return np.interp(wavelengths, source_wavelengths, values, left=np.nan, right=np.nan)
+
+
+def correct(cube: Planes,
+            wavelengths: np.ndarray,
+            telluric_wavelengths: np.ndarray,
+            telluric: np.ndarray,
+            telluric_error: np.ndarray = None,
+            *,
+            minimum: float = 0.1) -> Planes:
+    """
+    Divide the cube (in place) by the transmission, broadcast along the spatial axes.
+    Planes where the transmission is below `minimum` (or unknown) are flagged as LOW_TRANSMISSION.
+    """
+    t = resample(wavelengths, telluric_wavelengths, telluric)
+    t_error = np.zeros_like(t) if telluric_error is None else resample(wavelengths, telluric_wavelengths,
+                                                                        telluric_error)
+
+    low = ~(t >= minimum)
+    t = np.where(low, 1.0, t)[:, np.newaxis, np.newaxis]
+    t_error = np.where(low, 0.0, t_error)[:, np.newaxis, np.newaxis]
+
+    cube.writable()
+    cube.error = np.hypot(cube.error / t, cube.data * t_error / t ** 2)
+    cube.data /= t
+    cube.quality[low] |= QualityFlag.LOW_TRANSMISSION
+    return cube
@@ -0,0 +1,168 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Tuple
+
+import numpy as np
+from astropy import units
+from astropy.io import fits
+
+from pymetis.algorithms.rectification import (DistortionTable, WavelengthSolution, fit_polynomials,
+                                              evaluate_polynomials)
+
+"""
+Wavelength calibration of the IFU from arc lamp exposures.
+
+Every detector row covered by a slice (as given by the distortion table) is an arc spectrum along the columns.
+Lines are detected in all rows at once, identified in the line catalogue through a binary search
+in its sorted wavelengths, and the dispersion relation of all slices is fitted in a single batched
+least-squares solution. Identification and fitting are iterated with a shrinking tolerance window,
+starting from a linear first guess of the dispersion common to all slices.
+"""
+
+
+def read_catalogue(filename: str | Path) -> np.ndarray:
+    """ Sorted wavelengths of the lines in a LINE_INTMON_TABLE, converted to micrometres """
+    with fits.open(filename) as hdus:
+        column = hdus[1].columns['WAVE']
+        unit = units.Unit((column.unit or "um").strip().lower())
+        return np.sort(np.asarray(hdus[1].data['WAVE'], dtype=np.float64) * unit.to(units.um))
+
+
+def find_peaks(spectra: np.ndarray, *, threshold: float = 5.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Emission lines in every row of `spectra` at once: local maxima more than `threshold` robust standard deviations
+    above the median of their row, with their positions refined by a parabola through the three pixels around them.
+    Returns the row indices, the fractional column positions and the heights above the background.
+    """
+    background = np.nanmedian(spectra, axis=1, keepdims=True)
+    sigma = 1.4826 * np.nanmedian(np.abs(spectra - background), axis=1, keepdims=True)
+    values = np.where(np.isfinite(spectra), spectra - background, 0)
+
+    left, centre, right = values[:, :-2], values[:, 1:-1], values[:, 2:]
+    rows, columns = np.nonzero((centre > left) & (centre >= right) & (centre > threshold * sigma))
+
+    l, c, r = left[rows, columns], centre[rows, columns], right[rows, columns]
+    curvature = l - 2 * c + r
+    offset = np.clip(0.5 * (l - r) / np.where(curvature < 0, curvature, -1), -0.5, 0.5)
+    return rows, columns + 1 + offset, c
+
+
+def match_lines(predicted: np.ndarray,
+                catalogue: np.ndarray,
+                tolerance: float,
+                groups: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Identify detected lines with predicted wavelengths in the sorted `catalogue`.
+
+    A detection is matched to the nearest catalogue line if it lies within `tolerance` of it and no other line
+    does (ambiguous detections are dropped). Within a group of detections (a detector row),
+    every catalogue line is assigned to the closest detection only.
+    Returns the indices of the matched detections and of their catalogue lines.
+    """
+    if len(catalogue) < 2:
+        raise ValueError(f"At least two catalogue lines are needed, got {len(catalogue)}")
+
+    above = np.searchsorted(catalogue, predicted).clip(1, len(catalogue) - 1)
+    below = above - 1
+    nearer_below = predicted - catalogue[below] < catalogue[above] - predicted
+    nearest = np.where(nearer_below, below, above)
+    other = np.where(nearer_below, above, below)
+
+    distance = np.abs(predicted - catalogue[nearest])
+    candidates = np.flatnonzero((distance <= tolerance) & (np.abs(predicted - catalogue[other]) > tolerance))
+
+    order = candidates[np.argsort(distance[candidates], kind='stable')]
+    _, first = np.unique(groups[order] * len(catalogue) + nearest[order], return_index=True)
+    chosen = np.sort(order[first])
+    return chosen, nearest[chosen]
+
+
+@dataclass
+class ArcCalibration:
+    """ The fitted wavelength solution and the statistics of the identified lines """
+    solution: WavelengthSolution
+    lines: int                                  # Number of identified detections used in the final fit
+    rms: float                                  # [um] Robust RMS of the fit residuals
+
+
+def calibrate(image: np.ndarray,
+              distortion: DistortionTable,
+              catalogue: np.ndarray,
+              *,
+              central: float,
+              dispersion: float,
+              degree: int = 3,
+              tilt: int = 1,
+              threshold: float = 5.0,
+              tolerance: float = 3.0,
+              iterations: int = 4,
+              rejection: float = 3.0) -> ArcCalibration:
+    """
+    Derive the wavelength solution of every slice from a (dark-subtracted) arc image.
+
+    The first guess is `central + dispersion * (x - xc)`, with `xc` the central column, for all slices.
+    The initial tolerance window is `tolerance` pixels; it shrinks to `rejection` times the RMS of the residuals
+    in the following iterations. The solution is a polynomial of `degree` along the dispersion
+    and of `tilt` along the columns (the tilt of the lines).
+    """
+    ny, nx = distortion.detector_shape
+    if image.shape != (ny, nx):
+        raise ValueError(f"Arc image of shape {image.shape} does not match the distortion table {(ny, nx)}")
+
+    # The catalogue has to cover the range of the first guess, or no line can ever be identified
+    first, last = sorted(central + dispersion * np.array([-1, 1]) * (nx - 1) / 2)
+    overlap = np.count_nonzero((catalogue >= first) & (catalogue <= last))
+    if overlap <= degree:
+        raise ValueError(f"The line catalogue ({catalogue.min():.4g} to {catalogue.max():.4g} um) has {overlap} lines "
+                         f"in the range of the first guess ({first:.4g} to {last:.4g} um): "
+                         f"check the catalogue and the first guess of the central wavelength and dispersion")
+
+    n_slices = len(distortion.slices)
+    slice_of_row = np.full(ny, -1)
+    for index, (ymin, ymax) in enumerate(distortion.rows):
+        slice_of_row[ymin:ymax + 1] = index
+    covered = np.flatnonzero(slice_of_row >= 0)
+
+    rows, x, _ = find_peaks(image[covered], threshold=threshold)
+    y = covered[rows]
+    slices = slice_of_row[y]
+    xn, yn = distortion.normalize(x, y)
+
+    predicted = central + dispersion * (x - (nx - 1) / 2)
+    window = tolerance * abs(dispersion)
+    coefficients, rms, matched = None, np.inf, np.array([], dtype=np.int64)
+
+    for _ in range(iterations):
+        matched, lines = match_lines(predicted, catalogue, window, y)
+
+        # Every slice needs enough distinct lines to constrain the dispersion polynomial
+        distinct = np.bincount(np.unique(slices[matched] * len(catalogue) + lines) // len(catalogue),
+                               minlength=n_slices)
+        if (distinct <= degree).any():
+            poor = distortion.slices[distinct <= degree]
+            raise ValueError(f"Too few lines identified in slices {poor.tolist()} to fit a polynomial of "
+                             f"degree {degree}: check the first guess of the dispersion")
+
+        coefficients = fit_polynomials(xn[matched], yn[matched], catalogue[lines], slices[matched],
+                                       n_slices, (degree, tilt))
+        predicted = evaluate_polynomials(xn, yn, slices, coefficients)
+
+        residuals = catalogue[lines] - predicted[matched]
+        rms = 1.4826 * np.median(np.abs(residuals - np.median(residuals)))
+        window = max(rejection * rms, 0.1 * abs(dispersion))
+
+    # The output grid covers the wavelengths of all slices, sampled at the median dispersion
+    edges = np.repeat(covered, 2), np.tile([0, nx - 1], len(covered))
+    wavelengths = evaluate_polynomials(*distortion.normalize(edges[1], edges[0]), slice_of_row[edges[0]],
+                                       coefficients)
+    centres = (distortion.rows[:, 0] + distortion.rows[:, 1]) / 2
+    xc = np.repeat([(nx - 2) / 2, nx / 2], n_slices)
+    step = np.median(np.abs(np.diff(
+        evaluate_polynomials(*distortion.normalize(xc, np.tile(centres, 2)), np.tile(np.arange(n_slices), 2),
+                             coefficients).reshape(2, n_slices), axis=0)))
+    start = wavelengths.min()
+
+    solution = WavelengthSolution(distortion.slices, coefficients, distortion.detector_shape,
+                                  start=float(start), step=float(step),
+                                  count=int(np.ceil((wavelengths.max() - start) / step)) + 1)
+    return ArcCalibration(solution, len(matched), float(rms))
@@ -0,0 +1,76 @@
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from astropy.io import fits
+
+from pymetis.algorithms.stacking import Planes
+
+"""
+Decoding of input HDUs, once per physical HDU.
+
+A set of frames may list the same file several times, in different roles: e.g. a raw frame that also serves
+as the gain map and the linearity, or calibrations shared by several detectors or bands. Such files are decoded
+once, keyed by their resolved path and the extension, and the arrays are shared by all roles.
+Files listed only once are decoded on every request and not kept, so that streaming the raw frames
+still holds a single frame at a time.
+
+All arrays are read-only. A stage that needs to modify them works on a copy: planes are copied on write
+(see `Planes.writable`), other arrays have to be copied explicitly.
+"""
+
+
+def resolve(filename: str | Path) -> str:
+    return str(Path(filename).resolve())
+
+
+class FrameCache:
+    """ The decoded HDUs of the files of a set of frames """
+
+    def __init__(self, files: Iterable[str | Path] = ()):
+        counts = Counter(resolve(file) for file in files)
+        self.shared = {path for path, count in counts.items() if count > 1}
+        self.decoded = 0
+        self._arrays: Dict[Tuple[str, int, str], np.ndarray] = {}
+        self._extnames: Dict[str, List[str]] = {}
+
+    def data(self, filename: str | Path, extension: int | str = 0, dtype=np.float64) -> np.ndarray:
+        """ The (read-only) data of an HDU, given by its index or EXTNAME, converted to `dtype` """
+        path = resolve(filename)
+        if isinstance(extension, str):
+            if (name := extension.upper()) not in (extnames := self.extnames(path)):
+                raise KeyError(f"Extension {extension!r} not found in {filename}")
+            extension = extnames.index(name)
+
+        key = (path, extension, np.dtype(dtype).str)
+        if (array := self._arrays.get(key)) is not None:
+            return array
+
+        array = np.array(fits.getdata(path, extension), dtype=dtype)
+        array.flags.writeable = False
+        self.decoded += 1
+        if path in self.shared:
+            self._arrays[key] = array
+        return array
+
+    def extnames(self, filename: str | Path) -> List[str]:
+        """ The EXTNAMEs of all HDUs of a file (empty for those without one) """
+        path = resolve(filename)
+        if (names := self._extnames.get(path)) is None:
+            with fits.open(path, memmap=True) as hdus:
+                names = self._extnames[path] = [hdu.name.upper() for hdu in hdus]
+        return names
+
+    def planes(self, filename: str | Path) -> Planes:
+        """
+        The planes of a product, as `Planes.load` reads them, sharing the read-only data and error planes.
+        The DQ plane also flags the non-finite values and is always a new array.
+        """
+        extnames = self.extnames(filename)
+        planes = Planes.from_data(self.data(filename, 0))
+        if Planes.extname_error in extnames:
+            planes.error = self.data(filename, Planes.extname_error)
+        if Planes.extname_quality in extnames:
+            planes.quality |= self.data(filename, Planes.extname_quality, np.int32)
+        return planes
@@ -1,10 +1,19 @@
+import contextlib
 from abc import ABC, abstractmethod
-from typing import Dict, Any
+from typing import Dict, Any, Iterator
 
 import cpl
+from astropy.io import fits
+import numpy as np
+from astropy.table import Table
 from cpl.core import Msg
 
-from pymetis.base.product import PipelineProduct
+from pymetis.algorithms.coadd import CubeGrid
+from pymetis.algorithms.images import as_header
+from pymetis.algorithms.stacking import Planes
+from pymetis.base.framecache import FrameCache
+from pymetis.base.product import PipelineProduct, TableProduct
+from pymetis.base.profiling import ProfilingOptions, profiled
 from pymetis.inputs import PipelineInputSet
 
 
@@ -32,27 +41,54 @@ class MetisRecipeImpl(ABC):
         self.product_frames = cpl.ui.FrameSet()
         self.products = {}
 
+        # Products of upstream recipes run in the same process, keyed by the file names of their frames.
+        # Input frames found here are taken from memory instead of being loaded from their (possibly unsaved) files.
+        self.memory: Dict[str, PipelineProduct] = {}
+
+        # Files listed more than once in the frameset (in several roles) are decoded only once, see `FrameCache`
+        self.frame_cache = FrameCache()
+
     def run(self, frameset: cpl.ui.FrameSet, settings: Dict[str, Any]) -> cpl.ui.FrameSet:
         """
             The main function of the recipe implementation. Mirrors the signature of Recipe.run.
             All recipe implementations follow this schema (and hence it does not have to be repeated).
         """
+        with self.profiling('run'):
+            products = self.process(frameset, settings)   # Do all the actual processing
+            self.save_products(products)                  # Save the output products
 
+        return self.build_product_frameset(products)      # Return the output as a pycpl FrameSet
 
+    def process(self, frameset: cpl.ui.FrameSet, settings: Dict[str, Any]) -> Dict[str, PipelineProduct]:
+        """
+            Everything `run` does, except for saving the products: they are returned as objects.
+            Used directly when recipes are chained in memory.
+        """
         try:
             self.frameset = frameset
+            self.frame_cache = FrameCache(frame.file for frame in frameset)
             self.import_settings(settings)                # Import and process the provided settings dict
             self.inputset = self.InputSet(frameset)       # Create an appropriate Input object
             self.inputset.print_debug()
             self.inputset.verify()                        # Verify that they are valid (maybe with `schema` too?)
-            products = self.process_images()              # Do all the actual processing
-            self.save_products(products)                  # Save the output products
-
-            return self.build_product_frameset(products)  # Return the output as a pycpl FrameSet
+            with self.profiling('process_images'):
+                return self.process_images()
         except cpl.core.DataNotFoundError as e:
             Msg.error(self.__class__.__qualname__, f"Data not found error: {e.message}")
             raise e
 
+    @contextlib.contextmanager
+    def profiling(self, scope: str) -> Iterator[None]:
+        """ Profile the body if requested by the environment for this scope (see `pymetis.base.profiling`) """
+        options = ProfilingOptions.from_environment()
+        if options is None or options.scope != scope:
+            yield
+            return
+
+        Msg.info(self.__class__.__qualname__, f"Profiling {scope} with {', '.join(options.profilers)}")
+        with profiled(self.name, options) as outputs:
+            yield
+        Msg.info(self.__class__.__qualname__, f"Profiles written to {', '.join(map(str, outputs))}")
 
     def import_settings(self, settings: Dict[str, Any]) -> None:
         """ Update the recipe parameters with the values requested by the user """
@@ -90,6 +126,58 @@ class MetisRecipeImpl(ABC):
                       f"Saving {name}")
             product.save()
 
+    def load_planes(self, frame: cpl.ui.Frame) -> Planes:
+        """
+        DATA/ERR/DQ planes of an input frame. The planes are shared with all other users of the same file
+        (or product held in memory), and copied on write: see `Planes.writable`.
+        """
+        if (product := self.memory.get(frame.file)) is not None and product.planes is not None:
+            return product.planes.shared()
+        return self.frame_cache.planes(frame.file)
+
+    def load_data(self, frame: cpl.ui.Frame, extension: int | str = 0) -> np.ndarray:
+        """ The data of an extension of an input frame, read-only and shared with all other users of the file """
+        return self.frame_cache.data(frame.file, extension)
+
+    def load_header(self, frame: cpl.ui.Frame) -> cpl.core.PropertyList:
+        """ The primary header of an input frame """
+        if (product := self.memory.get(frame.file)) is not None:
+            return product.primary_header()
+        return cpl.core.PropertyList.load(frame.file, 0)
+
+    def load_table(self, frame: cpl.ui.Frame) -> Table:
+        """ The table in the first extension of an input frame """
+        if isinstance(product := self.memory.get(frame.file), TableProduct):
+            return product.table if isinstance(product.table, Table) else Table.read(product.table)
+        return Table.read(frame.file, hdu=1)
+
+    def load_grid(self, frame: cpl.ui.Frame) -> CubeGrid:
+        """ The pixel grid of an input cube, from its header only """
+        if (product := self.memory.get(frame.file)) is not None and product.planes is not None:
+            header = as_header(product.primary_header())
+            header['NAXIS'] = product.planes.data.ndim
+            for axis, size in enumerate(reversed(product.planes.data.shape), start=1):
+                header[f'NAXIS{axis}'] = size
+            return CubeGrid.from_header(header)
+        return CubeGrid.from_header(fits.getheader(frame.file, 0))
+
+    def dfs_frameset(self) -> cpl.ui.FrameSet:
+        """
+        The input frames as recorded in the headers of the products. Inputs held in memory
+        have possibly never been saved, so they are replaced by the frames they were created from.
+        """
+        frameset = cpl.ui.FrameSet()
+        seen = set()
+
+        for frame in self.frameset:
+            product = self.memory.get(frame.file)
+            for used in [frame] if product is None else product.recipe.dfs_frameset():
+                if used.file not in seen:
+                    seen.add(used.file)
+                    frameset.append(used)
+
+        return frameset
+
     def build_product_frameset(self, products: Dict[str, PipelineProduct]) -> cpl.ui.FrameSet:
         """ Gather all the products and build a FrameSet from their frames. """
         Msg.debug(self.__class__.__qualname__, f"Building the product frameset")
@@ -1,10 +1,29 @@
 from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Tuple
 
 import cpl
+from astropy.io import fits
+from astropy.table import Table
 from cpl.core import Msg
 
+from pymetis.algorithms.cubewriter import CubeWriter
+from pymetis.algorithms.images import as_image, as_imagelist
+from pymetis.algorithms.qc import QcDefinition, qc_dictionary
+from pymetis.algorithms.stacking import Planes
+
 PIPELINE = r"METIS"
 
+# Types of the DFS dictionaries
+QC_TYPES: Dict[str, cpl.core.Type] = {
+    'double': cpl.core.Type.DOUBLE,
+    'float': cpl.core.Type.DOUBLE,
+    'int': cpl.core.Type.INT,
+    'integer': cpl.core.Type.INT,
+    'string': cpl.core.Type.STRING,
+    'boolean': cpl.core.Type.BOOL,
+    'logical': cpl.core.Type.BOOL,
+}
+
 
 class PipelineProduct(ABC):
     """
@@ -21,11 +40,16 @@ class PipelineProduct(ABC):
                  recipe: 'MetisRecipeImpl',
                  header: cpl.core.PropertyList,
                  image: cpl.core.Image,
+                 *,
+                 error: cpl.core.Image = None,
+                 quality: cpl.core.Image = None,
                  **kwargs):
         self.recipe: 'MetisRecipeImpl' = recipe
         self.header: cpl.core.PropertyList = header
         self.image: cpl.core.Image = image
         self.properties = cpl.core.PropertyList()
+        self.extensions: List[Tuple[str, cpl.core.Image]] = []
+        self.planes: Planes | None = None           # The planes as arrays, if created from them
 
         # Raise a NotImplementedError in case a derived class forgot to set a class attribute
         if self.tag is None:
@@ -45,6 +69,24 @@ class PipelineProduct(ABC):
 
         self.add_properties()
 
+        # Error and data quality planes go first, so that they are always ERR and DQ right after the data
+        if error is not None:
+            self.add_extension("ERR", error)
+        if quality is not None:
+            self.add_extension("DQ", quality)
+
+    @classmethod
+    def from_planes(cls,
+                    recipe: 'MetisRecipeImpl',
+                    header: cpl.core.PropertyList,
+                    planes: Planes,
+                    **kwargs) -> 'PipelineProduct':
+        """ Create a product from DATA/ERR/DQ planes: data in the primary HDU, ERR and DQ as extensions """
+        product = cls(recipe, header, as_image(planes.data),
+                      error=as_image(planes.error), quality=as_image(planes.quality), **kwargs)
+        product.planes = planes
+        return product
+
     def add_properties(self):
         """
         Hook for adding properties.
@@ -60,6 +102,48 @@ class PipelineProduct(ABC):
             )
         )
 
+    def add_qc(self, parameters: Dict[str, Any]) -> None:
+        """
+        Add QC parameters (as computed by `QcEngine.parameters`) to the product properties.
+        Types and comments are taken from the METIS QC dictionary; every parameter must be defined there.
+        """
+        try:
+            dictionary = qc_dictionary()
+        except FileNotFoundError as e:
+            Msg.warning(self.__class__.__qualname__, f"QC dictionary not available ({e}), guessing the QC types")
+            dictionary = None
+
+        for name, value in parameters.items():
+            if dictionary is None:
+                definition = QcDefinition(name, 'int' if isinstance(value, int) else 'double')
+            else:
+                definition = dictionary.lookup(name)
+
+            self.properties.append(
+                cpl.core.Property(
+                    f"ESO {name}",
+                    QC_TYPES[definition.type.lower()],
+                    value,
+                    definition.comment,
+                )
+            )
+
+    def primary_header(self) -> cpl.core.PropertyList:
+        """ The primary header as it is saved (except for the keywords added by the DFS), without saving it """
+        header = cpl.core.PropertyList()
+        for prop in self.header:
+            header.append(prop)
+        for prop in self.properties:
+            header.append(prop)
+        return header
+
+    def add_extension(self, name: str, image: cpl.core.Image) -> None:
+        """
+        Register an additional image to be saved as a named extension (EXTNAME) after the primary HDU.
+        Extensions are written in the order in which they were added.
+        """
+        self.extensions.append((name, image))
+
     def as_frame(self):
         """ Create a CPL Frame from this Product """
         return cpl.ui.Frame(
@@ -73,10 +157,21 @@ class PipelineProduct(ABC):
     def save(self):
         """ Save this Product to a file """
         Msg.info(self.__class__.__qualname__, f"Saving product file as {self.output_file_name!r}.")
+        self.save_primary()
+
+        for name, image in self.extensions:
+            Msg.debug(self.__class__.__qualname__, f"Appending extension {name!r} to {self.output_file_name!r}.")
+            header = cpl.core.PropertyList()
+            header.append(cpl.core.Property("EXTNAME", cpl.core.Type.STRING, name))
+            image.save(self.output_file_name, header, cpl.core.io.EXTEND)
+
+    def save_primary(self):
+        """ Save the primary HDU with the DFS headers """
+        frameset = self.recipe.dfs_frameset()
         cpl.dfs.save_image(
-            self.recipe.frameset,       # All frames for the recipe
+            frameset,                   # All frames for the recipe
             self.recipe.parameters,     # The list of input parameters
-            self.recipe.frameset,       # The list of raw and calibration frames actually used
+            frameset,                   # The list of raw and calibration frames actually used
                                         # (same as all frames, as we always use all the frames)
             self.image,                 # Image to be saved
             self.recipe.name,           # Name of the recipe
@@ -86,6 +181,20 @@ class PipelineProduct(ABC):
             header=self.header,
         )
 
+    def save_header(self):
+        """ Save only the primary header with the DFS headers, without any data """
+        frameset = self.recipe.dfs_frameset()
+        cpl.dfs.save_propertylist(
+            frameset,
+            self.recipe.parameters,
+            frameset,
+            self.recipe.name,
+            self.properties,
+            PIPELINE,
+            self.output_file_name,
+            header=self.header,
+        )
+
     @property
     @abstractmethod
     def category(self) -> str:
@@ -107,3 +216,130 @@ class DetectorProduct(PipelineProduct, ABC):
                  **kwargs):
         self.detector = detector
         super().__init__(recipe, header, image, **kwargs)
+
+
+class TargetProduct(PipelineProduct, ABC):
+    """ A product whose category depends on the target, e.g. `SCI` or `STD` """
+    def __init__(self,
+                 recipe: 'MetisRecipe',
+                 header: cpl.core.PropertyList,
+                 image: cpl.core.Image,
+                 *,
+                 target: str,
+                 **kwargs):
+        self.target = target
+        super().__init__(recipe, header, image, **kwargs)
+
+
+class CubeProduct(PipelineProduct, ABC):
+    """
+    A product with a data cube (a CPL ImageList, one image per wavelength) in the primary HDU.
+    The world coordinate system of the cube is passed as `wcs`, a dictionary of FITS keywords and values.
+    """
+    frame_type = cpl.ui.Frame.FrameType.IMAGE
+
+    def __init__(self,
+                 recipe: 'MetisRecipe',
+                 header: cpl.core.PropertyList,
+                 image: cpl.core.ImageList,
+                 *,
+                 wcs: Dict[str, Any] = None,
+                 **kwargs):
+        self.wcs = wcs or {}
+        if self.wcs:
+            # The WCS of the cube replaces whatever WCS the header inherited from the inputs
+            header.del_regexp(r"^(WCSAXES|CTYPE|CUNIT|CRPIX|CRVAL|CDELT|CD[0-9]_|PC[0-9]_)", False)
+        super().__init__(recipe, header, image, **kwargs)
+
+    @classmethod
+    def from_planes(cls,
+                    recipe: 'MetisRecipeImpl',
+                    header: cpl.core.PropertyList,
+                    planes: Planes,
+                    **kwargs) -> 'CubeProduct':
+        product = cls(recipe, header, as_imagelist(planes.data),
+                      error=as_imagelist(planes.error), quality=as_imagelist(planes.quality), **kwargs)
+        product.planes = planes
+        return product
+
+    def add_properties(self):
+        super().add_properties()
+
+        for keyword, value in self.wcs.items():
+            match value:
+                case str():
+                    kind = cpl.core.Type.STRING
+                case int():
+                    kind = cpl.core.Type.INT
+                case _:
+                    kind = cpl.core.Type.DOUBLE
+            self.properties.append(cpl.core.Property(keyword, kind, value))
+
+    def save_primary(self):
+        frameset = self.recipe.dfs_frameset()
+        cpl.dfs.save_imagelist(
+            frameset,
+            self.recipe.parameters,
+            frameset,
+            self.image,                 # The cube, as a list of images
+            self.recipe.name,
+            self.properties,
+            PIPELINE,
+            self.output_file_name,
+            header=self.header,
+        )
+
+
+class StreamedCubeProduct(CubeProduct, ABC):
+    """
+    A cube product that is written incrementally rather than assembled in memory: `open` writes the headers
+    and allocates the cubes in the file, the planes are then written through the returned `CubeWriter`.
+    All properties (QC parameters included) must be set before the product is opened.
+    """
+
+    def __init__(self,
+                 recipe: 'MetisRecipe',
+                 header: cpl.core.PropertyList,
+                 shape: Tuple[int, int, int],
+                 *,
+                 wcs: Dict[str, Any] = None,
+                 **kwargs):
+        self.shape = tuple(shape)
+        self.writer: CubeWriter | None = None
+        super().__init__(recipe, header, None, wcs=wcs, **kwargs)
+
+    def open(self) -> CubeWriter:
+        """ Write the headers and return the writer for the planes """
+        # The DFS keywords are produced by CPL, the cube file is then laid out around its primary header
+        self.save_header()
+        header = fits.getheader(self.output_file_name, 0)
+        self.writer = CubeWriter(self.output_file_name, self.shape, header)
+        return self.writer
+
+    def save(self):
+        """ The product has already been saved while it was written, only check that it is complete """
+        if self.writer is None or not self.writer.complete:
+            raise RuntimeError(f"Cube {self.output_file_name!r} has not been written completely")
+        Msg.info(self.__class__.__qualname__, f"Product file {self.output_file_name!r} was written incrementally.")
+
+
+class TableProduct(PipelineProduct, ABC):
+    """
+    A product with a table in the first extension and only the DFS headers in the primary HDU.
+    The table is an `astropy.table.Table`, so that columns can be plain NumPy arrays,
+    or a ready-made binary table HDU (e.g. with header keywords of its own).
+    """
+    frame_type = cpl.ui.Frame.FrameType.TABLE
+
+    def __init__(self,
+                 recipe: 'MetisRecipe',
+                 header: cpl.core.PropertyList,
+                 table: Table | fits.BinTableHDU,
+                 **kwargs):
+        self.table = table
+        super().__init__(recipe, header, None, **kwargs)
+
+    def save_primary(self):
+        self.save_header()
+        hdu = self.table if isinstance(self.table, fits.BinTableHDU) else fits.table_to_hdu(self.table)
+        fits.append(self.output_file_name, hdu.data, hdu.header)
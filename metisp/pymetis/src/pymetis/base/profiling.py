@@ -0,0 +1,141 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Mapping
+
+"""
+Opt-in profiling of recipes, switched on by environment variables so that production runs need no changes:
+
+    PYMETIS_PROFILE=cprofile,tracemalloc,rss pyesorex metis_det_dark dark.sof
+
+- `PYMETIS_PROFILE`: comma-separated profilers: `cprofile` (function timings, `<recipe>.prof` for `pstats`
+  or snakeviz, and a summary in `<recipe>.pstats.txt`), `tracemalloc` (top allocation sites and the peak of
+  traced memory in `<recipe>.tracemalloc.txt`), `rss` (resident set size sampled periodically, `<recipe>.rss.txt`).
+- `PYMETIS_PROFILE_SCOPE`: `process_images` (default), or `run` to include loading the inputs and saving the products.
+- `PYMETIS_PROFILE_INTERVAL`: sampling interval of `rss` in seconds (default 0.1).
+- `PYMETIS_PROFILE_DIR`: directory for the outputs, by default the working directory, where the products are saved.
+"""
+
+PROFILERS = ('cprofile', 'tracemalloc', 'rss')
+SCOPES = ('process_images', 'run')
+
+# Number of functions and allocation sites in the text summaries
+TOP = 30
+
+
+@dataclass
+class ProfilingOptions:
+    profilers: List[str]
+    scope: str = 'process_images'
+    interval: float = 0.1
+    directory: Path = Path('.')
+
+    @classmethod
+    def from_environment(cls, environ: Mapping[str, str] = os.environ) -> 'ProfilingOptions | None':
+        """ The options requested by the environment variables, None if profiling is off """
+        profilers = [name.strip().lower() for name in environ.get('PYMETIS_PROFILE', '').split(',') if name.strip()]
+        if not profilers:
+            return None
+
+        if unknown := [name for name in profilers if name not in PROFILERS]:
+            raise ValueError(f"Unknown profilers {unknown} in PYMETIS_PROFILE, expected some of {list(PROFILERS)}")
+        if (scope := environ.get('PYMETIS_PROFILE_SCOPE', 'process_images')) not in SCOPES:
+            raise ValueError(f"Unknown profiling scope {scope!r}, expected one of {list(SCOPES)}")
+
+        return cls(profilers, scope,
+                   float(environ.get('PYMETIS_PROFILE_INTERVAL', 0.1)),
+                   Path(environ.get('PYMETIS_PROFILE_DIR', '.')))
+
+
+def resident_memory() -> int:
+    """ Current resident set size of the process in bytes (the peak where the current size is not available) """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler(threading.Thread):
+    """ Samples the resident set size in the background until stopped """
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.samples: List[tuple[float, int]] = []
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        start = time.perf_counter()
+        while True:
+            self.samples.append((time.perf_counter() - start, resident_memory()))
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+        self.samples.append((self.samples[-1][0] if self.samples else 0.0, resident_memory()))
+
+    def write(self, filename: Path) -> None:
+        with open(filename, 'w') as output:
+            output.write(f"# Peak RSS {max(rss for _, rss in self.samples) / 2**20:.1f} MiB\n")
+            output.write("# time [s]\tRSS [MiB]\n")
+            for elapsed, rss in self.samples:
+                output.write(f"{elapsed:.3f}\t{rss / 2**20:.1f}\n")
+
+
+@contextlib.contextmanager
+def profiled(name: str, options: ProfilingOptions) -> Iterator[List[Path]]:
+    """
+    Run the body of the `with` statement under the requested profilers. Yields a list that is filled
+    with the names of the output files (`<directory>/<name>.*`) when the body has finished.
+    """
+    outputs: List[Path] = []
+    options.directory.mkdir(parents=True, exist_ok=True)
+
+    sampler = RssSampler(options.interval) if 'rss' in options.profilers else None
+    profile = cProfile.Profile() if 'cprofile' in options.profilers else None
+    tracing = 'tracemalloc' in options.profilers and not tracemalloc.is_tracing()
+
+    if sampler is not None:
+        sampler.start()
+    if tracing:
+        tracemalloc.start(8)
+    if profile is not None:
+        profile.enable()
+
+    try:
+        yield outputs
+    finally:
+        def output(suffix: str) -> Path:
+            outputs.append(filename := options.directory / f"{name}{suffix}")
+            return filename
+
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(output('.prof'))
+            summary = io.StringIO()
+            pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(TOP)
+            output('.pstats.txt').write_text(summary.getvalue())
+
+        if tracing:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(output('.tracemalloc.txt'), 'w') as summary:
+                summary.write(f"# Peak traced memory {peak / 2**20:.1f} MiB, top {TOP} allocation sites still held:\n")
+                for statistic in snapshot.statistics('lineno')[:TOP]:
+                    summary.write(f"{statistic}\n")
+
+        if sampler is not None:
+            sampler.stop()
+            sampler.write(output('.rss.txt'))
@@ -0,0 +1,7 @@
+# Data organisation and local execution of workflows, independent of EDPS
+from .association import Associator, ProductStore
+from .index import HeaderIndex
+from .oca import OcaClassifier
+from .rules import ClassificationRule, CompiledClassifier, header_keyword
+from .sof import SofBuilder
+from .workflow import Workflow, DataSource, Task
@@ -0,0 +1,211 @@
+import argparse
+import bisect
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from pymetis.dataflow.rules import header_value
+from pymetis.dataflow.sof import read_headers, read_sof, write_sof
+
+"""
+Association of calibration products with raw frames, without EDPS.
+
+The product store is a directory tree of calibration products, identified by their `ESO PRO CATG`.
+For every product category (and DIT, for calibrations that have to match the exposure time, such as darks),
+the products are kept sorted by `MJD-OBS`, so that the product closest in time to a raw frame is found
+by bisection rather than by scanning the store. The calibrations a recipe needs are listed in `RECIPES`,
+with their tags already resolved for the detector and band of the recipe.
+
+A night is associated frame by frame; raw frames that end up with the same calibrations share one SOF.
+"""
+
+# Precision of the DIT comparison, in seconds
+DIT_DECIMALS: int = 6
+
+
+@dataclass(frozen=True)
+class Calibration:
+    """
+    A calibration input of a recipe: a product with one of the `tags` (in order of preference),
+    with the DIT of the raw frame if `match_dit`, the nearest in time and taken at most `validity` days apart.
+    """
+    tags: Tuple[str, ...]
+    match_dit: bool = False
+    required: bool = True
+    validity: float = None
+
+
+# Calibrations needed by the recipes, as declared by their input sets
+RECIPES: Dict[str, List[Calibration]] = {
+    'metis_lm_basic_reduce': [
+        Calibration(("MASTER_DARK_2RG",), match_dit=True),
+        Calibration(("MASTER_IMG_FLAT_LAMP_LM", "MASTER_IMG_FLAT_TWILIGHT_LM")),
+        Calibration(("LINEARITY_2RG",)),
+        Calibration(("GAIN_MAP_2RG",)),
+        Calibration(("PERSISTENCE_MAP",), required=False),
+    ],
+    'metis_lm_img_flat': [
+        Calibration(("MASTER_DARK_2RG",)),
+    ],
+    'metis_n_img_flat': [
+        Calibration(("MASTER_DARK_GEO",)),
+    ],
+    'metis_det_lingain': [
+        Calibration(("MASTER_DARK_2RG",)),
+    ],
+}
+
+
+def dit_key(dit) -> float | None:
+    return None if dit is None else round(float(dit), DIT_DECIMALS)
+
+
+@dataclass
+class _TimeIndex:
+    """ Products of one category (and DIT), sorted by the time of observation once all are added """
+    mjds: List[float] = field(default_factory=list)
+    files: List[str] = field(default_factory=list)
+    ordered: bool = True
+
+    def add(self, mjd: float, file: str) -> None:
+        self.mjds.append(mjd)
+        self.files.append(file)
+        self.ordered = False
+
+    def nearest(self, mjd: float, validity: float = None) -> Tuple[str, float] | None:
+        """ The product nearest to `mjd` (the earlier one on a tie) and its distance in days """
+        if not self.ordered:
+            order = sorted(range(len(self.mjds)), key=lambda index: (self.mjds[index], self.files[index]))
+            self.mjds = [self.mjds[index] for index in order]
+            self.files = [self.files[index] for index in order]
+            self.ordered = True
+
+        position = bisect.bisect_left(self.mjds, mjd)
+        candidates = [index for index in (position - 1, position) if 0 <= index < len(self.mjds)]
+        if not candidates:
+            return None
+
+        best = min(candidates, key=lambda index: abs(self.mjds[index] - mjd))
+        distance = abs(self.mjds[best] - mjd)
+        if validity is not None and distance > validity:
+            return None
+        return self.files[best], distance
+
+
+class ProductStore:
+    """ Calibration products indexed by category, DIT and time of observation """
+
+    def __init__(self):
+        # (category, DIT or None for any) -> products sorted by MJD-OBS
+        self.indexes: Dict[Tuple[str, float | None], _TimeIndex] = {}
+
+    def __len__(self) -> int:
+        return sum(len(index.files) for (_, dit), index in self.indexes.items() if dit is None)
+
+    def add(self, file: str, header) -> bool:
+        """ Add a product by its primary header; files without `ESO PRO CATG` or `MJD-OBS` are ignored """
+        category, mjd = header_value(header, 'ESO PRO CATG'), header_value(header, 'MJD-OBS')
+        if category is None or mjd is None:
+            return False
+
+        self.indexes.setdefault((category, None), _TimeIndex()).add(float(mjd), file)
+        if (dit := dit_key(header_value(header, 'ESO DET DIT'))) is not None:
+            self.indexes.setdefault((category, dit), _TimeIndex()).add(float(mjd), file)
+        return True
+
+    @classmethod
+    def from_files(cls, files: Iterable[str | Path], *, workers: int = None) -> 'ProductStore':
+        store = cls()
+        for file, header in read_headers(files, workers=workers):
+            store.add(file, header)
+        return store
+
+    @classmethod
+    def from_directory(cls, root: str | Path, *, workers: int = None) -> 'ProductStore':
+        return cls.from_files(sorted(Path(root).rglob('*.fits')), workers=workers)
+
+    def select(self, calibration: Calibration, mjd: float, dit: float = None) -> Tuple[str, str] | None:
+        """ The best product for a calibration as a frame (file, tag), None if there is none """
+        dit = dit_key(dit) if calibration.match_dit else None
+        for tag in calibration.tags:
+            if (index := self.indexes.get((tag, dit))) is not None:
+                if (found := index.nearest(mjd, calibration.validity)) is not None:
+                    return found[0], tag
+        return None
+
+
+class Associator:
+    """ Completes the raw frames of a recipe with the calibrations from a product store """
+
+    def __init__(self, store: ProductStore, recipe: str):
+        self.store = store
+        self.recipe = recipe
+        try:
+            self.calibrations = RECIPES[recipe]
+        except KeyError as e:
+            raise KeyError(f"No calibrations known for recipe {recipe!r}, only for {list(RECIPES)}") from e
+        self.unassociated: Dict[str, List[str]] = {}    # Raw file -> missing calibration tags, of the last call
+
+    def associate(self, header) -> Tuple[List[Tuple[str, str]], List[str]]:
+        """ The calibration frames for a raw frame, and the tags of required calibrations that were not found """
+        mjd = header_value(header, 'MJD-OBS')
+        dit = header_value(header, 'ESO DET DIT')
+        frames, missing = [], []
+
+        for calibration in self.calibrations:
+            found = None if mjd is None else self.store.select(calibration, float(mjd), dit)
+            if found is not None:
+                frames.append(found)
+            elif calibration.required:
+                missing.append(calibration.tags[0])
+
+        return frames, missing
+
+    def night(self, raw: Iterable[Tuple[str, str]], *, workers: int = None) -> List[List[Tuple[str, str]]]:
+        """
+        Associate all raw frames (file, tag) and group those with identical calibrations.
+        Returns complete sets of frames; raw frames lacking a required calibration are left out
+        and listed in `unassociated`.
+        """
+        raw = list(raw)
+        tags = dict(raw)
+        groups: Dict[tuple, List[Tuple[str, str]]] = {}
+        self.unassociated = {}
+
+        for file, header in read_headers([file for file, _ in raw], workers=workers):
+            calibrations, missing = self.associate(header)
+            if missing:
+                self.unassociated[file] = missing
+            else:
+                groups.setdefault(tuple(calibrations), []).append((file, tags[file]))
+
+        return [frames + list(calibrations) for calibrations, frames in groups.items()]
+
+    def write_night(self, raw: Iterable[Tuple[str, str]], output_dir: str | Path, *, workers: int = None) -> [Path]:
+        """ Associate a night of raw frames and write a SOF for every group, named `<recipe>_<n>.sof` """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return [write_sof(output_dir / f"{self.recipe}_{number}.sof", frames)
+                for number, frames in enumerate(self.night(raw, workers=workers), start=1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Associate raw frames with calibration products and write SOFs")
+    parser.add_argument('recipe', choices=list(RECIPES), help="recipe to prepare the SOFs for")
+    parser.add_argument('products', help="directory with the calibration products")
+    parser.add_argument('sofs', nargs='+', help="SOF files with the raw frames, e.g. written by pymetis.dataflow.sof")
+    parser.add_argument('-o', '--output-dir', default='.', help="directory for the complete SOF files")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of threads reading the headers")
+    args = parser.parse_args()
+
+    associator = Associator(ProductStore.from_directory(args.products, workers=args.workers), args.recipe)
+    raw = [frame for sof in args.sofs for frame in read_sof(sof)]
+    for filename in associator.write_night(raw, args.output_dir, workers=args.workers):
+        print(filename)
+    for file, missing in associator.unassociated.items():
+        print(f"{file}: no {', '.join(missing)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+import cpl
+from cpl.core import Msg
+
+from pymetis.base.product import PipelineProduct
+from pymetis.dataflow.executor import FrameSpec, load_recipe
+from pymetis.dataflow.sof import read_sof
+
+"""
+In-memory chaining of recipes.
+
+A chain runs a fixed sequence of recipes in a single process. The products of every recipe are not saved
+and reloaded, but handed to the following recipes as objects: their frames are added to the common pool
+of input frames, and the recipe implementations find the products behind them in their `memory`.
+Only the products of the last recipe are saved, unless the intermediate ones are requested too.
+"""
+
+
+@contextlib.contextmanager
+def working_directory(path: Path) -> Iterator[Path]:
+    """ Temporarily change the working directory """
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+
+
+@dataclass
+class ChainStep:
+    """
+    A recipe in a chain. Frames with the tags in one of the `separate` groups are processed by separate runs
+    of the recipe (e.g. the science and the standard star exposures); all other frames are given to every run.
+    """
+    recipe: str
+    separate: List[List[str]] = field(default_factory=list)
+
+    def runs(self, frames: [FrameSpec]) -> List[List[FrameSpec]]:
+        """ The input frames of the individual runs of the recipe """
+        if not self.separate:
+            return [list(frames)]
+
+        separated = {tag for group in self.separate for tag in group}
+        common = [frame for frame in frames if frame[1] not in separated]
+        runs = [[frame for frame in frames if frame[1] in group] for group in self.separate]
+        return [common + run for run in runs if run]
+
+
+# The IFU science chain: reduction of the standard star and the science exposures, telluric correction
+# and flux calibration of the science cubes, and their coaddition
+IFU_CHAIN: List[ChainStep] = [
+    ChainStep('metis_ifu_reduce', [['IFU_STD_RAW'], ['IFU_SCI_RAW']]),
+    ChainStep('metis_ifu_telluric'),
+    ChainStep('metis_ifu_calibrate'),
+    ChainStep('metis_ifu_postprocess'),
+]
+
+
+class RecipeChain:
+    """ Runs a chain of recipes in one process, passing the products from one recipe to the next in memory """
+
+    def __init__(self,
+                 steps: [ChainStep],
+                 output_dir: str | Path,
+                 *,
+                 settings: Dict[str, Dict[str, Any]] = None,
+                 save_intermediate: bool = False):
+        self.steps = steps
+        self.output_dir = Path(output_dir).absolute()
+        self.settings = settings or {}                  # Recipe settings, keyed by recipe name
+        self.save_intermediate = save_intermediate
+        self.memory: Dict[str, PipelineProduct] = {}    # Products of all recipes run so far, by file name
+
+    def run(self, frames: [FrameSpec]) -> [FrameSpec]:
+        """ Run all steps on `frames` and return the saved product frames """
+        pool: List[FrameSpec] = list(frames)
+        saved: List[FrameSpec] = []
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        # The products are saved to (and their frames refer to) the current working directory
+        with working_directory(self.output_dir):
+            for index, step in enumerate(self.steps):
+                save = self.save_intermediate or index == len(self.steps) - 1
+
+                for run in step.runs(pool):
+                    frameset = cpl.ui.FrameSet()
+                    for file, tag in run:
+                        frameset.append(cpl.ui.Frame(file, tag=tag))
+
+                    Msg.info(self.__class__.__qualname__, f"Running {step.recipe} on {len(run)} frames")
+                    implementation = load_recipe(step.recipe)().implementation
+                    implementation.memory = self.memory
+                    products = implementation.process(frameset, self.settings.get(step.recipe, {}))
+
+                    if save:
+                        implementation.save_products(products)
+
+                    for product in products.values():
+                        frame = (product.output_file_name, product.tag)
+                        self.memory[product.output_file_name] = product
+                        pool.append(frame)
+                        if save:
+                            saved.append((str(self.output_dir / product.output_file_name), product.tag))
+
+        return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the IFU recipes as a chain in a single process")
+    parser.add_argument('sof', help="set of frames with all the inputs of the chain")
+    parser.add_argument('-o', '--output-dir', default='.', help="directory for the products")
+    parser.add_argument('--save-intermediate', action='store_true',
+                        help="save the products of all recipes, not only those of the last one")
+    args = parser.parse_args()
+
+    frames = [(str(Path(file).absolute()), tag) for file, tag in read_sof(args.sof)]
+    chain = RecipeChain(IFU_CHAIN, args.output_dir, save_intermediate=args.save_intermediate)
+    for file, tag in chain.run(frames):
+        print(f"{file}\t{tag}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+import argparse
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import cpl
+from astropy.io import fits
+from cpl.core import Msg
+
+from pymetis.dataflow.index import HeaderIndex
+from pymetis.dataflow.rules import header_keyword
+from pymetis.dataflow.workflow import Workflow, Task, DataSource
+
+"""
+Local execution of an EDPS workflow without the EDPS service.
+
+The executor reads a workflow definition (see `pymetis.dataflow.workflow`), classifies the input files
+with its classification rules, reading only the primary headers, and runs the tasks in dependency order.
+Every job runs in its own scratch directory inside the output directory, in a separate worker process,
+so that independent tasks (e.g. the linearity/gain and the flat after the master dark) run concurrently.
+Products are passed to the downstream tasks as frames pointing into the scratch directories.
+"""
+
+# Where to find the recipe classes. Imported lazily so that worker processes only import what they run.
+RECIPES: Dict[str, str] = {
+    'metis_det_dark': 'pymetis.recipes.metis_det_dark:MetisDetDark',
+    'metis_det_lingain': 'pymetis.recipes.metis_det_lingain:MetisDetLinGain',
+    'metis_lm_basic_reduce': 'pymetis.recipes.img.metis_lm_basic_reduce:MetisLmBasicReduce',
+    'metis_lm_img_flat': 'pymetis.recipes.img.metis_lm_img_flat:MetisLmImgFlat',
+    'metis_n_img_flat': 'pymetis.recipes.img.metis_n_img_flat:MetisNImgFlat',
+    'metis_ifu_distortion': 'pymetis.recipes.ifu.metis_ifu_distortion:MetisIfuDistortion',
+    'metis_ifu_wavecal': 'pymetis.recipes.ifu.metis_ifu_wavecal:MetisIfuWavecal',
+    'metis_ifu_reduce': 'pymetis.recipes.ifu.metis_ifu_reduce:MetisIfuReduce',
+    'metis_ifu_telluric': 'pymetis.recipes.ifu.metis_ifu_telluric:MetisIfuTelluric',
+    'metis_ifu_calibrate': 'pymetis.recipes.ifu.metis_ifu_calibrate:MetisIfuCalibrate',
+    'metis_ifu_postprocess': 'pymetis.recipes.ifu.metis_ifu_postprocess:MetisIfuPostprocess',
+}
+
+# A frame as passed between processes: (file name, tag). CPL frames themselves cannot be pickled.
+FrameSpec = Tuple[str, str]
+
+
+def load_recipe(name: str) -> type:
+    """ Import and return the recipe class registered under `name` """
+    try:
+        module_name, class_name = RECIPES[name].split(':')
+    except KeyError as e:
+        raise KeyError(f"No recipe named {name!r} is known to the local executor") from e
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def run_recipe(recipe_name: str,
+               frames: [FrameSpec],
+               settings: Dict[str, Any],
+               workdir: str) -> [FrameSpec]:
+    """
+    Run a single recipe in `workdir` and return its products. This is executed in a worker process,
+    so changing the working directory (where the recipes save their products) does not affect anyone else.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    # Keep the SOF next to the products, so that every job can be rerun by hand with pyesorex
+    with open(f"{recipe_name}.sof", 'w') as sof:
+        sof.writelines(f"{file} {tag}\n" for file, tag in frames)
+
+    frameset = cpl.ui.FrameSet()
+    for file, tag in frames:
+        frameset.append(cpl.ui.Frame(file, tag=tag))
+
+    recipe = load_recipe(recipe_name)()
+    products = recipe.run(frameset, settings)
+
+    return [(str(Path(workdir) / frame.file), frame.tag) for frame in products]
+
+
+def collect_inputs(inputs: [str | Path], index: HeaderIndex = None, workers: int = None) -> List[Path]:
+    """
+    The input files: files as given and all FITS files in directories, updating the header `index` if there is one.
+    The paths are absolute, since every job runs in a working directory of its own.
+    """
+    files = []
+    for inp in (Path(inp).absolute() for inp in inputs):
+        if inp.is_dir():
+            files += sorted(inp.rglob('*.fits'))
+            if index is not None:
+                index.update(inp, workers=workers)
+        else:
+            files.append(inp)
+    return files
+
+
+class LocalExecutor:
+    """
+    Runs the tasks of a `Workflow` on a set of local files, using a pool of worker processes.
+
+    Jobs are formed per task and per group of main input frames sharing the values of the match keywords
+    of the main data source. A job is submitted as soon as all the jobs it depends on have finished.
+    """
+
+    def __init__(self,
+                 workflow: Workflow,
+                 output_dir: str | Path,
+                 *,
+                 max_workers: int = None,
+                 settings: Dict[str, Dict[str, Any]] = None,
+                 index: HeaderIndex = None):
+        self.workflow = workflow
+        self.output_dir = Path(output_dir).absolute()
+        self.max_workers = max_workers
+        self.settings = settings or {}                  # Recipe settings, keyed by recipe name
+        self.index = index                              # Stored primary headers, if available
+
+        self.headers: Dict[str, fits.Header] = {}       # Primary headers of classified files
+        self.classified: Dict[str, List[str]] = {}      # Tag -> files
+        self.products: Dict[Tuple[str, tuple], List[FrameSpec]] = {}    # (task, group) -> product frames
+
+    def classify(self, files: [str | Path]) -> Dict[str, List[str]]:
+        """
+        Read the primary headers of `files` (from the header index, if there is one and it has them)
+        and sort them by the tags of the classification rules. Relative paths are made absolute.
+        """
+        for file in (str(Path(file).absolute()) for file in files):
+            header = self.primary_header(file)
+            tags = self.workflow.classify(header)
+
+            if not tags:
+                Msg.debug(self.__class__.__qualname__, f"File {file!r} does not match any classification rule")
+                continue
+
+            self.headers[file] = header
+            for tag in tags:
+                self.classified.setdefault(tag, []).append(file)
+
+        for tag, tagged in self.classified.items():
+            Msg.info(self.__class__.__qualname__, f"Classified {len(tagged)} file(s) as {tag}")
+
+        return self.classified
+
+    def primary_header(self, file: str) -> fits.Header:
+        if self.index is not None:
+            try:
+                return self.index.header(file)
+            except KeyError:
+                pass
+        return fits.getheader(file, 0)
+
+    def _source_frames(self, source: DataSource) -> [FrameSpec]:
+        return [(file, tag) for tag in source.tags for file in self.classified.get(tag, [])]
+
+    def _group_key(self, source: DataSource, file: str) -> tuple:
+        header = self.headers[file]
+        return tuple(header.get(header_keyword(keyword)) for keyword in source.match_keywords)
+
+    def _jobs(self, task: Task) -> Dict[tuple, List[FrameSpec]]:
+        """ Split the main input of a task into groups, one job each """
+        match task.main_input:
+            case DataSource() as source:
+                groups: Dict[tuple, List[FrameSpec]] = {}
+                for file, tag in self._source_frames(source):
+                    groups.setdefault(self._group_key(source, file), []).append((file, tag))
+                return groups
+            case Task() as upstream:
+                return {key: frames for (name, key), frames in self.products.items() if name == upstream.name}
+            case _:
+                raise ValueError(f"Task {task.name!r} has no main input")
+
+    def _associated_frames(self, task: Task, key: tuple) -> [FrameSpec]:
+        """ Frames of the associated inputs: from the job with the same group if there is one, otherwise all """
+        frames = []
+
+        for source in task.associated_inputs:
+            match source:
+                case DataSource():
+                    frames += self._source_frames(source)
+                case Task():
+                    if (source.name, key) in self.products:
+                        frames += self.products[(source.name, key)]
+                    else:
+                        for (name, _), products in self.products.items():
+                            if name == source.name:
+                                frames += products
+
+        return frames
+
+    def run(self, files: [str | Path], targets: [str] = None) -> Dict[Tuple[str, tuple], List[FrameSpec]]:
+        """
+        Classify `files` and run all tasks required for `targets` (all tasks if not specified).
+        Returns the product frames of every job.
+        """
+        self.classify(files)
+        pending = self.workflow.required_tasks(targets)
+        finished: set = set()
+        running: Dict[Future, Tuple[Task, tuple]] = {}
+        remaining_jobs: Dict[str, int] = {}
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for task in [task for task in pending if all(dep.name in finished for dep in task.dependencies)]:
+                    pending.remove(task)
+                    jobs = self._jobs(task)
+
+                    if not jobs:
+                        Msg.warning(self.__class__.__qualname__, f"No input frames for task {task.name!r}, skipping")
+                        finished.add(task.name)
+                        continue
+
+                    remaining_jobs[task.name] = len(jobs)
+                    for index, (key, frames) in enumerate(jobs.items()):
+                        workdir = self.output_dir / (task.name if len(jobs) == 1 else f"{task.name}.{index}")
+                        frames = frames + self._associated_frames(task, key)
+                        Msg.info(self.__class__.__qualname__,
+                                 f"Submitting task {task.name!r} (recipe {task.recipe}) with {len(frames)} frames")
+                        future = pool.submit(run_recipe, task.recipe, frames,
+                                             self.settings.get(task.recipe, {}), str(workdir))
+                        running[future] = (task, key)
+
+                if not running:
+                    if pending:
+                        raise RuntimeError(f"Tasks {[task.name for task in pending]} cannot be scheduled")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, key = running.pop(future)
+                    self.products[(task.name, key)] = future.result()
+                    Msg.info(self.__class__.__qualname__,
+                             f"Task {task.name!r} produced {[tag for _, tag in self.products[(task.name, key)]]}")
+
+                    remaining_jobs[task.name] -= 1
+                    if remaining_jobs[task.name] == 0:
+                        finished.add(task.name)
+
+        return self.products
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an EDPS workflow locally, without the EDPS service")
+    parser.add_argument('workflow', help="workflow definition, e.g. workflows/metis/metis_lm_img_wkf.py")
+    parser.add_argument('inputs', nargs='+', help="input FITS files or directories to search for them")
+    parser.add_argument('-o', '--output-dir', default='.', help="directory for the scratch and product directories")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('-t', '--target', action='append', default=None,
+                        help="task name or meta target to produce (may be repeated, default: all tasks)")
+    parser.add_argument('-i', '--index', default=None,
+                        help="SQLite header index of the input directories, updated before classification")
+    args = parser.parse_args()
+
+    index = HeaderIndex(args.index) if args.index else None
+    files = collect_inputs(args.inputs, index, args.workers)
+
+    executor = LocalExecutor(Workflow.load(args.workflow), args.output_dir, max_workers=args.workers, index=index)
+    for (task, _), products in executor.run(files, args.target).items():
+        for file, tag in products:
+            print(f"{task}\t{file}\t{tag}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+from astropy.io import fits
+
+from pymetis.dataflow.rules import ClassificationRule, header_keyword
+
+"""
+A persistent index of the primary headers of a raw data archive.
+
+Classifying an archive means reading the primary header of every file, every time. The index keeps
+the keywords used for classification in an SQLite database, one row per file, together with the complete
+primary header for everything else (e.g. the match keywords of a workflow). Only files that are new or have
+changed (by modification time and size) since the last update are read, in parallel worker processes.
+Files that have disappeared are dropped. Queries on the indexed keywords are then answered by SQLite alone.
+"""
+
+# Indexed header keywords and the names of their columns
+COLUMNS: Dict[str, Tuple[str, str]] = {
+    'INSTRUME': ('instrume', 'TEXT'),
+    'ESO DPR CATG': ('dpr_catg', 'TEXT'),
+    'ESO DPR TYPE': ('dpr_type', 'TEXT'),
+    'ESO DPR TECH': ('dpr_tech', 'TEXT'),
+    'ESO DET DIT': ('det_dit', 'REAL'),
+    'MJD-OBS': ('mjd_obs', 'REAL'),
+}
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    {', '.join(f'{column} {kind}' for column, kind in COLUMNS.values())},
+    header TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dpr ON files (dpr_catg, dpr_type, dpr_tech);
+CREATE INDEX IF NOT EXISTS files_instrume ON files (instrume);
+CREATE INDEX IF NOT EXISTS files_mjd_obs ON files (mjd_obs);
+"""
+
+
+def read_header(path: str) -> Tuple[str, str | None]:
+    """ The primary header of `path` as a string (None if it is not a readable FITS file). Runs in a worker. """
+    try:
+        return path, fits.Header.fromfile(path).tostring()
+    except (OSError, ValueError):
+        return path, None
+
+
+def scan(root: str | Path, pattern: str = '*.fits') -> Iterator[Tuple[str, int, int]]:
+    """ All files matching `pattern` below `root`, with their modification time (in ns) and size """
+    for path in Path(root).rglob(pattern):
+        if path.is_file():
+            stat = path.stat()
+            yield str(path.absolute()), stat.st_mtime_ns, stat.st_size
+
+
+class HeaderIndex:
+    """ The SQLite database with the indexed primary headers """
+
+    def __init__(self, database: str | Path):
+        self.database = str(database)
+        self.connection = sqlite3.connect(self.database)
+        self.connection.executescript(SCHEMA)
+        self.unreadable: List[str] = []         # Files skipped by the last update
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> 'HeaderIndex':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    @staticmethod
+    def _row(path: str, mtime: int, size: int, text: str) -> tuple:
+        header = fits.Header.fromstring(text)
+        values = []
+        for keyword in COLUMNS:
+            value = header.get(keyword)
+            values.append(value.strip() if isinstance(value, str) else value)
+        return path, mtime, size, *values, text
+
+    def update(self, root: str | Path, *, pattern: str = '*.fits', workers: int = None) -> Tuple[int, int]:
+        """
+        Bring the index up to date with the files below `root`.
+        Returns the number of files (re)read and the number of files removed from the index.
+        Files that are not readable FITS files are skipped and listed in `unreadable`.
+        """
+        root = str(Path(root).absolute())
+        known = dict(((path, (mtime, size)) for path, mtime, size in self.connection.execute(
+            "SELECT path, mtime, size FROM files WHERE path LIKE ? ESCAPE '\\'",
+            (root.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + os.sep + '%',))))
+
+        found = {path: (mtime, size) for path, mtime, size in scan(root, pattern)}
+        changed = [path for path, stat in found.items() if known.get(path) != stat]
+        removed = [path for path in known if path not in found]
+
+        rows, self.unreadable = [], []
+        if changed:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for path, text in pool.map(read_header, changed, chunksize=64):
+                    if text is None:
+                        self.unreadable.append(path)
+                    else:
+                        rows.append(self._row(path, *found[path], text))
+
+        placeholders = ', '.join('?' * (len(COLUMNS) + 4))
+        with self.connection:
+            self.connection.executemany(f"INSERT OR REPLACE INTO files VALUES ({placeholders})", rows)
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+        return len(rows), len(removed)
+
+    def query(self, conditions: Dict[str, Any] = None, *, mjd: Tuple[float, float] = None) -> List[str]:
+        """
+        Paths of the files whose indexed keywords have the requested values, e.g. `{'dpr.catg': 'CALIB'}`
+        (EDPS-style or FITS keywords), optionally observed within the `mjd` range (inclusive).
+        """
+        clauses, values = [], []
+        for keyword, value in (conditions or {}).items():
+            clauses.append(f"{self.column(keyword)} = ?")
+            values.append(value)
+        if mjd is not None:
+            clauses.append("mjd_obs BETWEEN ? AND ?")
+            values += list(mjd)
+
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return [path for path, in self.connection.execute(f"SELECT path FROM files{where} ORDER BY path", values)]
+
+    @staticmethod
+    def column(keyword: str) -> str:
+        """ The column of an indexed keyword, given as an EDPS-style (`dpr.catg`) or FITS (`ESO DPR CATG`) keyword """
+        keyword = header_keyword(keyword)
+        try:
+            return COLUMNS[keyword][0]
+        except KeyError as e:
+            raise KeyError(f"Keyword {keyword!r} is not indexed, only {list(COLUMNS)}") from e
+
+    def classify(self, rule: ClassificationRule) -> List[str]:
+        """
+        Files matching a classification rule: by a query if it only uses indexed keywords,
+        otherwise by checking the stored headers of the files matching its indexed conditions.
+        """
+        indexed = {keyword: value for keyword, value in rule.conditions.items()
+                   if header_keyword(keyword) in COLUMNS}
+        files = self.query(indexed)
+        if len(indexed) == len(rule.conditions):
+            return files
+        return [file for file in files if rule.matches(self.header(file))]
+
+    def header(self, path: str | Path) -> fits.Header:
+        """ The stored primary header of a file """
+        row = self.connection.execute("SELECT header FROM files WHERE path = ?", (str(Path(path).absolute()),))
+        if (result := row.fetchone()) is None:
+            raise KeyError(f"File {str(path)!r} is not in the index {self.database!r}")
+        return fits.Header.fromstring(result[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the primary headers of a directory tree of FITS files")
+    parser.add_argument('database', help="SQLite database with the index (created if it does not exist)")
+    parser.add_argument('roots', nargs='*', help="directories to (re)index")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('-w', '--where', action='append', default=[], metavar="KEYWORD=VALUE",
+                        help="list the files with this value of an indexed keyword, e.g. dpr.type=DARK")
+    args = parser.parse_args()
+
+    with HeaderIndex(args.database) as index:
+        for root in args.roots:
+            updated, removed = index.update(root, workers=args.workers)
+            print(f"{root}: {updated} file(s) indexed, {removed} removed, {len(index.unreadable)} unreadable",
+                  file=sys.stderr)
+
+        if args.where:
+            for path in index.query(dict(condition.split('=', 1) for condition in args.where)):
+                print(path)
+
+
+if __name__ == '__main__':
+    main()
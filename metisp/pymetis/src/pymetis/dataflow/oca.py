@@ -0,0 +1,267 @@
+import argparse
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from pymetis.dataflow.rules import header_keyword, header_value
+from pymetis.dataflow.sof import read_headers
+
+"""
+Classification by OCA rules, without Gasgano or other external tools.
+
+OCA rule files (`metisc/oca/metis.oca`, `metisp/reflex/metis_wkf.oca`) consist of classification rules
+
+    if DPR.CATG like "%SCIENCE%" and DPR.TYPE like "%OBJECT%" then
+    {
+      DO.CATG = "RRRECIPE_DOCATG_RAW";
+    }
+
+followed by organisation (`select ...;`) and association (`action NAME { ... }`) statements.
+Only the classification rules are interpreted here; the other statements are parsed over and ignored.
+Every condition is compiled into a Python predicate on a primary header. The rules are applied in order
+and all matching rules assign their keywords, a later rule overriding an earlier one, as the reference tools do.
+
+Dotted OCA keywords are hierarchical ESO keywords (`DPR.CATG` is `ESO DPR CATG`), others are plain FITS keywords.
+A comparison with a missing keyword is false. `like` matches the whole value, `%` standing for any sequence
+of characters.
+"""
+
+Header = Any
+Predicate = Callable[[Header], bool]
+
+
+class OcaSyntaxError(ValueError):
+    pass
+
+
+TOKEN = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<string>"[^"]*")
+  | (?P<number>[+-]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_.\-]*)
+  | (?P<operator>==|!=|<=|>=|<|>|=)
+  | (?P<punctuation>[{}();,])
+""", re.VERBOSE | re.DOTALL)
+
+
+@dataclass(frozen=True)
+class Token:
+    kind: str
+    value: str
+    line: int
+
+
+def tokenize(text: str) -> Iterator[Token]:
+    position, line = 0, 1
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise OcaSyntaxError(f"Unexpected character {text[position]!r} at line {line}")
+        if match.lastgroup != 'space':
+            yield Token(match.lastgroup, match.group(), line)
+        line += match.group().count('\n')
+        position = match.end()
+
+
+def like(pattern: str) -> re.Pattern:
+    """ The regular expression equivalent to an OCA `like` pattern """
+    return re.compile('.*'.join(map(re.escape, pattern.split('%'))), re.DOTALL)
+
+
+def compare(keyword: str, operator: str, expected: Any) -> Predicate:
+    """ A predicate comparing the value of a keyword in a header with a constant """
+    fits_keyword = header_keyword(keyword.lower())
+
+    if operator == 'like':
+        regex = like(str(expected))
+        return lambda header: isinstance(value := header_value(header, fits_keyword), str) \
+            and regex.fullmatch(value) is not None
+
+    def predicate(header) -> bool:
+        value = header_value(header, fits_keyword)
+        if value is None or isinstance(value, str) != isinstance(expected, str):
+            return False
+        match operator:
+            case '==':
+                return value == expected
+            case '!=':
+                return value != expected
+            case '<':
+                return value < expected
+            case '<=':
+                return value <= expected
+            case '>':
+                return value > expected
+            case '>=':
+                return value >= expected
+
+    return predicate
+
+
+@dataclass
+class OcaRule:
+    """ A classification rule: the keywords to assign if the condition holds """
+    condition: Predicate
+    assignments: Dict[str, Any]
+    line: int
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.tokens: List[Token] = list(tokenize(text))
+        self.position = 0
+
+    def peek(self) -> Token | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self) -> Token:
+        if (token := self.peek()) is None:
+            raise OcaSyntaxError("Unexpected end of the rules")
+        self.position += 1
+        return token
+
+    def accept(self, value: str) -> bool:
+        if (token := self.peek()) is not None and token.value.lower() == value:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, value: str) -> Token:
+        token = self.next()
+        if token.value.lower() != value:
+            raise OcaSyntaxError(f"Expected {value!r} at line {token.line}, got {token.value!r}")
+        return token
+
+    def rules(self) -> List[OcaRule]:
+        rules = []
+        while (token := self.peek()) is not None:
+            match token.value.lower():
+                case 'if':
+                    rules.append(self.rule())
+                case 'select':
+                    self.skip_statement()
+                case 'action':
+                    self.skip_block()
+                case _:
+                    raise OcaSyntaxError(f"Unexpected {token.value!r} at line {token.line}")
+        return rules
+
+    def rule(self) -> OcaRule:
+        line = self.expect('if').line
+        condition = self.disjunction()
+        self.expect('then')
+        self.expect('{')
+        assignments = {}
+        while not self.accept('}'):
+            keyword = self.next()
+            self.expect('=')
+            assignments[keyword.value] = self.constant()
+            self.expect(';')
+        return OcaRule(condition, assignments, line)
+
+    def disjunction(self) -> Predicate:
+        terms = [self.conjunction()]
+        while self.accept('or'):
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else lambda header: any(term(header) for term in terms)
+
+    def conjunction(self) -> Predicate:
+        factors = [self.negation()]
+        while self.accept('and'):
+            factors.append(self.negation())
+        return factors[0] if len(factors) == 1 else lambda header: all(factor(header) for factor in factors)
+
+    def negation(self) -> Predicate:
+        if self.accept('not'):
+            operand = self.negation()
+            return lambda header: not operand(header)
+        if self.accept('('):
+            predicate = self.disjunction()
+            self.expect(')')
+            return predicate
+        return self.comparison()
+
+    def comparison(self) -> Predicate:
+        keyword = self.next()
+        if keyword.kind != 'name':
+            raise OcaSyntaxError(f"Expected a keyword at line {keyword.line}, got {keyword.value!r}")
+        operator = self.next()
+        if operator.kind != 'operator' and operator.value.lower() != 'like' or operator.value == '=':
+            raise OcaSyntaxError(f"Expected a comparison at line {operator.line}, got {operator.value!r}")
+        return compare(keyword.value, operator.value.lower(), self.constant())
+
+    def constant(self) -> Any:
+        token = self.next()
+        match token.kind:
+            case 'string':
+                return token.value[1:-1]
+            case 'number':
+                return float(token.value) if any(c in token.value for c in '.eE') else int(token.value)
+            case 'name' if token.value in ('T', 'F'):
+                return token.value == 'T'
+        raise OcaSyntaxError(f"Expected a constant at line {token.line}, got {token.value!r}")
+
+    def skip_statement(self) -> None:
+        while self.next().value != ';':
+            pass
+
+    def skip_block(self) -> None:
+        while self.next().value != '{':
+            pass
+        depth = 1
+        while depth:
+            value = self.next().value
+            depth += (value == '{') - (value == '}')
+
+
+class OcaClassifier:
+    """ The classification rules of an OCA file, compiled into predicates """
+
+    def __init__(self, rules: [OcaRule]):
+        self.rules = rules
+
+    @classmethod
+    def from_text(cls, text: str) -> 'OcaClassifier':
+        return cls(_Parser(text).rules())
+
+    @classmethod
+    def load(cls, filename: str | Path) -> 'OcaClassifier':
+        return cls.from_text(Path(filename).read_text())
+
+    def assignments(self, header) -> Dict[str, Any]:
+        """ All keywords assigned to a file with this primary header (empty if no rule matches) """
+        assigned = {}
+        for rule in self.rules:
+            if rule.condition(header):
+                assigned.update(rule.assignments)
+        return assigned
+
+    def classify(self, header) -> str | None:
+        """ The `DO.CATG` of a file with this primary header """
+        return self.assignments(header).get('DO.CATG')
+
+    def classify_files(self, files: Iterable[str | Path], *, workers: int = None) -> Iterator[Tuple[str, str | None]]:
+        """ The `DO.CATG` of every file, from its primary header only, read on a thread pool """
+        for file, header in read_headers(files, workers=workers):
+            yield file, self.classify(header)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify FITS files by OCA rules, printing a set of frames")
+    parser.add_argument('rules', help="OCA rule file, e.g. metisc/oca/metis.oca")
+    parser.add_argument('inputs', nargs='+', help="input FITS files or directories to search for them")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of threads reading the headers")
+    args = parser.parse_args()
+
+    files = []
+    for inp in map(Path, args.inputs):
+        files += sorted(inp.rglob('*.fits')) if inp.is_dir() else [inp]
+
+    for file, category in OcaClassifier.load(args.rules).classify_files(files, workers=args.workers):
+        if category is not None:
+            print(f"{file} {category}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Tuple
+
+
+def header_keyword(keyword: str) -> str:
+    """
+    Translate an EDPS-style keyword to the corresponding FITS header keyword.
+    EDPS uses lowercase dotted names: `instrume` is a plain FITS keyword,
+    while `dpr.catg` stands for the hierarchical `ESO DPR CATG`.
+    """
+    if '.' in keyword:
+        return "ESO " + keyword.replace('.', ' ').upper()
+    else:
+        return keyword.upper()
+
+
+def header_value(header, keyword: str) -> Any:
+    """ The value of a FITS keyword as compared by the rules: strings without padding, None if missing """
+    value = header.get(keyword)
+    return value.strip() if isinstance(value, str) else value
+
+
+@dataclass(frozen=True)
+class ClassificationRule:
+    """
+    A classification rule as declared by `edps.classification_rule`:
+    a frame gets the `tag` if every keyword in `conditions` has exactly the requested value.
+    """
+    tag: str
+    conditions: Dict[str, Any] = field(default_factory=dict, hash=False)
+
+    def matches(self, header) -> bool:
+        """ Check whether a primary header (anything with a dict-like `get`) satisfies this rule """
+        for keyword, expected in self.conditions.items():
+            if header_value(header, header_keyword(keyword)) != expected:
+                return False
+
+        return True
+
+
+class CompiledClassifier:
+    """
+    Classification rules compiled into lookup tables. Rules testing the same set of keywords (in practice
+    all of them test `instrume` and `dpr.catg/type/tech`) share a table mapping the required values to the tags,
+    so a header is classified by one lookup per set of keywords instead of testing every condition of every rule.
+    The result is exactly that of testing the rules one by one, in the same order.
+    """
+
+    def __init__(self, rules: Iterable[ClassificationRule]):
+        # FITS keywords tested -> (required values -> (rule position, tag))
+        self.tables: Dict[Tuple[str, ...], Dict[tuple, List[Tuple[int, str]]]] = {}
+
+        for position, rule in enumerate(rules):
+            keywords = sorted(rule.conditions)
+            fits_keywords = tuple(header_keyword(keyword) for keyword in keywords)
+            values = tuple(rule.conditions[keyword] for keyword in keywords)
+            self.tables.setdefault(fits_keywords, {}).setdefault(values, []).append((position, rule.tag))
+
+    def classify(self, header) -> [str]:
+        """ Tags of all rules matching a primary header (anything with a dict-like `get`) """
+        matches = []
+        for keywords, table in self.tables.items():
+            matches += table.get(tuple(header_value(header, keyword) for keyword in keywords), [])
+        return [tag for _, tag in sorted(matches)]
@@ -0,0 +1,147 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from astropy.io import fits
+
+from pymetis.dataflow.rules import CompiledClassifier, header_keyword, header_value
+from pymetis.dataflow.workflow import Workflow, DataSource, Task
+
+"""
+Preparation of set-of-frames (SOF) files without EDPS.
+
+Files are classified by the compiled rules of a workflow (see `rules.CompiledClassifier`), using only their
+primary headers read on a thread pool, and sorted into one SOF per task of the workflow and detector
+(and group of match keywords), ready to be run with `esorex` or `pyesorex`. The products of upstream tasks
+are not known at this point: they are listed as comments, to be filled in by hand.
+"""
+
+# Detectors by the last component of `ESO DPR TECH`, e.g. `IMAGE,LM`
+DETECTORS: Dict[str, str] = {
+    'LM': '2RG',
+    'N': 'GEO',
+    'IFU': 'IFU',
+    'LMS': 'IFU',
+}
+
+
+def detector(header) -> str | None:
+    """ The detector a raw frame was taken with, as used in the recipe names and tags """
+    technique = header.get('ESO DPR TECH')
+    if not isinstance(technique, str):
+        return None
+    return DETECTORS.get(technique.strip().split(',')[-1].strip())
+
+
+def read_headers(files: Iterable[str | Path], *, workers: int = None) -> Iterable[Tuple[str, fits.Header]]:
+    """ The primary headers of `files`, read (and nothing else) on a thread pool, in order """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        files = list(map(str, files))
+        yield from zip(files, pool.map(fits.Header.fromfile, files))
+
+
+def read_sof(filename: str | Path) -> [Tuple[str, str]]:
+    """ Read a set-of-frames file: one frame per line, the file name and the tag separated by whitespace """
+    with open(filename) as sof:
+        return [(os.path.expandvars(tokens[0]), tokens[1])
+                for tokens in (line.split() for line in sof) if len(tokens) >= 2 and not tokens[0].startswith('#')]
+
+
+def write_sof(filename: str | Path, frames: Iterable[Tuple[str, str]], comments: [str] = ()) -> Path:
+    """ Write a set-of-frames file, readable by `read_sof` """
+    filename = Path(filename)
+    with open(filename, 'w') as sof:
+        for comment in comments:
+            sof.write(f"# {comment}\n")
+        for file, tag in frames:
+            sof.write(f"{file} {tag}\n")
+    return filename
+
+
+class SofBuilder:
+    """ Classifies raw files by the rules of a workflow and sorts them into SOF files, one per job """
+
+    def __init__(self, workflow: Workflow):
+        self.workflow = workflow
+        self.classifier = CompiledClassifier(workflow.rules.values())
+        self.headers: Dict[str, fits.Header] = {}       # Primary headers of classified files
+        self.classified: Dict[str, List[str]] = {}      # Tag -> files
+
+    def classify(self, files: Iterable[str | Path], *, workers: int = None) -> Dict[str, List[str]]:
+        """ Read the primary headers of `files` and sort them by the tags of the classification rules """
+        for file, header in read_headers(files, workers=workers):
+            tags = self.classifier.classify(header)
+            if tags:
+                self.headers[file] = header
+            for tag in tags:
+                self.classified.setdefault(tag, []).append(file)
+        return self.classified
+
+    def _frames(self, source: DataSource, det: str | None) -> List[Tuple[str, str]]:
+        return [(file, tag) for tag in source.tags for file in self.classified.get(tag, [])
+                if det is None or detector(self.headers[file]) in (det, None)]
+
+    def jobs(self, task: Task) -> Dict[Tuple[str | None, tuple], List[Tuple[str, str]]]:
+        """ The main input frames of a task on raw data, split by detector and match keywords """
+        source = task.main_input
+        groups: Dict[Tuple[str | None, tuple], List[Tuple[str, str]]] = {}
+        for file, tag in self._frames(source, None):
+            header = self.headers[file]
+            key = detector(header), tuple(header_value(header, header_keyword(k)) for k in source.match_keywords)
+            groups.setdefault(key, []).append((file, tag))
+        return groups
+
+    def write(self, output_dir: str | Path) -> List[Path]:
+        """ Write the SOF files of all tasks with raw main inputs, named `<recipe>_<detector>[_<n>].sof` """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        written = []
+
+        for task in self.workflow.tasks.values():
+            if not isinstance(task.main_input, DataSource):
+                continue
+
+            jobs = self.jobs(task)
+            detectors = [det for det, _ in jobs]
+            numbers: Dict[str | None, int] = {}
+            for (det, key), frames in jobs.items():
+                name = f"{task.recipe}_{det}" if det is not None else task.recipe
+                if detectors.count(det) > 1:
+                    numbers[det] = numbers.get(det, 0) + 1
+                    name = f"{name}_{numbers[det]}"
+
+                comments = [f"Task {task.name}, match keywords {dict(zip(task.main_input.match_keywords, key))}"]
+                for source in task.associated_inputs:
+                    match source:
+                        case DataSource():
+                            frames = frames + self._frames(source, det)
+                        case Task():
+                            comments.append(f"Requires the products of task {source.name} (recipe {source.recipe})")
+
+                written.append(write_sof(output_dir / f"{name}.sof", frames, comments))
+
+        return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify raw files by the rules of a workflow and write SOF files")
+    parser.add_argument('workflow', help="workflow definition, e.g. workflows/metis/metis_lm_img_wkf.py")
+    parser.add_argument('inputs', nargs='+', help="input FITS files or directories to search for them")
+    parser.add_argument('-o', '--output-dir', default='.', help="directory for the SOF files")
+    parser.add_argument('-j', '--workers', type=int, default=None, help="number of threads reading the headers")
+    args = parser.parse_args()
+
+    files = []
+    for inp in map(Path, args.inputs):
+        files += sorted(inp.rglob('*.fits')) if inp.is_dir() else [inp]
+
+    builder = SofBuilder(Workflow.load(args.workflow))
+    builder.classify(files, workers=args.workers)
+    for filename in builder.write(args.output_dir):
+        print(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import ast
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List
+
+from pymetis.dataflow.rules import ClassificationRule, CompiledClassifier
+
+"""
+An EDPS-free description of a workflow.
+
+EDPS workflows (see `metisp/workflows/metis/`) are Python modules built from calls to `classification_rule`,
+`data_source` and `task`. Importing such a module requires the `edps` package and the EDPS service.
+Instead, we read the module source with `ast` and rebuild an equivalent plain description:
+classification rules, data sources and tasks with their inputs and recipes.
+
+Only the builder methods that matter for local execution are interpreted, all other `with_*` options
+(job processing, filters, ...) are accepted and ignored.
+"""
+
+
+@dataclass
+class DataSource:
+    """ A set of raw frames selected by one or more classification rules """
+    name: str = None
+    rules: [ClassificationRule] = field(default_factory=list)
+    match_keywords: [str] = field(default_factory=list)
+
+    @property
+    def tags(self) -> [str]:
+        return [rule.tag for rule in self.rules]
+
+
+@dataclass
+class Task:
+    """ A processing step: a recipe run on its main input, with products of other tasks associated """
+    name: str
+    recipe: str = None
+    main_input: 'DataSource | Task' = None
+    associated_inputs: ['DataSource | Task'] = field(default_factory=list)
+    meta_targets: [str] = field(default_factory=list)
+
+    @property
+    def inputs(self) -> ['DataSource | Task']:
+        return [self.main_input, *self.associated_inputs]
+
+    @property
+    def dependencies(self) -> ['Task']:
+        """ Tasks whose products have to be available before this one can run """
+        return [inp for inp in self.inputs if isinstance(inp, Task)]
+
+
+class _Builder:
+    """ Common behaviour of builders: unknown `with_*` options are accepted and ignored """
+    def __getattr__(self, name: str):
+        if name.startswith('with_'):
+            return lambda *args, **kwargs: self
+        raise AttributeError(f"{self.__class__.__qualname__} does not support {name!r}")
+
+
+class _DataSourceBuilder(_Builder):
+    def __init__(self):
+        self.source = DataSource()
+
+    def with_classification_rule(self, rule: ClassificationRule) -> '_DataSourceBuilder':
+        self.source.rules.append(rule)
+        return self
+
+    def with_match_keywords(self, keywords: [str]) -> '_DataSourceBuilder':
+        self.source.match_keywords = list(keywords)
+        return self
+
+    def build(self) -> DataSource:
+        return self.source
+
+
+class _TaskBuilder(_Builder):
+    def __init__(self, name: str):
+        self.task = Task(name)
+
+    def with_recipe(self, recipe: str) -> '_TaskBuilder':
+        self.task.recipe = recipe
+        return self
+
+    def with_main_input(self, source: DataSource | Task) -> '_TaskBuilder':
+        self.task.main_input = source
+        return self
+
+    def with_associated_input(self, source: DataSource | Task, *args, **kwargs) -> '_TaskBuilder':
+        self.task.associated_inputs.append(source)
+        return self
+
+    def with_meta_targets(self, targets: [str]) -> '_TaskBuilder':
+        self.task.meta_targets = list(targets)
+        return self
+
+    def build(self) -> Task:
+        if self.task.recipe is None:
+            self.task.recipe = self.task.name
+        return self.task
+
+
+class Workflow:
+    """
+    Classification rules, data sources and tasks of one workflow, keyed by their (variable or task) names.
+    """
+    _constructors = {
+        'classification_rule': lambda tag, conditions=None: ClassificationRule(tag, dict(conditions or {})),
+        'data_source': lambda *args, **kwargs: _DataSourceBuilder(),
+        'task': lambda name, *args, **kwargs: _TaskBuilder(name),
+    }
+
+    def __init__(self):
+        self.rules: Dict[str, ClassificationRule] = {}
+        self.data_sources: Dict[str, DataSource] = {}
+        self.tasks: Dict[str, Task] = {}
+        self._classifier: CompiledClassifier | None = None
+
+    @classmethod
+    def load(cls, filename: str | Path) -> 'Workflow':
+        """ Read a workflow module without importing it """
+        filename = Path(filename)
+        workflow = cls()
+        workflow._read(ast.parse(filename.read_text(), filename=str(filename)))
+        return workflow
+
+    def _read(self, module: ast.Module) -> None:
+        namespace: Dict[str, Any] = {}
+
+        for statement in module.body:
+            if not isinstance(statement, ast.Assign):
+                continue
+
+            value = self._evaluate(statement.value, namespace)
+
+            for target in statement.targets:
+                if isinstance(target, ast.Name):
+                    namespace[target.id] = value
+                    self._register(target.id, value)
+
+    def _register(self, name: str, value: Any) -> None:
+        match value:
+            case ClassificationRule():
+                self.rules[name] = value
+                self._classifier = None
+            case DataSource():
+                value.name = value.name or name
+                self.data_sources[name] = value
+            case Task():
+                self.tasks[value.name] = value
+
+    def _evaluate(self, node: ast.expr, namespace: Dict[str, Any]) -> Any:
+        """ Evaluate the small subset of Python that workflow definitions are written in """
+        match node:
+            case ast.Constant() | ast.List() | ast.Tuple() | ast.Dict() | ast.Set():
+                try:
+                    return ast.literal_eval(node)
+                except ValueError:
+                    pass
+
+                match node:
+                    case ast.List() | ast.Tuple() | ast.Set():
+                        return [self._evaluate(element, namespace) for element in node.elts]
+                    case ast.Dict():
+                        return {self._evaluate(key, namespace): self._evaluate(value, namespace)
+                                for key, value in zip(node.keys, node.values)}
+            case ast.Name():
+                # Names we do not know (such as EDPS meta targets `SCIENCE` or `QC1_CALIB`) stand for themselves
+                return namespace.get(node.id, node.id)
+            case ast.Call():
+                args = [self._evaluate(arg, namespace) for arg in node.args]
+                kwargs = {kw.arg: self._evaluate(kw.value, namespace) for kw in node.keywords}
+
+                match node.func:
+                    case ast.Name(id=name) if name in self._constructors:
+                        return self._constructors[name](*args, **kwargs)
+                    case ast.Attribute(value=receiver, attr=method):
+                        return getattr(self._evaluate(receiver, namespace), method)(*args, **kwargs)
+
+        raise ValueError(f"Unsupported construct in workflow definition at line {node.lineno}: {ast.dump(node)}")
+
+    def classify(self, header) -> [str]:
+        """ Return the tags of all classification rules matching a primary header """
+        if self._classifier is None:
+            self._classifier = CompiledClassifier(self.rules.values())
+        return self._classifier.classify(header)
+
+    def required_tasks(self, targets: [str] = None) -> [Task]:
+        """
+        Return the tasks needed to produce `targets` (task names or meta targets), in topological order.
+        With no targets, all tasks are returned.
+        """
+        if targets:
+            selected = [task for task in self.tasks.values()
+                        if task.name in targets or set(task.meta_targets) & set(targets)]
+            if not selected:
+                raise KeyError(f"No task matches the targets {targets}")
+        else:
+            selected = list(self.tasks.values())
+
+        ordered: List[Task] = []
+        done: set = set()
+        visiting: set = set()
+
+        def visit(task: Task) -> None:
+            if task.name in done:
+                return
+            if task.name in visiting:
+                raise ValueError(f"Workflow contains a cycle through task {task.name!r}")
+
+            visiting.add(task.name)
+            for dependency in task.dependencies:
+                visit(dependency)
+            visiting.remove(task.name)
+            done.add(task.name)
+            ordered.append(task)
+
+        for task in selected:
+            visit(task)
+
+        return ordered
@@ -2,4 +2,5 @@ from .inputset import PipelineInputSet
 
 from .base import PipelineInput, SinglePipelineInput, MultiplePipelineInput
 
-from .common import RawInput, MasterDarkInput, MasterFlatInput, LinearityInput, PersistenceMapInput, GainMapInput
\ No newline at end of file
+from .common import (RawInput, MasterDarkInput, MasterFlatInput, LinearityInput, PersistenceMapInput, GainMapInput,
+                     WavecalInput, DistortionTableInput)
\ No newline at end of file
@@ -64,3 +64,15 @@ class GainMapInput(SinglePipelineInput):
     _title: str = "gain map"
     _tags = ["GAIN_MAP_{det}"]
     _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
+
+
+class WavecalInput(SinglePipelineInput):
+    _title: str = "wavelength calibration"
+    _tags: [str] = ["IFU_WAVECAL"]
+    _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
+
+
+class DistortionTableInput(SinglePipelineInput):
+    _title: str = "distortion table"
+    _tags: [str] = ["IFU_DISTORTION_TABLE"]
+    _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
@@ -1,7 +1,10 @@
 from abc import ABC
+from typing import Literal
 
 import cpl.ui
 
+from pymetis.algorithms.expression import Expression, lazy
+from pymetis.algorithms.stacking import Planes
 from pymetis.inputs.common import MasterDarkInput
 from pymetis.prefabricates.rawimage import RawImageProcessor
 
@@ -27,3 +30,19 @@ class DarkImageProcessor(RawImageProcessor, ABC):
             super().__init__(frameset)
             self.master_dark = self.MasterDarkInput(frameset, det=self.detector)
             self.inputs += [self.master_dark]
+
+    def load_master_dark(self) -> Planes:
+        return self.load_planes(self.inputset.master_dark.frame)
+
+    def dark_subtraction(self,
+                         combined: Planes | Expression,
+                         method: Literal['add'] | Literal['average'] | Literal['median'] | Literal['sigclip'],
+                         count: int,
+                         master_dark: Planes = None) -> Expression:
+        """
+        The combined frames minus the master dark (scaled appropriately for the stacking method),
+        as a lazy expression to be extended with further calibrations or evaluated.
+        """
+        if master_dark is None:
+            master_dark = self.load_master_dark()
+        return lazy(combined) - lazy(master_dark) * self.calibration_scale(method, count)
@@ -56,28 +56,32 @@ class MetisBaseImgFlatImpl(DarkImageProcessor, ABC):
         """
         Do the actual processing of the images.
         Here, it means loading the input images and a master dark,
-        then subtracting the master dark from every flat,
-        and finally combining them into a master flat.
+        combining the flats into a master flat with error and quality planes,
+        and finally subtracting the master dark from the combination.
         """
         # TODO: Detect detector
         # TODO: Twilight
 
-        raw_images = self.load_raw_images()
-        master_dark = cpl.core.Image.load(self.inputset.master_dark.frame.file, extension=0)
-
-        for raw_image in raw_images:
-            Msg.debug(self.__class__.__qualname__, f"Subtracting image {raw_image}")
-            raw_image.subtract(master_dark)
-
         # Combine the images in the image list using the image stacking option requested by the user.
         method = self.parameters[f"{self.name}.stacking.method"].value
 
         # TODO: preprocessing steps like persistence correction / nonlinearity (or not) should come here
 
+        # The raw flats are streamed and combined, the master dark is subtracted once from the combined planes
+        # (scaled appropriately for the stacking method), which also propagates its error and DQ planes.
+        plan = self.memory_plan(method)
+        with self.tile_pool(plan) as pool:
+            planes = self.combine_images(self.iterate_raw_images(), method, backend=self.backend, plan=plan, pool=pool)
+            Msg.debug(self.__class__.__qualname__, f"Subtracting the master dark")
+            self.dark_subtraction(planes, method, len(self.inputset.raw.frameset)).evaluate(
+                out=planes, tile_pixels=plan.tile_pixels, pool=pool)
+
         header = cpl.core.PropertyList.load(self.inputset.raw.frameset[0].file, 0)
-        combined_image = self.combine_images(self.load_raw_images(), method)
+
+        product = self.Product.from_planes(self, header, planes)
+        product.add_qc(self.qc.parameters(combined=planes.data))
 
         self.products = {
-            self.name.upper(): self.Product(self, header, combined_image),
+            self.name.upper(): product,
         }
-        return self.products
\ No newline at end of file
+        return self.products
@@ -1,14 +1,38 @@
+import contextlib
+import os
+import tempfile
 from abc import ABC
-from typing import Literal
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Literal, Tuple, TypeVar
 
 import cpl
+import numpy as np
 from cpl.core import Msg
 
+from pymetis.algorithms import background
+from pymetis.algorithms.accumulator import WelfordAccumulator
+from pymetis.algorithms.backend import ArrayBackend, NumpyBackend
+from pymetis.algorithms.backend_cpl import CplBackend
+from pymetis.algorithms.images import as_array, as_image
+from pymetis.algorithms.mosaic import ChipLayout, map_chips
+from pymetis.algorithms.parallel import TilePool
+from pymetis.algorithms.planner import MiB, FrameGeometry, MemoryPlan, plan_memory
+from pymetis.algorithms.qc import QcEngine
+from pymetis.algorithms.refpix import ReferencePixelCorrector
+from pymetis.algorithms.stacking import Planes, combine_planes
 from pymetis.base.impl import MetisRecipeImpl
 from pymetis.base.input import RecipeInput
 from pymetis.inputs import PipelineInputSet
 from pymetis.inputs.common import RawInput
 
+T = TypeVar('T')
+
+# Compute backends that can be selected by the `backend` parameter of a recipe
+BACKENDS: Dict[str, type] = {backend.name: backend for backend in [NumpyBackend, CplBackend]}
+
+# Detectors with reference pixels: the HAWAII-2RG arrays of the LM imager and of the IFU
+REFERENCE_PIXEL_DETECTORS = ('2RG', 'IFU')
+
 
 class RawImageProcessor(MetisRecipeImpl, ABC):
     """
@@ -22,9 +46,111 @@ class RawImageProcessor(MetisRecipeImpl, ABC):
 
         def __init__(self, frameset: cpl.ui.FrameSet):
             self.raw = self.RawInput(frameset, det=self.detector)
-            self.inputs += [self.raw]
+            # A new list: `+=` would extend the class attribute shared by all input sets
+            self.inputs = self.inputs + [self.raw]
             super().__init__(frameset)
 
+    def __init__(self, recipe: 'MetisRecipe') -> None:
+        super().__init__(recipe)
+        self.qc = QcEngine()
+        self._layout: ChipLayout | None = None
+        self._uncorrected_shapes = set()
+
+    @property
+    def layout(self) -> ChipLayout:
+        """ The chips of the detector array, as found in the first raw frame """
+        if self._layout is None:
+            self._layout = ChipLayout.from_file(self.inputset.raw.frameset[0].file)
+        return self._layout
+
+    @property
+    def reference_correction(self) -> ReferencePixelCorrector | None:
+        """
+        The reference pixel correction of the raw frames: for the HAWAII-2RG detectors,
+        unless switched off by the `refpix` parameter of the recipe
+        """
+        if self.inputset.detector not in REFERENCE_PIXEL_DETECTORS:
+            return None
+        try:
+            enabled = self.parameters[f"{self.name}.refpix"].value
+        except KeyError:
+            enabled = True
+        return ReferencePixelCorrector() if enabled else None
+
+    def read_raw_chip(self, frame: cpl.ui.Frame, chip: int) -> np.ndarray:
+        """ The pixels of a single chip of a raw frame, corrected with the reference pixels if the detector has them """
+        data = self.frame_cache.data(frame.file, self.layout.extensions[chip])
+        if (corrector := self.reference_correction) is None:
+            return data
+        if not corrector.applies(data.shape):
+            if data.shape not in self._uncorrected_shapes:
+                self._uncorrected_shapes.add(data.shape)
+                Msg.warning(self.__class__.__qualname__,
+                            f"Chips of shape {data.shape} cannot be corrected with their reference pixels")
+            return data
+        return corrector.correct(data)
+
+    def load_raw_image(self, frame: cpl.ui.Frame) -> cpl.core.Image:
+        """ A single raw frame, with the chips of a multi-chip detector assembled into a mosaic """
+        if len(self.layout) == 1:
+            return as_image(self.read_raw_chip(frame, 0))
+        return as_image(self.layout.assemble([self.read_raw_chip(frame, chip) for chip in range(len(self.layout))]))
+
+    def iterate_raw_images(self) -> Iterator[cpl.core.Image]:
+        """
+        Load the raw images one at a time, as determined by the tags.
+        Use this whenever the processing can be done frame by frame: only one raw image is held in memory.
+        Every image is also fed to the QC engine on its way through.
+        """
+        for idx, frame in enumerate(self.inputset.raw.frameset):
+            Msg.info(self.__class__.__qualname__, f"Processing input frame #{idx}: {frame.file!r}...")
+            Msg.debug(self.__class__.__qualname__, f"Loading input image {frame.file}")
+            image = self.load_raw_image(frame)
+            self.qc.feed(as_array(image))
+            yield image
+
+    def iterate_raw_chip(self, chip: int, qc: QcEngine) -> Iterator[np.ndarray]:
+        """ The images of a single chip of all raw frames, one at a time, fed to the chip's own QC engine """
+        for frame in self.inputset.raw.frameset:
+            image = self.read_raw_chip(frame, chip)
+            qc.feed(image)
+            yield image
+
+    def process_chips(self, function: Callable[[int, Iterator[np.ndarray]], T], *, workers: int = None) -> List[T]:
+        """
+        Process every chip of the raw frames independently and in parallel (on at most `workers` threads):
+        `function` gets the index of the chip and an iterator over its images, and should use only the chip's
+        own region of the calibrations (see `ChipLayout.split`). The results are returned in extension order.
+        """
+        count = len(self.layout)
+        engines = [QcEngine(stride=self.qc.stride, channels=self.qc.channels, hot_sigma=self.qc.hot_sigma)
+                   for _ in range(count)]
+        Msg.info(self.__class__.__qualname__, f"Processing {count} chips in extensions {self.layout.extensions}")
+
+        results = map_chips(lambda chip: function(chip, self.iterate_raw_chip(chip, engines[chip])), count, workers)
+        self.qc = QcEngine.merge(engines)
+        return results
+
+    def raw_beam(self, frame: cpl.ui.Frame) -> int | None:
+        """ The chop/nod beam (+1 or -1) of a raw frame, None if it was neither chopped nor nodded """
+        header = self.load_header(frame)
+        positions = {}
+        for keyword in background.BEAM_KEYWORDS:
+            try:
+                positions[keyword] = header[keyword].value
+            except KeyError:
+                pass
+        return background.beam(positions)
+
+    def iterate_raw_beams(self) -> Iterator[Tuple[int | None, cpl.core.Image]]:
+        """
+        Like `iterate_raw_images`, but also yield the chop/nod beam of every image,
+        to be fed to a `background.PairSubtractor`.
+        """
+        frames = self.inputset.raw.frameset
+        for frame, image in zip(frames, self.iterate_raw_images()):
+            yield self.raw_beam(frame), image
+
     def load_raw_images(self) -> cpl.core.ImageList:
         """
         Always load a set of raw images, as determined by the tags.
@@ -33,42 +159,121 @@ class RawImageProcessor(MetisRecipeImpl, ABC):
         """
         output = cpl.core.ImageList()
 
-        for idx, frame in enumerate(self.inputset.raw.frameset):
-            Msg.info(self.__class__.__qualname__, f"Processing input frame #{idx}: {frame.file!r}...")
-
+        for image in self.iterate_raw_images():
             # Append the loaded image to an image list
-            Msg.debug(self.__class__.__qualname__, f"Loading input image {frame.file}")
-            output.append(cpl.core.Image.load(frame.file, extension=1))
+            output.append(image)
 
         return output
 
+    @property
+    def backend(self) -> ArrayBackend:
+        """ The compute backend selected by the `backend` parameter of the recipe (NumPy if it has none) """
+        try:
+            name = self.parameters[f"{self.name}.backend"].value
+        except KeyError:
+            name = NumpyBackend.name
+
+        try:
+            return BACKENDS[name]()
+        except KeyError as e:
+            raise ValueError(f"Unknown compute backend {name!r}, expected one of {list(BACKENDS)}") from e
+
+    @property
+    def max_memory(self) -> int | None:
+        """ The memory budget in bytes, from the `max_memory` parameter of the recipe in MiB (None if unlimited) """
+        try:
+            megabytes = self.parameters[f"{self.name}.max_memory"].value
+        except KeyError:
+            return None
+        return megabytes * MiB if megabytes > 0 else None
+
+    @property
+    def processes(self) -> int:
+        """ Worker processes for the stacked methods and the calibration, from the `processes` parameter (0: all) """
+        try:
+            processes = self.parameters[f"{self.name}.processes"].value
+        except KeyError:
+            return 1
+        return processes if processes > 0 else os.cpu_count() or 1
+
+    def memory_plan(self,
+                    method: Literal['add'] | Literal['average'] | Literal['median'] | Literal['sigclip'],
+                    *,
+                    per_chip: bool = False) -> MemoryPlan:
+        """
+        Plan the combine and calibration stages within the memory budget, from the headers of the raw frames only,
+        and report the plan in the log before anything is loaded.
+        """
+        geometry = FrameGeometry.from_files([frame.file for frame in self.inputset.raw.frameset])
+        plan = plan_memory(geometry, method, self.max_memory, per_chip=per_chip, processes=self.processes)
+        for line in plan.report():
+            Msg.info(self.__class__.__qualname__, f"Memory plan: {line}")
+        if not plan.within_budget:
+            Msg.warning(self.__class__.__qualname__, f"Memory budget of {plan.budget / MiB:.0f} MiB will be exceeded")
+        return plan
+
+    @staticmethod
+    @contextlib.contextmanager
+    def stack_buffer(plan: MemoryPlan | None, shape: Tuple[int, int]) -> Iterator[np.ndarray | None]:
+        """ A memory-mapped temporary file for the stack of all frames, if the plan requires one (None otherwise) """
+        if plan is None or not plan.spill:
+            yield None
+            return
+
+        with tempfile.TemporaryDirectory(prefix="pymetis-stack-") as directory:
+            yield np.lib.format.open_memmap(Path(directory) / "stack.npy", mode='w+', dtype=np.float64,
+                                            shape=(plan.geometry.count, *shape))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def tile_pool(plan: MemoryPlan | None) -> Iterator[TilePool | None]:
+        """ A pool of worker processes for bands of rows, if the plan has more than one process (None otherwise) """
+        if plan is None or plan.processes <= 1:
+            yield None
+            return
+
+        with TilePool(plan.processes) as pool:
+            yield pool
+
     @classmethod
     def combine_images(cls,
-                       images: cpl.core.ImageList,
-                       method: Literal['add'] | Literal['average'] | Literal['median']):
+                       images: Iterable[cpl.core.Image],
+                       method: Literal['add'] | Literal['average'] | Literal['median'] | Literal['sigclip'],
+                       *,
+                       accumulator: WelfordAccumulator = None,
+                       backend: ArrayBackend = None,
+                       plan: MemoryPlan = None,
+                       pool: TilePool = None) -> Planes:
         """
-        Basic helper method to combine images using one of `add`, `average` or `median`.
+        Basic helper method to combine images using one of `add`, `average`, `median` or `sigclip`.
         Probably not a universal panacea, but it recurs often enough to warrant being here.
+
+        Produces the data, error and data quality planes in a single pass over `images`.
+        If `images` is a generator (such as `iterate_raw_images()`), only one image is held in memory at a time,
+        except for `median` and `sigclip`, which need the full stack anyway and collapse it with the `backend`,
+        in bands of rows and from a memory-mapped stack if the memory `plan` says so, and on the worker processes
+        of the `pool` if one is given (see `tile_pool`).
         """
         Msg.info(cls.__qualname__, f"Combining images using method {method!r}")
-        combined_image = None
-        match method:
-            case "add":
-                for idx, image in enumerate(images):
-                    if idx == 0:
-                        combined_image = image
-                    else:
-                        combined_image.add(image)
-            case "average":
-                combined_image = images.collapse_create()
-            case "median":
-                combined_image = images.collapse_median_create()
-            case _:
-                Msg.error(cls.__qualname__,
-                          f"Got unknown stacking method {method!r}. Stopping right here!")
-                raise ValueError(f"Unknown stacking method {method!r}")
-
-        return combined_image
+
+        if method not in ["add", "average", "median", "sigclip"]:
+            Msg.error(cls.__qualname__,
+                      f"Got unknown stacking method {method!r}. Stopping right here!")
+            raise ValueError(f"Unknown stacking method {method!r}")
+
+        with cls.stack_buffer(plan, plan.geometry.layout.shape if plan else None) as stack:
+            return combine_planes((as_array(image) for image in images), method,
+                                  accumulator=accumulator, backend=backend,
+                                  rows=plan.combine_rows if plan else None, stack=stack, pool=pool)
+
+    @staticmethod
+    def calibration_scale(method: Literal['add'] | Literal['average'] | Literal['median'], count: int) -> float:
+        """
+        Additive calibrations (such as a dark) are applied to the combined image rather than to every frame.
+        This is equivalent for all stacking methods, provided that the calibration is scaled by the number
+        of frames for `add`.
+        """
+        return count if method == "add" else 1
 
     @property
     def detector_name(self) -> str:
@@ -1,36 +1,115 @@
 import cpl
+import numpy as np
 from cpl.core import Msg
 from typing import Dict
 
+from pymetis.algorithms import fluxcal, telluric
 from pymetis.base.impl import MetisRecipe, MetisRecipeImpl
-from pymetis.base.input import RecipeInput
-from pymetis.base.product import PipelineProduct
-from pymetis.inputs import SinglePipelineInput, PipelineInputSet
+from pymetis.base.product import PipelineProduct, CubeProduct
+from pymetis.inputs import SinglePipelineInput, MultiplePipelineInput, PipelineInputSet
 
 
 class MetisIfuCalibrateImpl(MetisRecipeImpl):
+    @property
+    def detector_name(self) -> str | None:
+        return "2RG"
+
     class InputSet(PipelineInputSet):
-        detector = '2RG'
+        class SciReducedInput(MultiplePipelineInput):
+            _title: str = "reduced science cube"
+            _tags: [str] = ["IFU_SCI_REDUCED", "IFU_SCI_COMBINED"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.RAW      # TODO What group is this really?
+
+        class TelluricInput(SinglePipelineInput):
+            _title: str = "telluric correction"
+            _tags: [str] = ["IFU_TELLURIC"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
+
+        class FluxcalInput(SinglePipelineInput):
+            _title: str = "flux calibration table"
+            _tags: [str] = ["FLUXCAL_TAB"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
+
+        class QuantumEfficiencyInput(SinglePipelineInput):
+            _title: str = "quantum efficiency"
+            _tags: [str] = ["QUANTUM_EFFICIENCY"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
+            _required: bool = False
 
         def __init__(self, frameset: cpl.ui.FrameSet):
+            self.sci_reduced = self.SciReducedInput(frameset)
+            self.telluric = self.TelluricInput(frameset)
+            self.fluxcal = self.FluxcalInput(frameset)
+            self.quantum_efficiency = self.QuantumEfficiencyInput(frameset)
+            self.inputs = [self.sci_reduced, self.telluric, self.fluxcal, self.quantum_efficiency]
             super().__init__(frameset)
-            self.sci_reduced: SinglePipelineInput(frameset, tags=["IFU_SCI_REDUCED"])
-            self.telluric: SinglePipelineInput(frameset, tags=["IFU_TELLURIC"])
-            self.fluxcal: SinglePipelineInput(frameset, tags=["FLUXCAL_TAB"])
 
-            self.inputs += [self.sci_reduced, self.telluric, self.fluxcal]
-
-    class ProductSciCubeCalibrated(PipelineProduct):
+    class ProductSciCubeCalibrated(CubeProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
         category = rf"IFU_SCI_CUBE_CALIBRATED"
+        tag = category
+
+        def __init__(self, *args, number: int, **kwargs):
+            self.number = number
+            super().__init__(*args, **kwargs)
+
+        @property
+        def output_file_name(self) -> str:
+            """ One product per input cube, numbered in the order of the inputs """
+            return f"{self.category}_{self.number:03d}.fits"
+
+    def load_response(self, chip: str | None) -> fluxcal.ResponseCache:
+        """
+        The response from the FLUXCAL_TAB, completed by the throughput of detector `chip` if the
+        quantum efficiency is provided and describes it
+        """
+        table = self.load_table(self.inputset.fluxcal.frame)
+        throughput = None
+
+        if (frame := self.inputset.quantum_efficiency.frame) is not None:
+            try:
+                throughput = fluxcal.read_throughput(frame.file, chip)
+            except KeyError as e:
+                Msg.warning(self.__class__.__qualname__,
+                            f"Not using the quantum efficiency, the response is only known where the standard star "
+                            f"measured it: {e}")
+
+        return fluxcal.ResponseCache(table['WAVE'], table['CONVERSION'], throughput)
 
     def process_images(self) -> Dict[str, PipelineProduct]:
-        # self.correct_telluric()
-        # self.apply_fluxcal()
+        """
+        Correct every science cube for the telluric absorption and convert it to Jy.
+        The response is resampled once for every distinct wavelength grid, then applied as a single multiplication.
+        """
+        frames = self.inputset.sci_reduced.frameset
+        transmission = self.load_table(self.inputset.telluric.frame)
+        minimum = self.parameters["metis_ifu_calibrate.min_transmission"].value
+        responses = None
+
+        self.products = {}
+        for number, frame in enumerate(frames):
+            Msg.info(self.__class__.__qualname__, f"Calibrating cube {frame.file!r}")
+            header = self.load_header(frame)
+            grid = self.load_grid(frame)
+            if responses is None:
+                try:
+                    chip = header["ESO DET CHIP NAME"].value
+                except KeyError:
+                    chip = None
+                responses = self.load_response(chip)
+
+            cube = self.load_planes(frame)
+            cube = telluric.correct(cube, grid.wavelengths,
+                                    np.asarray(transmission['WAVE']), np.asarray(transmission['TRANSMISSION']),
+                                    np.asarray(transmission['ERR']), minimum=minimum)
+            cube = fluxcal.apply(cube, responses.response(grid.header()))
+
+            product = self.ProductSciCubeCalibrated.from_planes(self, header, cube, number=number)
+            product.properties.append(cpl.core.Property("BUNIT", cpl.core.Type.STRING, "Jy"))
+            self.products[product.output_file_name] = product
 
-        self.products = {
-            product.category: product()
-            for product in [self.ProductSciCubeCalibrated(header)]
-        }
+        Msg.info(self.__class__.__qualname__,
+                 f"Calibrated {len(frames)} cubes on {len(responses)} distinct wavelength grids")
         return self.products
 
 
@@ -42,8 +121,18 @@ class MetisIfuCalibrate(MetisRecipe):
     _copyright = "GPL-3.0-or-later"
     _synopsis = "Calibrate IFU science data"
     _description = (
-        "Currently just a skeleton prototype."
+        "Correct the reduced science cubes for the telluric absorption and convert them to Jy\n"
+        + "using the response measured on a standard star, completed by the detector quantum efficiency\n"
+        + "if a QUANTUM_EFFICIENCY table describes the detector. The table in metis-calib/spec only describes\n"
+        + "VISIR detectors and cannot be used for METIS."
     )
 
-    parameters = cpl.ui.ParameterList([])
+    parameters = cpl.ui.ParameterList([
+        cpl.ui.ParameterValue(
+            name="metis_ifu_calibrate.min_transmission",
+            context="metis_ifu_calibrate",
+            description="Transmission below which the telluric correction is flagged as unreliable",
+            default=0.1,
+        ),
+    ])
     implementation_class = MetisIfuCalibrateImpl
@@ -1,81 +1,119 @@
 import cpl
 from cpl.core import Msg
-from typing import Dict, Literal
+from typing import Dict
 
+from pymetis.algorithms import distortion
+from pymetis.algorithms.distortion import PinholeTable
+from pymetis.algorithms.stacking import QualityFlag
 from pymetis.base.impl import MetisRecipe
+from pymetis.base.product import PipelineProduct, TableProduct
+from pymetis.inputs import SinglePipelineInput
+from pymetis.inputs.common import RawInput, MasterDarkInput
 from pymetis.prefabricates.darkimage import DarkImageProcessor
-from pymetis.mixins import PersistenceInputMixin, BadpixMapInputMixin, LinearityInputMixin, GainMapInputMixin
-from pymetis.mixins.detectors import Detector2rgMixin
-from pymetis.base.product import PipelineProduct
 
 
 class MetisIfuDistortionImpl(DarkImageProcessor):
-    target: Literal["SCI"] | Literal["STD"] = None
-
-    #class Input(Detector2rgMixin, PersistenceInputMixin, LinearityInputMixin, GainMapInputMixin, BadpixMapInputMixin,
-    #            DarkImageProcessor.Input):
-    #    tags_raw = ["IFU_DISTORTION_RAW"]
-    #    tags_dark = ["MASTER_DARK_IFU"]
-    #    tag_pinhole = "PINHOLE_TABLE"
-
-    #    def __init__(self, frameset: cpl.ui.FrameSet):
-    #        self.pinhole_table: cpl.ui.Frame | None = None
-    #        super().__init__(frameset)
-
-    #    def categorize_frame(self, frame: cpl.ui.Frame) -> None:
-    #        match frame.tag:
-    #            case self.tag_pinhole:
-    #                frame.group = cpl.ui.Frame.FrameGroup.CALIB
-    #                self.pinhole_table = self._override_with_warning(self.pinhole_table, frame,
-    #                                                                 origin=self.__class__.__qualname__,
-    #                                                                 title="pinhole table")
-    #                Msg.debug(self.__class__.__qualname__, f"Got a pinhole table frame: {frame.file}.")
-    #            case _:
-    #                super().categorize_frame(frame)
-
-    #    def verify(self):
-    #        """
-    #        This Input is just a simple composition of mixins and does not require any further action
-    #        """
-    #        pass
-
-    class ProductSciCubeCalibrated(PipelineProduct):
-        category = rf"IFU_SCI_CUBE_CALIBRATED"
+    class InputSet(DarkImageProcessor.InputSet):
+        """
+            The Input class for the IFU distortion calibration: exposures of the pinhole mask,
+            a master dark and the table describing the pinholes of the mask.
+        """
+        detector = "IFU"
 
-    def process_images(self) -> Dict[str, PipelineProduct]:
-        masterdark_image = cpl.core.Image.load(self.inputset.master_dark.file)
-        raw_images = cpl.core.ImageList()
+        class RawInput(RawInput):
+            _tags = ["IFU_DISTORTION_RAW"]
+
+        MasterDarkInput = MasterDarkInput
 
-        for idx, frame in enumerate(self.inputset.raw.frameset):
-            Msg.info(self.name, f"Loading raw image {frame.file}")
+        class PinholeTableInput(SinglePipelineInput):
+            _title: str = "pinhole table"
+            _tags: [str] = ["PINHOLE_TABLE"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
 
-            if idx == 0:
-                self.header = cpl.core.PropertyList.load(frame.file, 0)
+        def __init__(self, frameset: cpl.ui.FrameSet):
+            super().__init__(frameset)
+            self.pinhole_table = self.PinholeTableInput(frameset)
 
-            raw_image = cpl.core.Image.load(frame.file, extension=1)
-            raw_image.subtract(masterdark_image)
-            raw_images.append(raw_image)
+            self.inputs += [self.pinhole_table]
 
-        method = self.parameters["metis_ifu_calibrate.stacking.method"].value
-        combined_image = self.combine_images(raw_images, method)
+    class ProductDistortionTable(TableProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
+        category = rf"IFU_DISTORTION_TABLE"
+        tag = category
+
+    def process_images(self) -> Dict[str, PipelineProduct]:
+        """
+        Combine the pinhole exposures, subtract the master dark, measure the positions of all pinhole spots
+        and fit the position along the slices.
+        """
+        method = self.parameters["metis_ifu_distortion.stacking.method"].value
+        count = len(self.inputset.raw.frameset)
+
+        combined = self.combine_images(self.iterate_raw_images(), method)
+        self.dark_subtraction(combined, method, count).evaluate(out=combined)
+
+        pinholes = PinholeTable.load(self.inputset.pinhole_table.frame.file)
+        result = distortion.solve(
+            combined.data, pinholes,
+            degree=self.parameters["metis_ifu_distortion.degree"].value,
+            threshold=self.parameters["metis_ifu_distortion.threshold"].value,
+            min_pixels=self.parameters["metis_ifu_distortion.min_pixels"].value,
+            mask=(combined.quality & ~QualityFlag.NO_ERROR) != 0,
+        )
+        Msg.info(self.__class__.__qualname__,
+                 f"Fitted the distortion of {len(result.table.slices)} slices to {result.spots} spots "
+                 f"of {len(pinholes.slices)} pinholes, RMS {result.rms:.3g} spaxels")
+
+        header = cpl.core.PropertyList.load(self.inputset.raw.frameset[0].file, 0)
+        product = self.ProductDistortionTable(self, header, result.table.to_hdu())
+        product.add_qc(self.qc.parameters() | {
+            "QC DISTORT NSPOTS": result.spots,
+            "QC DISTORT RMS": result.rms,
+        })
 
         self.products = {
-            product.category: product(self, self.header, combined_image, detector_name=self.detector_name)
-            for product in [self.ProductSciCubeCalibrated]
+            'IFU_DISTORTION_TABLE': product,
         }
         return self.products
 
 
 class MetisIfuDistortion(MetisRecipe):
-    _name = "metis_ifu_calibrate"
+    _name = "metis_ifu_distortion"
     _version = "0.1"
     _author = "Martin Baláž"
     _email = "martin.balaz@univie.ac.at"
     _copyright = "GPL-3.0-or-later"
-    _synopsis = "Reduce raw science exposures of the IFU."
+    _synopsis = "Derive the distortion table of the IFU from pinhole mask exposures"
     _description = (
-        "Currently just a skeleton prototype."
+        "Detect the spots of all pinholes in the dark-subtracted pinhole mask exposure and fit\n"
+        + "the position along the slice for every slice of the IFU."
     )
 
-    parameters = cpl.ui.ParameterList([])
+    parameters = cpl.ui.ParameterList([
+        cpl.ui.ParameterEnum(
+            name="metis_ifu_distortion.stacking.method",
+            context="metis_ifu_distortion",
+            description="Name of the method used to combine the pinhole exposures",
+            default="average",
+            alternatives=("add", "average", "median"),
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_distortion.degree",
+            context="metis_ifu_distortion",
+            description="Degree of the distortion polynomials",
+            default=2,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_distortion.threshold",
+            context="metis_ifu_distortion",
+            description="Detection threshold of the spots, in robust standard deviations of the background",
+            default=5.0,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_distortion.min_pixels",
+            context="metis_ifu_distortion",
+            description="Minimum number of pixels of a spot",
+            default=3,
+        ),
+    ])
     implementation_class = MetisIfuDistortionImpl
@@ -1,11 +1,14 @@
+import os
+import tempfile
+
 import cpl
 from cpl.core import Msg
 from typing import Dict
 
+from pymetis.algorithms.coadd import CubeGrid, CubeCoadder
 from pymetis.base.impl import MetisRecipe, MetisRecipeImpl
-from pymetis.base.input import RecipeInput
-from pymetis.base.product import PipelineProduct
-from pymetis.recipes.ifu.metis_ifu_distortion import MetisIfuDistortionImpl
+from pymetis.base.product import PipelineProduct, StreamedCubeProduct
+from pymetis.inputs import PipelineInputSet, MultiplePipelineInput
 
 
 class MetisIfuPostprocessImpl(MetisRecipeImpl):
@@ -13,41 +16,56 @@ class MetisIfuPostprocessImpl(MetisRecipeImpl):
     def detector_name(self) -> str | None:
         return "2RG"
 
-    class Input(RecipeInput):
-        tag_sci_cube_calibrated = "IFU_SCI_CUBE_CALIBRATED"
-        detector_name = '2RG'
+    class InputSet(PipelineInputSet):
+        class SciCubeCalibratedInput(MultiplePipelineInput):
+            _title: str = "calibrated science cube"
+            _tags: [str] = ["IFU_SCI_CUBE_CALIBRATED"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.RAW      # TODO What group is this really?
 
         def __init__(self, frameset: cpl.ui.FrameSet):
-            self.sci_cube_calibrated: cpl.ui.Frame | None = None
+            self.sci_cube_calibrated = self.SciCubeCalibratedInput(frameset)
+            self.inputs = [self.sci_cube_calibrated]
             super().__init__(frameset)
 
-        def categorize_frame(self, frame: cpl.ui.Frame) -> None:
-            match frame.tag:
-                case self.tag_sci_cube_calibrated:
-                    frame.group = cpl.ui.Frame.FrameGroup.RAW # TODO What group is this really?
-                    self.sci_cube_calibrated = self._override_with_warning(self.sci_cube_calibrated, frame,
-                                                                           origin=self.__class__.__qualname__,
-                                                                           title="sci cube calibrated")
-                    Msg.debug(self.__class__.__qualname__, f"Got sci cube calibrated frame: {frame.file}.")
-                case _:
-                    super().categorize_frame(frame)
-
-        def verify(self) -> None:
-            pass
-
-    class ProductSciCoadd(PipelineProduct):
+    class ProductSciCoadd(StreamedCubeProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
         category = rf"IFU_SCI_COADD"
+        tag = category
+
+    def determine_output_grid(self) -> CubeGrid:
+        """ The grid enclosing all input cubes, determined from their headers only """
+        grids = [self.load_grid(frame) for frame in self.inputset.sci_cube_calibrated.frameset]
+        grid = CubeGrid.enclosing(grids)
+        Msg.info(self.__class__.__qualname__, f"Coadding {len(grids)} cubes onto a grid of shape {grid.shape}")
+        return grid
 
     def process_images(self) -> Dict[str, PipelineProduct]:
-        # self.determine_output_grid()
-        # self.resample_cubes()
-        # self.coadd_cubes()
+        """
+        Resample all calibrated cubes onto a common grid and coadd them.
+        The cubes are loaded and accumulated one at a time into memory-mapped cubes in a scratch directory,
+        and the coadded cube is normalized and written to the product chunk by chunk.
+        """
+        grid = self.determine_output_grid()
+        weighting = self.parameters["metis_ifu_postprocess.weighting"].value
+        header = self.load_header(self.inputset.sci_cube_calibrated.frameset[0])
+
+        with tempfile.TemporaryDirectory(prefix="coadd-", dir=os.getcwd()) as scratch:
+            coadder = CubeCoadder(grid, scratch, weighting=weighting)
+
+            for frame in self.inputset.sci_cube_calibrated.frameset:
+                Msg.info(self.__class__.__qualname__, f"Resampling cube {frame.file!r}")
+                coadder.add(self.load_planes(frame), self.load_grid(frame))
+
+            product = self.ProductSciCoadd(self, header, grid.shape, wcs=grid.wcs_keywords())
+            with product.open() as cube:
+                for window, planes in coadder.chunks():
+                    cube.write(window, planes)
 
-        header = cpl.core.PropertyList.load(self.input.sci_cube_calibrated.file, 0)
-        coadded_image = cpl.core.Image()
+            # The scratch files can only be removed once they are no longer mapped
+            del coadder
 
         self.products = {
-            'IFU_SCI_COADD': self.ProductSciCoadd(self, header, coadded_image, detector_name=self.detector_name),
+            'IFU_SCI_COADD': product,
         }
         return self.products
 
@@ -58,10 +76,18 @@ class MetisIfuPostprocess(MetisRecipe):
     _author = "Martin Baláž"
     _email = "martin.balaz@univie.ac.at"
     _copyright = "GPL-3.0-or-later"
-    _synopsis = "Calibrate IFU science data"
+    _synopsis = "Coadd calibrated IFU science cubes"
     _description = (
-        "Currently just a skeleton prototype."
+        "Resample the calibrated science cubes onto a common grid enclosing all of them and coadd them."
     )
 
-    parameters = cpl.ui.ParameterList([])
-    implementation_class = MetisIfuDistortionImpl
+    parameters = cpl.ui.ParameterList([
+        cpl.ui.ParameterEnum(
+            name="metis_ifu_postprocess.weighting",
+            context="metis_ifu_postprocess",
+            description="Weighting of the voxels of the input cubes",
+            default="uniform",
+            alternatives=("uniform", "variance"),
+        ),
+    ])
+    implementation_class = MetisIfuPostprocessImpl
@@ -1,156 +1,252 @@
 import cpl
+import numpy as np
 from cpl.core import Msg
-from typing import Any, Dict, Literal
-
-from pymetis.base.impl import MetisRecipeImpl, MetisRecipe
-from pymetis.base.product import PipelineProduct
-from pymetis.inputs.base import SinglePipelineInput
-from pymetis.inputs.common import RawInput, MasterDarkInput, LinearityInput, PersistenceMapInput
+from typing import Dict, Iterable, Iterator, List, Literal, Tuple
+
+from pymetis.algorithms.background import PairSubtractor
+from pymetis.algorithms.images import as_array
+from pymetis.algorithms.planner import DEFAULT_TILE_PIXELS, MemoryPlan
+from pymetis.algorithms.rectification import RectificationOperator
+from pymetis.algorithms.stacking import Planes, combine_planes
+from pymetis.base.impl import MetisRecipe
+from pymetis.base.product import PipelineProduct, TargetProduct, CubeProduct
+from pymetis.inputs.common import (RawInput, MasterDarkInput, LinearityInput, PersistenceMapInput,
+                                   WavecalInput, DistortionTableInput)
 from pymetis.prefabricates.darkimage import DarkImageProcessor
 
-from pymetis.prefabricates.rawimage import RawImageProcessor
-from pymetis.mixins import MasterDarkInputMixin, LinearityInputMixin, PersistenceInputMixin
-from pymetis.mixins.detectors import Detector2rgMixin
+# Stacking methods that commute with the (linear) rectification: the mosaic can be combined first
+LINEAR_METHODS = ("add", "average")
 
 
-class MetisIfuReduceImpl(MetisRecipeImpl):
+class MetisIfuReduceImpl(DarkImageProcessor):
     target: Literal["SCI"] | Literal["STD"] = None
 
     class InputSet(DarkImageProcessor.InputSet):
         """
-            The Input class for Metis IFU reduction. Utilizes InputMixins:
-
-            - Detector2rgMixin, which handles the 2RG detector and substitudes '2RG' for 'det' in tags
-            - LinearityInputMixin, which
+            The Input class for Metis IFU reduction: raw science or standard star exposures,
+            a master dark, and the geometric calibrations of the IFU (distortion table and wavelength calibration).
         """
         detector = "IFU"
 
         class RawInput(RawInput):
             _tags = ["IFU_SCI_RAW", "IFU_STD_RAW"]
 
-
-        # We know which files to handle and how, but we need to specify how to identify them: define tags_something
-        # for every mixin and the class itself.
-        tags_raw = ["IFU_SCI_RAW", "IFU_STD_RAW"]
-        tags_dark = ["MASTER_DARK_IFU"]
-        tags_wavecal = ["IFU_WAVECAL"]
+        MasterDarkInput = MasterDarkInput
 
         def __init__(self, frameset: cpl.ui.FrameSet):
             """
-                Here we also define all input frames specific for this recipe, except those handled by mixins.
+                Here we also define all input frames specific for this recipe, except those handled by the parents.
             """
-            self.raw = RawInput(frameset, det=self)
-            self.linearity_map = LinearityInput(frameset)
-            self.persistence_map = PersistenceMapInput(frameset)
-            self.master_dark = MasterDarkInput(frameset, det="IFU")
-            self.ifu_wavecal = SinglePipelineInput(frameset, tags=["IFU_WAVECAL"])
-            self.ifu_distortion_table = SinglePipelineInput(frameset, tags=["IFU_DISTORTION_TABLE"])
             super().__init__(frameset)
+            self.linearity = LinearityInput(frameset, det=self.detector)
+            self.persistence = PersistenceMapInput(frameset)
+            self.wavecal = WavecalInput(frameset)
+            self.distortion_table = DistortionTableInput(frameset)
 
-        def categorize_frame(self, frame: cpl.ui.Frame) -> None:
-            match frame.tag:
-                case x if x in self.tags_wavecal:
-                    self.ifu_wavecal = frame
-                    Msg.debug(self.__class__.__qualname__,
-                              f"Got frame {frame.file!r} with unexpected tag {frame.tag!r}, ignoring it")
-
-        def verify(self):
-            """
-                During verification, we see if there is the correct number of frames.
-                Note that mixins and parent methods are called last.
-            """
-            self._verify_frame_present(self.ifu_wavecal, "IFU wavelength calibration")
-            super().verify()
+            self.inputs += [self.linearity, self.persistence, self.wavecal, self.distortion_table]
 
-    class ProductReduced(PipelineProduct):
-        @property
-        def category(self) -> str:
-            return rf"IFU_{self.target}_REDUCED"
+    # Only the combined cube is produced (and the background when nodding): the exposures are combined
+    # as they are read, so there is no reduced image or cube of a single exposure to save.
+    class ProductBackground(TargetProduct):
+        level = cpl.ui.Frame.FrameLevel.INTERMEDIATE
+        frame_type = cpl.ui.Frame.FrameType.IMAGE
 
-    class ProductBackground(PipelineProduct):
         @property
         def category(self) -> str:
             return rf"IFU_{self.target}_BACKGROUND"
 
-    class ProductReducedCube(PipelineProduct):
         @property
-        def category(self) -> str:
-            return rf"IFU_{self.target}_REDUCED_CUBE"
+        def tag(self) -> str:
+            return self.category
+
+    class ProductCombined(TargetProduct, CubeProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
 
-    class ProductCombined(PipelineProduct):
         @property
         def category(self) -> str:
             return rf"IFU_{self.target}_COMBINED"
 
+        @property
+        def tag(self) -> str:
+            return self.category
+
+    def determine_target(self) -> Literal["SCI"] | Literal["STD"]:
+        """ Science or standard star, as determined from the tags of the raw frames (which must not be mixed) """
+        targets = {frame.tag.split('_')[1] for frame in self.inputset.raw.frameset}
+        if len(targets) != 1:
+            raise ValueError(f"Raw frames of a single target expected, got {sorted(targets)}")
+        return targets.pop()
+
+    def pointing(self, header: cpl.core.PropertyList) -> Tuple[float, float]:
+        """ The pointing (RA, DEC) in degrees from the raw header, or (0, 0) with a warning if it is not recorded """
+        try:
+            return header["RA"].value, header["DEC"].value
+        except KeyError:
+            Msg.warning(self.__class__.__qualname__,
+                        "The raw header does not record the pointing (RA, DEC), the cube WCS is centred on (0, 0)")
+            return 0.0, 0.0
+
+    def load_rectification(self) -> RectificationOperator:
+        """ The rectification operator for the provided distortion table and wavelength calibration """
+        cache_dir = self.parameters["metis_ifu_reduce.cache_dir"].value or None
+        operator, cached = RectificationOperator.cached(self.inputset.distortion_table.frame.file,
+                                                        self.inputset.wavecal.frame.file,
+                                                        cache_dir)
+        Msg.info(self.__class__.__qualname__,
+                 f"{'Loaded cached' if cached else 'Built'} rectification operator for cubes of shape "
+                 f"{operator.cube_shape} ({operator.matrix.nnz} non-zero weights)")
+        return operator
+
+    def is_nodded(self) -> bool:
+        """ Whether the raw frames are to be pair-subtracted, as requested or as recorded in their headers """
+        match self.parameters["metis_ifu_reduce.background"].value:
+            case "nodding":
+                return True
+            case "none":
+                return False
+            case _:
+                return self.raw_beam(self.inputset.raw.frameset[0]) is not None
+
+    def reduce_chip(self,
+                    chip: int,
+                    images: Iterator[np.ndarray],
+                    master_dark: Planes,
+                    beams: [int] = None,
+                    plan: MemoryPlan = None) -> Tuple[Planes, PairSubtractor | None]:
+        """
+        Combine the images of a single chip and subtract the chip's region of the master dark.
+        If the `beams` of the frames are given, the images are subtracted pairwise first: the dark cancels
+        in the differences, and is only subtracted from the background estimate.
+        The stack is collapsed and calibrated in tiles as determined by the memory `plan`.
+        """
+        method = self.parameters["metis_ifu_reduce.stacking.method"].value
+        dark = self.layout.split(master_dark, chip)
+        rows = plan.combine_rows if plan else None
+
+        with self.stack_buffer(plan, dark.data.shape) as stack:
+            if beams is None:
+                combined = combine_planes(images, method, rows=rows, stack=stack)
+                count = len(self.inputset.raw.frameset)
+                tile_pixels = plan.tile_pixels if plan else DEFAULT_TILE_PIXELS
+                return self.dark_subtraction(combined, method, count, dark).evaluate(out=combined,
+                                                                                     tile_pixels=tile_pixels), None
+
+            pairs = PairSubtractor()
+            return combine_planes(pairs.subtract(zip(beams, images)), method, rows=rows, stack=stack), pairs
+
+    def combine_chips(self,
+                      method: Literal['add'] | Literal['average'],
+                      master_dark: Planes,
+                      beams: [int] = None) -> Tuple[Planes, Planes | None, List[PairSubtractor]]:
+        """
+        Combine the raw exposures chip by chip, in parallel, and assemble the combined mosaic.
+        Returns the mosaic, the mosaic of the nodding background (None if not nodded) and the pair subtractors.
+        """
+        plan = self.memory_plan(method, per_chip=True)
+        chips = self.process_chips(lambda chip, images: self.reduce_chip(chip, images, master_dark, beams, plan),
+                                   workers=plan.workers)
+        combined = self.layout.assemble_planes([planes for planes, _ in chips])
+        if beams is None:
+            return combined, None, []
+
+        subtractors = [subtractor for _, subtractor in chips]
+        backgrounds = [Planes.from_accumulator(subtractor.background, "average") for subtractor in subtractors]
+        return combined, self.layout.assemble_planes(backgrounds), subtractors
+
+    @staticmethod
+    def rectify_exposures(operator: RectificationOperator,
+                          images: Iterable[np.ndarray],
+                          quality: np.ndarray) -> Iterator[np.ndarray]:
+        """ The cube of every image, reconstructed as it is read, with the DQ flags of the cubes ORed into `quality` """
+        for image in images:
+            cube = operator.apply(Planes.from_data(image))
+            quality |= cube.quality
+            yield cube.data
+
+    def combine_exposures(self,
+                          operator: RectificationOperator,
+                          method: Literal['median'],
+                          master_dark: Planes,
+                          beams: [int] = None) -> Tuple[Planes, Planes | None, List[PairSubtractor]]:
+        """
+        Reconstruct the cube of every raw exposure (or of every nod difference) and combine the cubes.
+        The master dark is rectified once and subtracted from the combined cube:
+        the median of the differences from a constant frame is the difference from the median.
+        Returns the cube, the mosaic of the nodding background (None if not nodded) and the pair subtractor.
+        """
+        plan = self.memory_plan(method)
+        quality = np.zeros(operator.cube_shape, dtype=np.int32)
+        images = (as_array(image) for image in self.iterate_raw_images())
+
+        with self.stack_buffer(plan, operator.cube_shape) as stack:
+            if beams is None:
+                cube = combine_planes(self.rectify_exposures(operator, images, quality), method, stack=stack)
+                count = len(self.inputset.raw.frameset)
+                cube.subtract(operator.apply(master_dark), scale=self.calibration_scale(method, count))
+                cube.quality |= quality
+                return cube, None, []
+
+            pairs = PairSubtractor()
+            cube = combine_planes(self.rectify_exposures(operator, pairs.subtract(zip(beams, images)), quality),
+                                  method, stack=stack)
+            cube.quality |= quality
+            return cube, Planes.from_accumulator(pairs.background, "average"), [pairs]
+
+    @staticmethod
+    def nod_counts(subtractors: List[PairSubtractor]) -> Tuple[int, int]:
+        """ The numbers of nod pairs and of frames left without a partner, which have to agree for all chips """
+        counts = {(subtractor.pairs, subtractor.unpaired) for subtractor in subtractors}
+        if len(counts) != 1:
+            raise ValueError(f"The chips were not paired alike, got (pairs, unpaired) of {sorted(counts)}")
+        return counts.pop()
 
     def process_images(self) -> Dict[str, PipelineProduct]:
-        # do something... a lot of something
-
-        self.products = {
-            rf'IFU_{self.target}_REDUCED': self.ProductReduced(),
-            rf'IFU_{self.target}_BACKGROUND': self.ProductBackground(),
-            rf'IFU_{self.target}_REDUCED_CUBE': self.ProductReducedCube(),
-            rf'IFU_{self.target}_COMBINED': self.ProductCombined(),
-        }
-        return self.products
-
-    def run(self, frameset: cpl.ui.FrameSet, settings: Dict[str, Any]) -> cpl.ui.FrameSet:
-        """
-        This is obsolete: move functionality to process_iamges
-        and abolish this function (it is calle dbut from root class)
         """
-        for idx, frame in enumerate(self.raw_frames):
-            Msg.info(self.name, f"Processing {frame.file!r}...")
-
-            if idx == 0:
-                self.header = cpl.core.PropertyList.load(frame.file, 0)
-
-            Msg.debug(self.name, "Loading image.")
-            raw_image = cpl.core.Image.load(frame.file, extension=1)
-
-            # Subtract dark
-            raw_image.subtract(masterdark_image)
-
-            # Insert the processed image in an image list.
-            # Of course there is also an append() method available.
-            raw_images.insert(idx, raw_image)
-
-        # Combine the images in the image list using the image stacking
-        # option requested by the user.
-
-        combined_image = None
-        # TODO: preprocessing steps like persistence correction / nonlinearity (or not)
-        processed_images = raw_images
-        match method:
-            case "add":
-                for idx, image in enumerate(processed_images):
-                    if idx == 0:
-                        combined_image = image
-                    else:
-                        combined_image.add(image)
-            case "average":
-                combined_image = processed_images.collapse_create()
-            case "median":
-                combined_image = processed_images.collapse_median_create()
-            case _:
-                Msg.error(
-                    self.name,
-                    f"Got unknown stacking method {method!r}. Stopping right here!",
-                )
-                # Since we did not create a product we need to return an empty
-                # ui.FrameSet object. The result frameset product_frames will do,
-                # it is still empty here!
-                return self.product_frames
+        Combine the raw exposures, reconstruct the cube and save it as IFU_{target}_COMBINED.
 
+        For `add` and `average`, the chips of the detector array are combined and dark-subtracted independently,
+        in parallel, then assembled into a single mosaic. Since the rectification is linear and commutes with these
+        methods, it is then only needed once: a single sparse matrix-vector product, which also propagates
+        the error and DQ planes into the cube.
 
-    @property
-    def detector_name(self) -> str:
-        """ All IFU recipes work with the HAWAII2RG array """
-        return "2RG"
+        The `median` does not commute with the rectification, so every exposure is rectified first
+        and the median of the cubes is taken, with the DQ flags of every cube.
 
-    @property
-    def output_file_name(self) -> str:
-        return f"IFU_SCI_REDUCED"
+        Nodded exposures are subtracted pairwise as they are read, and the differences are combined instead.
+        """
+        self.target = self.determine_target()
+        frames = self.inputset.raw.frameset
+
+        operator = self.load_rectification()
+        master_dark = self.load_master_dark()
+        header = cpl.core.PropertyList.load(frames[0].file, 0)
+        beams = [self.raw_beam(frame) for frame in frames] if self.is_nodded() else None
+        method = self.parameters["metis_ifu_reduce.stacking.method"].value
+        self.products = {}
+
+        if method in LINEAR_METHODS:
+            combined, background, subtractors = self.combine_chips(method, master_dark, beams)
+            cube = operator.apply(combined)
+        else:
+            cube, background, subtractors = self.combine_exposures(operator, method, master_dark, beams)
+
+        if beams is not None:
+            pairs, unpaired = self.nod_counts(subtractors)
+            Msg.info(self.__class__.__qualname__,
+                     f"Subtracted {pairs} nod pairs, {unpaired} frames left without a partner")
+
+            sky = background.subtract(master_dark)
+            product = self.ProductBackground.from_planes(self, header, sky, target=self.target)
+            product.add_qc({"QC IFU BKG NPAIRS": pairs, "QC IFU BKG MED": float(np.nanmedian(sky.data))})
+            self.products[rf'IFU_{self.target}_BACKGROUND'] = product
+
+        wcs = operator.wcs(*self.pointing(header))
+
+        product = self.ProductCombined.from_planes(self, header, cube, target=self.target, wcs=wcs)
+        product.add_qc(self.qc.parameters())
+        self.products[rf'IFU_{self.target}_COMBINED'] = product
+
+        return self.products
 
 
 class MetisIfuReduce(MetisRecipe):
@@ -160,7 +256,8 @@ class MetisIfuReduce(MetisRecipe):
     _email = "martin.balaz@univie.ac.at"
     _synopsis = "Reduce raw science exposures of the IFU."
     _description = (
-        "Currently just a skeleton prototype."
+        "Dark-subtract the raw IFU exposures, reconstruct the data cubes using the distortion table\n"
+        + "and the wavelength calibration, and combine them."
     )
 
     parameters = cpl.ui.ParameterList([
@@ -171,5 +268,39 @@ class MetisIfuReduce(MetisRecipe):
             default=False,
             alternatives=(True, False),
         ),
+        cpl.ui.ParameterEnum(
+            name="metis_ifu_reduce.stacking.method",
+            context="metis_ifu_reduce",
+            description="Name of the method used to combine the reconstructed cubes",
+            default="average",
+            alternatives=("add", "average", "median"),
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_reduce.cache_dir",
+            context="metis_ifu_reduce",
+            description="Directory for precomputed rectification operators "
+                        "(default: $PYMETIS_CACHE_DIR, no cache if not set)",
+            default="",
+        ),
+        cpl.ui.ParameterEnum(
+            name="metis_ifu_reduce.background",
+            context="metis_ifu_reduce",
+            description="Background subtraction: pairwise subtraction of nodded exposures, none, "
+                        "or auto (nodding if the raw headers record the nod position)",
+            default="auto",
+            alternatives=("auto", "nodding", "none"),
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_reduce.max_memory",
+            context="metis_ifu_reduce",
+            description="Memory budget in MiB for planning the tile sizes and workers (0: unlimited)",
+            default=0,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_reduce.refpix",
+            context="metis_ifu_reduce",
+            description="Correct the raw frames with the reference pixels of the detector",
+            default=True,
+        ),
     ])
     implementation_class = MetisIfuReduceImpl
@@ -1,10 +1,14 @@
 import cpl
+import numpy as np
+from astropy.table import Table
 from cpl.core import Msg
-from typing import Dict
+from typing import Dict, Tuple
 
+from pymetis.algorithms import telluric
+from pymetis.algorithms.stacking import Planes
 from pymetis.base.impl import MetisRecipe, MetisRecipeImpl
-from pymetis.base.input import RecipeInput
-from pymetis.base.product import PipelineProduct
+from pymetis.base.product import PipelineProduct, TableProduct
+from pymetis.inputs import PipelineInputSet, SinglePipelineInput
 
 
 class MetisIfuTelluricImpl(MetisRecipeImpl):
@@ -12,44 +16,88 @@ class MetisIfuTelluricImpl(MetisRecipeImpl):
     def detector_name(self) -> str | None:
         return "2RG"
 
-    class Input(RecipeInput):
-        tags_combined = ["IFU_SCI_COMBINED", "IFU_STD_COMBINED"]
-        detector_name = '2RG'
+    class InputSet(PipelineInputSet):
+        class StdCombinedInput(SinglePipelineInput):
+            _title: str = "standard star combined cube"
+            _tags: [str] = ["IFU_STD_COMBINED"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.RAW     # TODO What group is this really?
+
+        class SciCombinedInput(SinglePipelineInput):
+            _title: str = "science combined cube"
+            _tags: [str] = ["IFU_SCI_COMBINED"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.RAW
+            _required: bool = False
 
         def __init__(self, frameset: cpl.ui.FrameSet):
-            self.combined: cpl.ui.Frame | None = None
+            self.std_combined = self.StdCombinedInput(frameset)
+            self.sci_combined = self.SciCombinedInput(frameset)
+            self.inputs = [self.std_combined, self.sci_combined]
             super().__init__(frameset)
 
-        def categorize_frame(self, frame: cpl.ui.Frame) -> None:
-            if frame.tag in self.tags_combined:
-                frame.group = cpl.ui.Frame.FrameGroup.RAW # TODO What group is this really?
-                self.combined = self._override_with_warning(self.combined, frame,
-                                                            origin=self.__class__.__qualname__,
-                                                            title="combined")
-                Msg.debug(self.__class__.__qualname__, f"Got IFU science combined frame: {frame.file}.")
-            else:
-                super().categorize_frame(frame)
-
-        def verify(self) -> None:
-            pass
-
-    class ProductSciReduced1D(PipelineProduct):
+    class ProductSciReduced1D(TableProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
         category = rf"IFU_SCI_REDUCED_1D"
+        tag = category
 
-    class ProductIfuTelluric(PipelineProduct):
+    class ProductIfuTelluric(TableProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
         category = "IFU_TELLURIC"
+        tag = category
 
-    class ProductFluxcalTab(PipelineProduct):
+    class ProductFluxcalTab(TableProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
         category = "FLUXCAL_TAB"
+        tag = category
+
+    def derive_telluric(self, std: Planes, wavelengths: np.ndarray) -> Tuple[Table, np.ndarray]:
+        """
+        Extract the standard star spectrum and divide it by its continuum to get the transmission.
+        Returns the transmission table and the continuum.
+        """
+        spectrum, error, aperture = telluric.extract_spectrum(std)
+        Msg.info(self.__class__.__qualname__, f"Extracted the standard star from {aperture.sum()} spaxels")
+
+        transmission, transmission_error, continuum = telluric.transmission(wavelengths, spectrum, error)
+        return Table({'WAVE': wavelengths, 'TRANSMISSION': transmission, 'ERR': transmission_error}), continuum
+
+    def derive_fluxcal(self, wavelengths: np.ndarray, continuum: np.ndarray) -> Table:
+        """
+        The conversion from ADU to Jy: the model spectrum of the standard star (a blackbody scaled to the given
+        flux at the central wavelength) divided by its measured continuum.
+        """
+        temperature = self.parameters["metis_ifu_telluric.std_temperature"].value
+        flux = self.parameters["metis_ifu_telluric.std_flux"].value
+
+        central = wavelengths[len(wavelengths) // 2]
+        model = flux * telluric.blackbody(wavelengths, temperature) / telluric.blackbody(central, temperature)
+        conversion = model / np.where(continuum > 0, continuum, np.nan)
+        return Table({'WAVE': wavelengths, 'CONVERSION': conversion})
 
     def process_images(self) -> Dict[str, PipelineProduct]:
-        # self.correct_telluric()
-        # self.apply_fluxcal()
+        std = self.inputset.std_combined.frame
+        std_wavelengths = self.load_grid(std).wavelengths
+        header = self.load_header(std)
+
+        telluric_table, continuum = self.derive_telluric(self.load_planes(std), std_wavelengths)
 
         self.products = {
-            product.category: product()
-            for product in [self.ProductSciReduced1D, self.ProductIfuTelluric, self.ProductFluxcalTab]
+            'IFU_TELLURIC': self.ProductIfuTelluric(self, header, telluric_table),
+            'FLUXCAL_TAB': self.ProductFluxcalTab(self, header, self.derive_fluxcal(std_wavelengths, continuum)),
         }
+
+        if (sci := self.inputset.sci_combined.frame) is not None:
+            # All spaxels are corrected at once; the transmission is resampled only if the grids differ
+            sci_wavelengths = self.load_grid(sci).wavelengths
+            cube = telluric.correct(self.load_planes(sci), sci_wavelengths,
+                                    std_wavelengths, np.asarray(telluric_table['TRANSMISSION']),
+                                    np.asarray(telluric_table['ERR']),
+                                    minimum=self.parameters["metis_ifu_telluric.min_transmission"].value)
+            spectrum, error, _ = telluric.extract_spectrum(cube)
+            self.products['IFU_SCI_REDUCED_1D'] = self.ProductSciReduced1D(
+                self, self.load_header(sci),
+                Table({'WAVE': sci_wavelengths, 'FLUX': spectrum, 'ERR': error}),
+            )
+
         return self.products
 
 
@@ -61,8 +109,28 @@ class MetisIfuTelluric(MetisRecipe):
     _copyright = "GPL-3.0-or-later"
     _synopsis = "Derive telluric absorption correction and optionally flux calibration"
     _description = (
-        "Currently just a skeleton prototype."
+        "Derive the atmospheric transmission and the flux conversion from a standard star cube.\n"
+        + "If a science cube is provided, correct it and extract its telluric-corrected spectrum."
     )
 
-    parameters = cpl.ui.ParameterList([])
+    parameters = cpl.ui.ParameterList([
+        cpl.ui.ParameterValue(
+            name="metis_ifu_telluric.std_temperature",
+            context="metis_ifu_telluric",
+            description="Temperature of the blackbody model of the standard star [K]",
+            default=9600.0,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_telluric.std_flux",
+            context="metis_ifu_telluric",
+            description="Flux of the standard star at the central wavelength [Jy]",
+            default=1.0,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_telluric.min_transmission",
+            context="metis_ifu_telluric",
+            description="Transmission below which the telluric correction is flagged as unreliable",
+            default=0.1,
+        ),
+    ])
     implementation_class = MetisIfuTelluricImpl
@@ -0,0 +1,135 @@
+import cpl
+from cpl.core import Msg
+from typing import Dict
+
+from pymetis.algorithms import wavecal
+from pymetis.algorithms.rectification import DistortionTable
+from pymetis.base.impl import MetisRecipe
+from pymetis.base.product import PipelineProduct, TableProduct
+from pymetis.inputs import SinglePipelineInput
+from pymetis.inputs.common import RawInput, MasterDarkInput, DistortionTableInput
+from pymetis.prefabricates.darkimage import DarkImageProcessor
+
+
+class MetisIfuWavecalImpl(DarkImageProcessor):
+    class InputSet(DarkImageProcessor.InputSet):
+        """
+            The Input class for the IFU wavelength calibration: arc lamp exposures, a master dark,
+            the distortion table (which tells where the slices are) and the catalogue of the arc lines.
+        """
+        detector = "IFU"
+
+        class RawInput(RawInput):
+            _tags = ["IFU_WAVE_RAW"]
+
+        MasterDarkInput = MasterDarkInput
+
+        class LineCatalogInput(SinglePipelineInput):
+            _title: str = "arc line catalogue"
+            _tags: [str] = ["LINE_INTMON_TABLE"]
+            _group: cpl.ui.Frame.FrameGroup = cpl.ui.Frame.FrameGroup.CALIB
+
+        def __init__(self, frameset: cpl.ui.FrameSet):
+            super().__init__(frameset)
+            self.distortion_table = DistortionTableInput(frameset)
+            self.line_catalog = self.LineCatalogInput(frameset)
+
+            self.inputs += [self.distortion_table, self.line_catalog]
+
+    class ProductWavecal(TableProduct):
+        level = cpl.ui.Frame.FrameLevel.FINAL
+        category = rf"IFU_WAVECAL"
+        tag = category
+
+    def process_images(self) -> Dict[str, PipelineProduct]:
+        """
+        Combine the arc exposures, subtract the master dark and fit the wavelength solution of all slices.
+        """
+        method = self.parameters["metis_ifu_wavecal.stacking.method"].value
+        count = len(self.inputset.raw.frameset)
+
+        combined = self.combine_images(self.iterate_raw_images(), method)
+        self.dark_subtraction(combined, method, count).evaluate(out=combined)
+
+        distortion = DistortionTable.load(self.inputset.distortion_table.frame.file)
+        catalogue = wavecal.read_catalogue(self.inputset.line_catalog.frame.file)
+        Msg.info(self.__class__.__qualname__,
+                 f"Identifying arc lines in {len(distortion.slices)} slices, {len(catalogue)} catalogue lines "
+                 f"from {catalogue[0]:.4g} to {catalogue[-1]:.4g} um")
+
+        result = wavecal.calibrate(
+            combined.data, distortion, catalogue,
+            central=self.parameters["metis_ifu_wavecal.central"].value,
+            dispersion=self.parameters["metis_ifu_wavecal.dispersion"].value,
+            degree=self.parameters["metis_ifu_wavecal.degree"].value,
+            threshold=self.parameters["metis_ifu_wavecal.threshold"].value,
+            tolerance=self.parameters["metis_ifu_wavecal.tolerance"].value,
+        )
+        Msg.info(self.__class__.__qualname__,
+                 f"Fitted the wavelength solution to {result.lines} detections, RMS {result.rms:.3g} um")
+
+        header = cpl.core.PropertyList.load(self.inputset.raw.frameset[0].file, 0)
+        product = self.ProductWavecal(self, header, result.solution.to_hdu())
+        product.add_qc(self.qc.parameters() | {
+            "QC WAVECAL NLINES": result.lines,
+            "QC WAVECAL RMS": result.rms,
+        })
+
+        self.products = {
+            'IFU_WAVECAL': product,
+        }
+        return self.products
+
+
+class MetisIfuWavecal(MetisRecipe):
+    _name = "metis_ifu_wavecal"
+    _version = "0.1"
+    _author = "Martin Baláž"
+    _email = "martin.balaz@univie.ac.at"
+    _copyright = "GPL-3.0-or-later"
+    _synopsis = "Derive the wavelength calibration of the IFU from arc lamp exposures"
+    _description = (
+        "Detect the arc lines in every slice of the dark-subtracted arc exposure, identify them\n"
+        + "in the line catalogue and fit the dispersion relation of every slice."
+    )
+
+    parameters = cpl.ui.ParameterList([
+        cpl.ui.ParameterEnum(
+            name="metis_ifu_wavecal.stacking.method",
+            context="metis_ifu_wavecal",
+            description="Name of the method used to combine the arc exposures",
+            default="average",
+            alternatives=("add", "average", "median"),
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_wavecal.central",
+            context="metis_ifu_wavecal",
+            description="First guess of the wavelength at the central detector column [um]",
+            default=3.8,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_wavecal.dispersion",
+            context="metis_ifu_wavecal",
+            description="First guess of the dispersion [um/pixel]",
+            default=0.00025,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_wavecal.degree",
+            context="metis_ifu_wavecal",
+            description="Degree of the dispersion polynomial along the slices",
+            default=3,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_wavecal.threshold",
+            context="metis_ifu_wavecal",
+            description="Detection threshold of the arc lines, in robust standard deviations of the background",
+            default=5.0,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_ifu_wavecal.tolerance",
+            context="metis_ifu_wavecal",
+            description="Initial tolerance of the line identification, in pixels of the first guess",
+            default=3.0,
+        ),
+    ])
+    implementation_class = MetisIfuWavecalImpl
@@ -3,6 +3,8 @@ from typing import Dict
 import cpl
 from cpl.core import Msg
 
+from pymetis.algorithms.expression import lazy
+from pymetis.algorithms.stacking import Planes
 from pymetis.base.impl import MetisRecipe
 from pymetis.base.product import PipelineProduct
 from pymetis.inputs import RawInput
@@ -85,44 +87,42 @@ class MetisLmBasicReduceImpl(DarkImageProcessor):
         def output_file_name(self):
             return f"{self.category}.fits"
 
-    def prepare_flat(self, flat: cpl.core.Image, bias: cpl.core.Image | None):
+    def prepare_flat(self, flat: Planes, bias: Planes | None) -> Planes:
         """ Flat field preparation: subtract bias and normalize it to median 1 """
         Msg.info(self.__class__.__qualname__, "Preparing flat field")
-        
-        #import pdb ; pdb.set_trace()
+
         if flat is None:
             raise RuntimeError("No flat frames found in the frameset.")
         else:
             if bias is not None:
-                flat.subtract(bias)
-            median = flat.get_median()
+                (lazy(flat) - lazy(bias)).evaluate(out=flat)
             return flat
 
             # return flat.divide_scalar(median)
 
-    def prepare_images(self,
-                       raw_frames: cpl.ui.FrameSet,
-                       bias: cpl.core.Image | None = None,
-                       flat: cpl.core.Image | None = None) -> cpl.core.ImageList:
-        prepared_images = cpl.core.ImageList()
-
-        for index, frame in enumerate(raw_frames):
-            Msg.info(self.__class__.__qualname__, f"Processing {frame.file!r}...")
-
-            Msg.debug(self.__class__.__qualname__, f"Loading image {frame.file!r}")
-            raw_image = cpl.core.Image.load(frame.file, extension=1)
-
-            if bias:
-                Msg.debug(self.__class__.__qualname__, "Bias subtracting...")
-                raw_image.subtract(bias)
+    def calibrate(self,
+                  combined: Planes,
+                  count: int,
+                  bias: Planes | None = None,
+                  flat: Planes | None = None) -> Planes:
+        """
+        Apply the bias and the flat to the combined image. Both are linear per-pixel operations, so applying them
+        once to the combination is equivalent to applying them to every frame, and the errors and quality flags
+        of the calibrations propagate into the planes of the result.
+        Both are evaluated together in a single tiled pass, in place.
+        """
+        method = self.parameters["basic_reduction.stacking.method"].value
+        calibrated = lazy(combined)
 
-            if flat:
-                Msg.debug(self.__class__.__qualname__, "Flat fielding...")
-                raw_image.divide(flat)
+        if bias is not None:
+            Msg.debug(self.__class__.__qualname__, "Bias subtracting...")
+            calibrated = self.dark_subtraction(calibrated, method, count, bias)
 
-            prepared_images.append(raw_image)
+        if flat is not None:
+            Msg.debug(self.__class__.__qualname__, "Flat fielding...")
+            calibrated = calibrated / lazy(flat)
 
-        return prepared_images
+        return calibrated.evaluate(out=combined)
 
     def process_images(self) -> Dict[str, PipelineProduct]:
         """
@@ -134,20 +134,23 @@ class MetisLmBasicReduceImpl(DarkImageProcessor):
 
         Msg.info(self.__class__.__qualname__, f"Starting processing image attibute.")
 
-        flat = cpl.core.Image.load(self.inputset.master_flat.frame.file, extension=0)
-        bias = cpl.core.Image.load(self.inputset.master_dark.frame.file, extension=0)
-        gain = cpl.core.Image.load(self.inputset.gain_map.frame.file, extension=0)
+        flat = self.load_planes(self.inputset.master_flat.frame)
+        bias = self.load_master_dark()
+        gain = self.load_data(self.inputset.gain_map.frame)
 
         Msg.info(self.__class__.__qualname__, f"Detector name = {self.detector_name}")
 
         flat = self.prepare_flat(flat, bias)
-        images = self.prepare_images(self.inputset.raw.frameset, flat, bias)
-        combined_image = self.combine_images(images, self.parameters["basic_reduction.stacking.method"].value)
+        combined = self.combine_images(self.iterate_raw_images(),
+                                       self.parameters["basic_reduction.stacking.method"].value)
+        combined = self.calibrate(combined, len(self.inputset.raw.frameset), bias, flat)
         header = cpl.core.PropertyList.load(self.inputset.raw.frameset[0].file, 0)
 
+        product = self.Product.from_planes(self, header, combined, detector_name=self.detector_name)
+        product.add_qc(self.qc.parameters(combined=combined.data))
+
         self.products = {
-            fr'OBJECT_REDUCED_{self.detector_name}':
-                self.Product(self, header, combined_image, detector_name=self.detector_name),
+            fr'OBJECT_REDUCED_{self.detector_name}': product,
         }
 
         return self.products
@@ -182,6 +185,12 @@ class MetisLmBasicReduce(MetisRecipe):
             description="Name of the method used to combine the input images",
             default="add",
             alternatives=("add", "average", "median"),
-        )
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_lm_basic_reduce.refpix",
+            context="metis_lm_basic_reduce",
+            description="Correct the raw frames with the reference pixels of the detector",
+            default=True,
+        ),
     ])
     implementation_class = MetisLmBasicReduceImpl
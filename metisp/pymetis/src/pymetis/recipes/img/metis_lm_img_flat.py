@@ -30,5 +30,31 @@ class MetisLmImgFlat(MetisRecipe):
             default="average",
             alternatives=("add", "average", "median"),
         ),
+        cpl.ui.ParameterEnum(
+            name=f"{_name}.backend",
+            context=_name,
+            description="Compute backend for combining the whole stack (median, sigclip)",
+            default="numpy",
+            alternatives=("numpy", "cpl"),
+        ),
+        cpl.ui.ParameterValue(
+            name=f"{_name}.max_memory",
+            context=_name,
+            description="Memory budget in MiB for planning the tile sizes and workers (0: unlimited)",
+            default=0,
+        ),
+        cpl.ui.ParameterValue(
+            name=f"{_name}.processes",
+            context=_name,
+            description="Worker processes for combining and calibrating, each taking a band of rows "
+                        "(1: none, 0: all cores)",
+            default=1,
+        ),
+        cpl.ui.ParameterValue(
+            name=f"{_name}.refpix",
+            context=_name,
+            description="Correct the raw frames with the reference pixels of the detector",
+            default=True,
+        ),
     ])
     implementation_class = MetisLmImgFlatImpl
@@ -30,5 +30,25 @@ class MetisNImgFlat(MetisRecipe):
             default="average",
             alternatives=("add", "average", "median"),
         ),
+        cpl.ui.ParameterEnum(
+            name=f"{_name}.backend",
+            context=_name,
+            description="Compute backend for combining the whole stack (median, sigclip)",
+            default="numpy",
+            alternatives=("numpy", "cpl"),
+        ),
+        cpl.ui.ParameterValue(
+            name=f"{_name}.max_memory",
+            context=_name,
+            description="Memory budget in MiB for planning the tile sizes and workers (0: unlimited)",
+            default=0,
+        ),
+        cpl.ui.ParameterValue(
+            name=f"{_name}.processes",
+            context=_name,
+            description="Worker processes for combining and calibrating, each taking a band of rows "
+                        "(1: none, 0: all cores)",
+            default=1,
+        ),
     ])
     implementation_class = MetisNImgFlatImpl
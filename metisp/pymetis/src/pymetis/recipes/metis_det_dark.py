@@ -3,8 +3,10 @@ from typing import Dict
 import cpl
 from cpl.core import Msg
 
+from pymetis.algorithms.accumulator import WelfordAccumulator
+from pymetis.algorithms.images import as_image
 from pymetis.base.impl import MetisRecipeImpl, MetisRecipe
-from pymetis.inputs.common import RawInput, LinearityInput
+from pymetis.inputs.common import RawInput, LinearityInput, MasterDarkInput
 from pymetis.base.product import PipelineProduct
 from pymetis.inputs import PipelineInputSet
 from pymetis.prefabricates.rawimage import RawImageProcessor
@@ -20,11 +22,17 @@ class MetisDetDarkImpl(RawImageProcessor):
         class LinearityInput(LinearityInput):
             _tags = ["LINEARITY_{det}"]
 
+        class PreviousMasterDarkInput(MasterDarkInput):
+            """ An existing master dark to be updated with new raw frames (only used in update mode) """
+            _title: str = "previous master dark"
+            _required: bool = False
+
         def __init__(self, frameset: cpl.ui.FrameSet):
             self.raw = self.RawDarkInput(frameset, det=self.band)       # ToDo: inconsistent, should be detector "2RG"
             self.linearity = self.LinearityInput(frameset, det=self.band, required=False)
+            self.master_dark = self.PreviousMasterDarkInput(frameset, det=self.detector)
 
-            self.inputs = [self.raw, self.linearity]
+            self.inputs = [self.raw, self.linearity, self.master_dark]
             super().__init__(frameset)
 
     class Product(Detector2rgMixin, PipelineProduct):
@@ -35,8 +43,30 @@ class MetisDetDarkImpl(RawImageProcessor):
         def __init__(self,
                      recipe: MetisRecipeImpl,
                      header: cpl.core.PropertyList,
-                     image: cpl.core.Image):
-            super().__init__(recipe, header, image)
+                     image: cpl.core.Image,
+                     *,
+                     accumulator: WelfordAccumulator = None,
+                     **kwargs):
+            self.accumulator = accumulator
+            super().__init__(recipe, header, image, **kwargs)
+
+            # Carry the running statistics along, so that the master dark can be updated with new frames later
+            if accumulator is not None:
+                self.add_extension(WelfordAccumulator.extname_mean, as_image(accumulator.mean))
+                self.add_extension(WelfordAccumulator.extname_m2, as_image(accumulator.m2))
+
+        def add_properties(self):
+            super().add_properties()
+
+            if self.accumulator is not None:
+                self.properties.append(
+                    cpl.core.Property(
+                        "ESO PRO DATANCOM",
+                        cpl.core.Type.INT,
+                        self.accumulator.count,
+                        "Number of combined frames",
+                    )
+                )
 
         @property
         def category(self) -> str:
@@ -69,18 +99,46 @@ class MetisDetDarkImpl(RawImageProcessor):
         # Combine the images in the image list using the image stacking
         # option requested by the user.
         method = self.parameters["metis_det_dark.stacking.method"].value
+        update = self.parameters["metis_det_dark.update"].value
         Msg.info(self.__class__.__qualname__, f"Combining images using method {method!r}")
+        header = cpl.core.PropertyList.load(self.inputset.raw.frameset[0].file, 0)
 
         # TODO: preprocessing steps like persistence correction / nonlinearity (or not)
-        raw_images = self.load_raw_images()
-        combined_image = self.combine_images(raw_images, method)
-        header = cpl.core.PropertyList.load(self.inputset.raw.frameset[0].file, 0)
+        if method in ["add", "average"]:
+            # These can be computed from running statistics: keep the accumulator state in the product.
+            # When updating, the new frames are simply folded into the accumulator of the previous master dark.
+            accumulator = self.load_previous_accumulator() if update else WelfordAccumulator()
+        else:
+            if update:
+                raise ValueError(f"Stacking method {method!r} does not support updating an existing master dark, "
+                                 f"use 'add' or 'average'")
+            accumulator = None
+
+        plan = self.memory_plan(method)
+        with self.tile_pool(plan) as pool:
+            planes = self.combine_images(self.iterate_raw_images(), method,
+                                         accumulator=accumulator, backend=self.backend, plan=plan, pool=pool)
+        product = self.Product.from_planes(self, header, planes, accumulator=accumulator)
+        product.add_qc(self.qc.parameters(combined=planes.data))
 
         return {
-            fr'METIS_{self.detector_name}_DARK':
-                self.Product(self, header, combined_image),
+            fr'METIS_{self.detector_name}_DARK': product,
         }
 
+    def load_previous_accumulator(self) -> WelfordAccumulator:
+        """
+        Restore the running statistics of the master dark that is being updated.
+        Only the previous product is read, its raw frames are not needed.
+        """
+        frame = self.inputset.master_dark.frame
+        if frame is None:
+            raise cpl.core.DataNotFoundError("Update mode requested, but no previous master dark "
+                                             "found in the frameset.")
+
+        count = cpl.core.PropertyList.load(frame.file, 0)["ESO PRO DATANCOM"].value
+        Msg.info(self.__class__.__qualname__, f"Updating master dark {frame.file!r} combined from {count} frames")
+        return WelfordAccumulator.load(frame.file, count)
+
 
 class MetisDetDark(MetisRecipe):
     # Fill in recipe information
@@ -101,6 +159,37 @@ class MetisDetDark(MetisRecipe):
             default="average",
             alternatives=("add", "average", "median", "sigclip"),
         ),
+        cpl.ui.ParameterValue(
+            name="metis_det_dark.update",
+            context="metis_det_dark",
+            description="Fold the raw frames into the provided MASTER_DARK instead of creating a new one",
+            default=False,
+        ),
+        cpl.ui.ParameterEnum(
+            name="metis_det_dark.backend",
+            context="metis_det_dark",
+            description="Compute backend for combining the whole stack (median, sigclip)",
+            default="numpy",
+            alternatives=("numpy", "cpl"),
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_det_dark.max_memory",
+            context="metis_det_dark",
+            description="Memory budget in MiB for planning the tile sizes and workers (0: unlimited)",
+            default=0,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_det_dark.processes",
+            context="metis_det_dark",
+            description="Worker processes for the stacked methods, each taking a band of rows (1: none, 0: all cores)",
+            default=1,
+        ),
+        cpl.ui.ParameterValue(
+            name="metis_det_dark.refpix",
+            context="metis_det_dark",
+            description="Correct the raw frames with the reference pixels of the detector",
+            default=True,
+        ),
     ])
 
     implementation_class = MetisDetDarkImpl
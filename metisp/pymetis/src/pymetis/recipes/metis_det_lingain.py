@@ -3,6 +3,7 @@ from typing import Dict
 
 import cpl
 
+from pymetis.algorithms.images import as_image
 from pymetis.base.impl import MetisRecipe
 from pymetis.inputs.base import MultiplePipelineInput
 from pymetis.inputs.common import RawInput, MasterDarkInput
@@ -48,9 +49,9 @@ class MetisDetLinGainImpl(DarkImageProcessor):
             return f"BADPIX_MAP_{self.detector}"
 
     def process_images(self) -> Dict[str, PipelineProduct]:
-        raw_images = self.load_raw_images()
-        combined_image = self.combine_images(raw_images,
-                                             method=self.parameters["metis_det_lingain.stacking.method"].value)
+        planes = self.combine_images(self.iterate_raw_images(),
+                                     method=self.parameters["metis_det_lingain.stacking.method"].value)
+        combined_image = as_image(planes.data)
 
         # Flat field preparation: subtract bias and normalize it to median 1
         # Msg.info(self.name, "Preparing flat field")
@@ -65,7 +66,6 @@ class MetisDetLinGainImpl(DarkImageProcessor):
         linearity_image = combined_image    # TODO Actual implementation missing
         badpix_map = combined_image         # TODO Actual implementation missing
 
-        #import pdb ; pdb.set_trace()
         self.products = {
             f'MASTER_GAIN_{self.detector_name}':
                 self.ProductGain(self, header, gain_image, 
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.accumulator import WelfordAccumulator
+
+
+@pytest.fixture
+def frames():
+    return np.random.default_rng(42).normal(100, 5, size=(9, 16, 12))
+
+
+class TestWelfordAccumulator:
+    def test_streaming(self, frames):
+        accumulator = WelfordAccumulator()
+        for frame in frames:
+            accumulator.add(frame)
+
+        assert accumulator.count == len(frames)
+        assert np.allclose(accumulator.mean, frames.mean(axis=0))
+        assert np.allclose(accumulator.variance, frames.var(axis=0, ddof=1))
+        assert np.allclose(accumulator.combined("add"), frames.sum(axis=0))
+
+    def test_merge_equals_full_pass(self, frames):
+        old, new = WelfordAccumulator(), WelfordAccumulator()
+        for frame in frames[:6]:
+            old.add(frame)
+        for frame in frames[6:]:
+            new.add(frame)
+
+        merged = new.merge(old)
+        assert merged.count == len(frames)
+        assert np.allclose(merged.mean, frames.mean(axis=0))
+        assert np.allclose(merged.variance, frames.var(axis=0, ddof=1))
+
+    def test_merge_into_empty(self, frames):
+        other = WelfordAccumulator()
+        other.add(frames[0])
+        assert WelfordAccumulator().merge(other).count == 1
+
+    def test_shape_mismatch(self, frames):
+        accumulator = WelfordAccumulator()
+        accumulator.add(frames[0])
+        with pytest.raises(ValueError):
+            accumulator.add(frames[0, :4])
+
+    def test_median_not_supported(self, frames):
+        accumulator = WelfordAccumulator()
+        accumulator.add(frames[0])
+        with pytest.raises(ValueError):
+            accumulator.combined("median")
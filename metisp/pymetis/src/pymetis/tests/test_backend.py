@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.backend import NumpyBackend
+
+
+@pytest.fixture
+def backend():
+    return NumpyBackend()
+
+
+@pytest.fixture
+def stack():
+    return np.random.default_rng(5).normal(100, 2, size=(20, 6, 8))
+
+
+class TestNumpyBackend:
+    def test_divide_by_zero(self, backend):
+        result = backend.divide(np.array([[1.0, 2.0]]), np.array([[2.0, 0.0]]))
+        assert np.array_equal(result, [[0.5, 0.0]])
+
+    def test_collapse(self, backend, stack):
+        assert np.allclose(backend.mean(stack), stack.mean(axis=0))
+        assert np.allclose(backend.median(stack), np.median(stack, axis=0))
+
+    def test_clip(self, backend, stack):
+        stack[4, 1, 1] = 500
+        stack[7, 2, 3] = -300
+        clipped = backend.clip(stack)
+        assert clipped[1, 1] == pytest.approx(np.delete(stack[:, 1, 1], 4).mean())
+        assert clipped[2, 3] == pytest.approx(np.delete(stack[:, 2, 3], 7).mean())
+
+    def test_clip_keeps_fraction(self, backend):
+        # With kappa this small everything but the closest values would be rejected
+        stack = np.arange(10, dtype=np.float64)[:, np.newaxis, np.newaxis]
+        clipped = backend.clip(stack, kappa=0.1, keep=0.5)
+        assert np.isfinite(clipped).all()
+
+    def test_statistics(self, backend, stack):
+        statistics = backend.statistics(stack[0])
+        assert statistics['stdev'] == pytest.approx(stack[0].std(ddof=1))
+        assert statistics['min'] <= statistics['median'] <= statistics['max']
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.backend import NumpyBackend
+from pymetis.algorithms.backend_cpl import CplBackend
+from pymetis.algorithms.stacking import combine_planes
+
+
+@pytest.fixture
+def stack():
+    stack = np.random.default_rng(17).normal(1000, 10, size=(20, 16, 12))
+    stack[2, 5, 5] = 1e5
+    stack[6, 9, 1] = -1e5
+    return stack
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(23)
+    image, other = rng.normal(50, 5, size=(2, 16, 12))
+    other[3, 3] = 0
+    return image, other
+
+
+class TestParity:
+    """ The NumPy backend must reproduce the CPL reference implementation """
+    numpy = NumpyBackend()
+    cpl = CplBackend()
+
+    def test_subtract(self, images):
+        assert np.allclose(self.numpy.subtract(*images), self.cpl.subtract(*images))
+
+    def test_divide(self, images):
+        assert np.allclose(self.numpy.divide(*images), self.cpl.divide(*images))
+
+    def test_mean(self, stack):
+        assert np.allclose(self.numpy.mean(stack), self.cpl.mean(stack))
+
+    def test_median(self, stack):
+        assert np.allclose(self.numpy.median(stack), self.cpl.median(stack))
+
+    def test_clip(self, stack):
+        assert np.allclose(self.numpy.clip(stack), self.cpl.clip(stack), rtol=1e-3)
+
+    def test_statistics(self, stack):
+        expected = self.cpl.statistics(stack[0])
+        for key, value in self.numpy.statistics(stack[0]).items():
+            assert value == pytest.approx(expected[key]), key
+
+    @pytest.mark.parametrize("method", ["median", "sigclip"])
+    def test_combine_planes(self, stack, method):
+        planes = [combine_planes(iter(stack), method, backend=backend) for backend in [self.numpy, self.cpl]]
+        assert np.allclose(planes[0].data, planes[1].data, rtol=1e-3)
+        assert np.array_equal(planes[0].quality, planes[1].quality)
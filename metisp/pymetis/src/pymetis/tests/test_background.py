@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.background import PairSubtractor, beam
+
+
+class TestBeam:
+    def test_nodding(self):
+        assert beam({'ESO SEQ NODPOS': 'A'}) == 1
+        assert beam({'ESO SEQ NODPOS': 'B '}) == -1
+
+    def test_chopping_and_nodding(self):
+        assert beam({'ESO SEQ NODPOS': 'B', 'ESO SEQ CHOPPOS': 'B'}) == 1
+        assert beam({'ESO SEQ NODPOS': 'A', 'ESO SEQ CHOPPOS': 'B'}) == -1
+
+    def test_not_nodded(self):
+        assert beam({}) is None
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            beam({'ESO SEQ NODPOS': 'C'})
+
+
+class TestPairSubtractor:
+    @pytest.fixture
+    def sequence(self):
+        """ An ABBA sequence: a source on top of a constant sky in the A beam only """
+        rng = np.random.default_rng(7)
+        source = np.zeros((8, 10))
+        source[3:5, 4:6] = 50
+        beams = [1, -1, -1, 1, 1, -1, -1, 1]
+        frames = [1000 + (source if b > 0 else 0) + rng.normal(0, 1, source.shape) for b in beams]
+        return source, list(zip(beams, frames))
+
+    def test_pairs(self, sequence):
+        source, frames = sequence
+        pairs = PairSubtractor()
+        differences = list(pairs.subtract(iter(frames)))
+
+        assert pairs.pairs == 4
+        assert pairs.unpaired == 0
+        assert np.allclose(np.mean(differences, axis=0), source, atol=2)
+
+    def test_background(self, sequence):
+        _, frames = sequence
+        pairs = PairSubtractor()
+        for _ in pairs.subtract(iter(frames)):
+            pass
+
+        assert pairs.background.count == 4
+        assert np.allclose(pairs.background.mean, 1000, atol=2)
+
+    def test_unpaired(self, sequence):
+        _, frames = sequence
+        pairs = PairSubtractor()
+        differences = list(pairs.subtract(iter(frames[:1] + frames[3:])))
+
+        # A, A, A, B, B, A: the B frames are paired with the nearest A frames, the first and the last A are left over
+        assert len(differences) == 2
+        assert pairs.unpaired == 2
+
+    @pytest.mark.parametrize("beams", [[1, 1, -1, -1], [1, -1, -1, 1], [-1, -1, 1, 1, 1, -1, -1, 1]])
+    def test_runs_of_one_beam(self, beams):
+        # Both beams see the same sky, the A beam also the source
+        frames = [(b, np.full((2, 2), 1000.0 + (50 if b > 0 else 0))) for b in beams]
+        pairs = PairSubtractor()
+        differences = list(pairs.subtract(iter(frames)))
+
+        assert pairs.pairs == len(beams) // 2
+        assert pairs.unpaired == 0
+        assert np.allclose(differences, 50)
+
+    def test_nearest_partner(self):
+        # A1 A2 B1 B2: B1 pairs with A2, which is nearest in time, then B2 with A1
+        frames = [(1, np.full(1, 1.0)), (1, np.full(1, 2.0)), (-1, np.full(1, 0.5)), (-1, np.full(1, 0.0))]
+        assert [d[0] for d in PairSubtractor().subtract(iter(frames))] == [1.5, 1.0]
+
+    def test_window(self):
+        # Six A frames in a row: beyond the window of four, the oldest two can no longer be paired
+        frames = [(1, np.zeros((2, 2)))] * 6 + [(-1, np.zeros((2, 2)))] * 4
+        pairs = PairSubtractor(window=4)
+        assert len(list(pairs.subtract(iter(frames)))) == 4
+        assert pairs.pairs == 4
+        assert pairs.unpaired == 2
+
+    def test_invalid_beam(self):
+        with pytest.raises(ValueError):
+            PairSubtractor().feed(None, np.zeros((2, 2)))
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms.coadd import CubeGrid, CubeCoadder
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+SCALE = 0.0082 / 3600
+
+
+def cube_header(ra: float = 10.0, dec: float = -30.0, shape=(20, 8, 12), start: float = 3.5) -> fits.Header:
+    header = fits.Header()
+    header['NAXIS'] = 3
+    header['NAXIS1'], header['NAXIS2'], header['NAXIS3'] = reversed(shape)
+    header.update({
+        'CTYPE1': 'RA---TAN', 'CUNIT1': 'deg', 'CRPIX1': (shape[2] + 1) / 2, 'CRVAL1': ra, 'CDELT1': -SCALE,
+        'CTYPE2': 'DEC--TAN', 'CUNIT2': 'deg', 'CRPIX2': (shape[1] + 1) / 2, 'CRVAL2': dec, 'CDELT2': SCALE,
+        'CTYPE3': 'WAVE', 'CUNIT3': 'um', 'CRPIX3': 1.0, 'CRVAL3': start, 'CDELT3': 0.001,
+    })
+    return header
+
+
+def offset(pixels: float) -> float:
+    """ Right ascension shifted by a number of spaxels (to the east, i.e. towards lower x) """
+    return 10.0 + pixels * SCALE / np.cos(np.radians(-30.0))
+
+
+class TestCubeGrid:
+    def test_single(self):
+        grid = CubeGrid.enclosing([CubeGrid.from_header(cube_header())])
+        assert grid.shape == (20, 8, 12)
+
+    def test_dithered(self):
+        grids = [CubeGrid.from_header(cube_header(ra=offset(dx))) for dx in [0, 3, 6]]
+        assert CubeGrid.enclosing(grids).shape == (20, 8, 18)
+
+    def test_spectral(self):
+        grids = [CubeGrid.from_header(cube_header(start=start)) for start in [3.5, 3.51]]
+        assert CubeGrid.enclosing(grids).shape == (30, 8, 12)
+
+    def test_wavelengths(self):
+        assert np.allclose(CubeGrid.from_header(cube_header()).wavelengths[:3], [3.5, 3.501, 3.502])
+
+    def test_not_a_cube(self):
+        with pytest.raises(ValueError):
+            CubeGrid.from_header(fits.Header({'NAXIS': 2}))
+
+
+class TestCubeCoadder:
+    def test_constant(self, tmp_path):
+        grids = [CubeGrid.from_header(cube_header(ra=offset(dx))) for dx in [0, 3]]
+        coadder = CubeCoadder(CubeGrid.enclosing(grids), tmp_path)
+        for grid in grids:
+            planes = Planes.from_data(np.full(grid.shape, 5.0))
+            planes.error[:] = 1
+            coadder.add(planes, grid)
+
+        result = coadder.result()
+        covered = (result.quality & QualityFlag.NO_DATA) == 0
+        assert covered.any()
+        assert np.allclose(result.data[covered], 5)
+        # Where both cubes overlap, the error is reduced
+        assert result.error[covered].min() < 1
+
+    def test_skips_flagged(self, tmp_path):
+        grid = CubeGrid.from_header(cube_header())
+        coadder = CubeCoadder(CubeGrid.enclosing([grid]), tmp_path)
+        planes = Planes.from_data(np.full(grid.shape, 5.0))
+        planes.data[:, 2, 2] = 1000
+        planes.quality[:, 2, 2] |= QualityFlag.BAD_PIXEL
+        coadder.add(planes, grid)
+
+        result = coadder.result()
+        assert np.nanmax(result.data) == pytest.approx(5)
+
+    def test_chunks(self, tmp_path):
+        grid = CubeGrid.from_header(cube_header())
+        coadder = CubeCoadder(grid, tmp_path)
+        coadder.add(Planes.from_data(np.random.default_rng(3).normal(size=grid.shape)), grid)
+
+        chunks = list(coadder.chunks(size=3))
+        assert [window.start for window, _ in chunks] == list(range(0, grid.shape[0], 3))
+
+        data = np.concatenate([planes.data for _, planes in chunks])
+        assert np.array_equal(data, coadder.result().data, equal_nan=True)
+
+    def test_variance_needs_errors(self, tmp_path):
+        grid = CubeGrid.from_header(cube_header())
+        coadder = CubeCoadder(grid, tmp_path, weighting="variance")
+        with pytest.raises(ValueError):
+            coadder.add(Planes.from_data(np.ones(grid.shape)), grid)
+
+
+def test_wcs_keywords():
+    keywords = CubeGrid.from_header(cube_header()).wcs_keywords()
+    assert keywords['CTYPE3'] == 'WAVE'
+    assert keywords['CRVAL1'] == pytest.approx(10.0)
+    assert 'NAXIS1' not in keywords
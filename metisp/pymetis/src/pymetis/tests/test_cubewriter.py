@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms.cubewriter import CubeWriter
+from pymetis.algorithms.stacking import Planes
+
+
+@pytest.fixture
+def cube():
+    rng = np.random.default_rng(11)
+    data = rng.normal(size=(7, 5, 4))
+    return Planes(data, np.abs(data) / 10, (np.arange(7 * 5 * 4) % 3).astype(np.int32).reshape(data.shape))
+
+
+@pytest.fixture
+def header():
+    header = fits.Header()
+    header['NAXIS'] = 0
+    header['CHECKSUM'] = 'stale'
+    header['CTYPE3'] = 'WAVE'
+    header['HIERARCH ESO PRO CATG'] = 'IFU_SCI_COADD'
+    return header
+
+
+class TestCubeWriter:
+    def test_chunks(self, tmp_path, cube, header):
+        filename = tmp_path / "cube.fits"
+        with CubeWriter(filename, cube.data.shape, header) as writer:
+            for start in range(0, 7, 3):
+                window = slice(start, min(start + 3, 7))
+                writer.write(window, Planes(cube.data[window], cube.error[window], cube.quality[window]))
+            assert writer.complete
+
+        loaded = Planes.load(filename)
+        assert np.array_equal(loaded.data, cube.data)
+        assert np.array_equal(loaded.error, cube.error)
+        assert np.array_equal(loaded.quality, cube.quality)
+
+    def test_header(self, tmp_path, cube, header):
+        filename = tmp_path / "cube.fits"
+        with CubeWriter(filename, cube.data.shape, header):
+            pass
+
+        with fits.open(filename) as hdus:
+            hdus.verify('exception')
+            assert [hdu.name for hdu in hdus] == ['PRIMARY', 'ERR', 'DQ']
+            assert hdus[0].header['NAXIS3'] == 7
+            assert hdus[0].header['ESO PRO CATG'] == 'IFU_SCI_COADD'
+            assert 'CHECKSUM' not in hdus[0].header
+
+    def test_incomplete(self, tmp_path, cube):
+        with CubeWriter(tmp_path / "cube.fits", cube.data.shape) as writer:
+            writer.write(0, Planes(cube.data[0], cube.error[0], cube.quality[0]))
+            assert not writer.complete
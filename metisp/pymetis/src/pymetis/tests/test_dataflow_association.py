@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.dataflow.association import Associator, Calibration, ProductStore
+from pymetis.dataflow.sof import read_sof
+
+
+def write_fits(path, mjd, *, dit=1.0, **keywords):
+    header = fits.Header({'MJD-OBS': mjd, 'HIERARCH ESO DET DIT': dit})
+    for keyword, value in keywords.items():
+        header[f"HIERARCH ESO {keyword.replace('_', ' ')}"] = value
+    fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(np.zeros((4, 4)))]).writeto(path)
+    return str(path)
+
+
+@pytest.fixture
+def products(tmp_path):
+    root = tmp_path / "products"
+    root.mkdir()
+    files = {
+        'dark1': write_fits(root / "dark1.fits", 60000.0, dit=1.0, PRO_CATG="MASTER_DARK_2RG"),
+        'dark2': write_fits(root / "dark2.fits", 60001.0, dit=1.0, PRO_CATG="MASTER_DARK_2RG"),
+        'dark_long': write_fits(root / "dark_long.fits", 60001.0, dit=10.0, PRO_CATG="MASTER_DARK_2RG"),
+        'flat': write_fits(root / "flat.fits", 59990.0, PRO_CATG="MASTER_IMG_FLAT_TWILIGHT_LM"),
+        'linearity': write_fits(root / "linearity.fits", 60000.0, PRO_CATG="LINEARITY_2RG"),
+        'gain': write_fits(root / "gain.fits", 60000.0, PRO_CATG="GAIN_MAP_2RG"),
+    }
+    write_fits(root / "raw.fits", 60000.0)
+    return root, files
+
+
+class TestProductStore:
+    def test_index(self, products):
+        root, _ = products
+        store = ProductStore.from_directory(root, workers=2)
+        assert len(store) == 6
+
+    def test_nearest(self, products):
+        root, files = products
+        store = ProductStore.from_directory(root)
+        dark = Calibration(("MASTER_DARK_2RG",), match_dit=True)
+        assert store.select(dark, 60000.3, 1.0) == (files['dark1'], "MASTER_DARK_2RG")
+        assert store.select(dark, 60000.7, 1.0) == (files['dark2'], "MASTER_DARK_2RG")
+        assert store.select(dark, 59000.0, 10.0) == (files['dark_long'], "MASTER_DARK_2RG")
+        assert store.select(dark, 60000.0, 5.0) is None
+
+    def test_preference_and_validity(self, products):
+        root, files = products
+        store = ProductStore.from_directory(root)
+        flat = Calibration(("MASTER_IMG_FLAT_LAMP_LM", "MASTER_IMG_FLAT_TWILIGHT_LM"))
+        assert store.select(flat, 60000.0) == (files['flat'], "MASTER_IMG_FLAT_TWILIGHT_LM")
+        assert store.select(Calibration(flat.tags, validity=5), 60000.0) is None
+
+
+class TestAssociator:
+    def test_night(self, products, tmp_path):
+        root, files = products
+        raw = tmp_path / "raw"
+        raw.mkdir()
+        frames = [(write_fits(raw / f"sci{i}.fits", 60000.1 + i * 0.3, dit=1.0), "LM_IMAGE_SCI_RAW")
+                  for i in range(3)]
+        frames.append((write_fits(raw / "odd.fits", 60000.1, dit=3.0), "LM_IMAGE_SCI_RAW"))
+
+        associator = Associator(ProductStore.from_directory(root), 'metis_lm_basic_reduce')
+        written = associator.write_night(frames, tmp_path / "sof")
+
+        # The first two frames are closest to the first dark, the third one to the second; no dark for DIT = 3 s
+        assert len(written) == 2
+        assert associator.unassociated == {frames[3][0]: ["MASTER_DARK_2RG"]}
+
+        first = read_sof(written[0])
+        assert first[:2] == frames[:2]
+        assert set(first[2:]) == {(files['dark1'], "MASTER_DARK_2RG"),
+                                  (files['flat'], "MASTER_IMG_FLAT_TWILIGHT_LM"),
+                                  (files['linearity'], "LINEARITY_2RG"),
+                                  (files['gain'], "GAIN_MAP_2RG")}
+        assert read_sof(written[1])[:2] == [frames[2], (files['dark2'], "MASTER_DARK_2RG")]
+
+    def test_unknown_recipe(self, products):
+        with pytest.raises(KeyError):
+            Associator(ProductStore(), 'metis_unknown')
@@ -0,0 +1,199 @@
+from typing import Any, Dict
+
+import cpl
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+from pymetis.algorithms.stacking import Planes
+from pymetis.base.impl import MetisRecipe, MetisRecipeImpl
+from pymetis.base.product import PipelineProduct, TableProduct, CubeProduct
+from pymetis.dataflow.chain import ChainStep, IFU_CHAIN, RecipeChain, read_sof
+from pymetis.dataflow.executor import RECIPES
+from pymetis.inputs import PipelineInputSet, RawInput, SinglePipelineInput
+
+CUBE_WCS = {
+    'CTYPE1': 'RA---TAN', 'CUNIT1': 'deg', 'CRPIX1': 1.0, 'CRVAL1': 10.0, 'CDELT1': -1e-5,
+    'CTYPE2': 'DEC--TAN', 'CUNIT2': 'deg', 'CRPIX2': 1.0, 'CRVAL2': -20.0, 'CDELT2': 1e-5,
+    'CTYPE3': 'WAVE', 'CUNIT3': 'um', 'CRPIX3': 1.0, 'CRVAL3': 3.5, 'CDELT3': 0.001,
+}
+
+
+class StubRawInput(RawInput):
+    _tags = ["STUB_RAW"]
+
+
+class StubProduceImpl(MetisRecipeImpl):
+    """ Makes an image, a table and a cube product from a raw frame """
+
+    class InputSet(PipelineInputSet):
+        def __init__(self, frameset: cpl.ui.FrameSet):
+            self.raw = StubRawInput(frameset)
+            self.inputs = [self.raw]
+            super().__init__(frameset)
+
+    class ProductImage(PipelineProduct):
+        category = tag = "STUB_IMAGE"
+        level = cpl.ui.Frame.FrameLevel.INTERMEDIATE
+        frame_type = cpl.ui.Frame.FrameType.IMAGE
+
+    class ProductTable(TableProduct):
+        category = tag = "STUB_TABLE"
+        level = cpl.ui.Frame.FrameLevel.INTERMEDIATE
+
+    class ProductCube(CubeProduct):
+        category = tag = "STUB_CUBE"
+        level = cpl.ui.Frame.FrameLevel.INTERMEDIATE
+
+    def process_images(self) -> Dict[str, PipelineProduct]:
+        raw = self.inputset.raw.frameset[0]
+        image = Planes.from_data(2 * self.load_data(raw))
+        cube = Planes.from_data(np.arange(24.0).reshape(4, 3, 2))
+        return {
+            'STUB_IMAGE': self.ProductImage.from_planes(self, self.load_header(raw), image),
+            'STUB_TABLE': self.ProductTable(self, self.load_header(raw), Table({'WAVE': [3.5, 3.6]})),
+            'STUB_CUBE': self.ProductCube.from_planes(self, self.load_header(raw), cube, wcs=CUBE_WCS),
+        }
+
+
+class StubConsumeImpl(MetisRecipeImpl):
+    """ Combines the products of `StubProduceImpl`, and records what it got for them """
+    received: Dict[str, Any] = {}
+
+    class InputSet(PipelineInputSet):
+        class ImageInput(SinglePipelineInput):
+            _title = "stub image"
+            _tags = ["STUB_IMAGE"]
+            _group = cpl.ui.Frame.FrameGroup.CALIB
+
+        class TableInput(ImageInput):
+            _title = "stub table"
+            _tags = ["STUB_TABLE"]
+
+        class CubeInput(ImageInput):
+            _title = "stub cube"
+            _tags = ["STUB_CUBE"]
+
+        def __init__(self, frameset: cpl.ui.FrameSet):
+            self.raw = StubRawInput(frameset)
+            self.image = self.ImageInput(frameset)
+            self.table = self.TableInput(frameset)
+            self.cube = self.CubeInput(frameset)
+            self.inputs = [self.raw, self.image, self.table, self.cube]
+            super().__init__(frameset)
+
+    class ProductResult(PipelineProduct):
+        category = tag = "STUB_RESULT"
+        level = cpl.ui.Frame.FrameLevel.FINAL
+        frame_type = cpl.ui.Frame.FrameType.IMAGE
+
+    def process_images(self) -> Dict[str, PipelineProduct]:
+        planes = self.load_planes(self.inputset.image.frame)
+        table = self.load_table(self.inputset.table.frame)
+        StubConsumeImpl.received = {
+            'planes': planes,
+            'table': table,
+            'grid': self.load_grid(self.inputset.cube.frame),
+            'dfs': [frame.file for frame in self.dfs_frameset()],
+        }
+        result = Planes.from_data(planes.data + table['WAVE'].sum())
+        header = self.load_header(self.inputset.raw.frameset[0])
+        return {'STUB_RESULT': self.ProductResult.from_planes(self, header, result)}
+
+
+class StubProduce(MetisRecipe):
+    _name = "stub_produce"
+    _synopsis = "Stub producer of an in-memory chain"
+    implementation_class = StubProduceImpl
+
+
+class StubConsume(MetisRecipe):
+    _name = "stub_consume"
+    _synopsis = "Stub consumer of an in-memory chain"
+    implementation_class = StubConsumeImpl
+
+
+class TestChainStep:
+    def test_single_run(self):
+        frames = [("a.fits", "IFU_SCI_REDUCED"), ("b.fits", "IFU_TELLURIC")]
+        assert ChainStep('metis_ifu_calibrate').runs(frames) == [frames]
+
+    def test_separate_runs(self):
+        step = ChainStep('metis_ifu_reduce', [['IFU_STD_RAW'], ['IFU_SCI_RAW']])
+        frames = [("std.fits", "IFU_STD_RAW"), ("sci.fits", "IFU_SCI_RAW"), ("dark.fits", "MASTER_DARK_IFU")]
+        assert step.runs(frames) == [
+            [("dark.fits", "MASTER_DARK_IFU"), ("std.fits", "IFU_STD_RAW")],
+            [("dark.fits", "MASTER_DARK_IFU"), ("sci.fits", "IFU_SCI_RAW")],
+        ]
+
+    def test_missing_group(self):
+        step = ChainStep('metis_ifu_reduce', [['IFU_STD_RAW'], ['IFU_SCI_RAW']])
+        frames = [("sci.fits", "IFU_SCI_RAW"), ("dark.fits", "MASTER_DARK_IFU")]
+        assert step.runs(frames) == [[("dark.fits", "MASTER_DARK_IFU"), ("sci.fits", "IFU_SCI_RAW")]]
+
+
+@pytest.mark.parametrize('step', IFU_CHAIN)
+def test_chain_recipes(step):
+    assert step.recipe in RECIPES
+
+
+def test_read_sof(tmp_path):
+    sof = tmp_path / "chain.sof"
+    sof.write_text("# inputs\nsci.fits IFU_SCI_RAW\n\ndark.fits MASTER_DARK_IFU\n")
+    assert read_sof(sof) == [("sci.fits", "IFU_SCI_RAW"), ("dark.fits", "MASTER_DARK_IFU")]
+
+
+class TestRecipeChain:
+    @pytest.fixture
+    def raw(self, tmp_path):
+        filename = tmp_path / "raw.fits"
+        hdu = fits.PrimaryHDU(np.arange(6.0).reshape(3, 2))
+        hdu.header['OBJECT'] = "STUB"
+        hdu.writeto(filename)
+        return str(filename)
+
+    @pytest.fixture
+    def chain(self, tmp_path, monkeypatch):
+        recipes = {'stub_produce': StubProduce, 'stub_consume': StubConsume}
+        monkeypatch.setattr("pymetis.dataflow.chain.load_recipe", recipes.__getitem__)
+        StubConsumeImpl.received = {}
+
+        def inner(**kwargs) -> RecipeChain:
+            return RecipeChain([ChainStep('stub_produce'), ChainStep('stub_consume')], tmp_path / "out", **kwargs)
+        return inner
+
+    def test_memory(self, chain, raw, tmp_path):
+        recipe_chain = chain()
+        saved = recipe_chain.run([(raw, "STUB_RAW")])
+
+        # Only the products of the last recipe are saved
+        assert saved == [(str(tmp_path / "out" / "STUB_RESULT.fits"), "STUB_RESULT")]
+        assert sorted(path.name for path in (tmp_path / "out").iterdir()) == ["STUB_RESULT.fits"]
+        assert set(recipe_chain.memory) == {"STUB_IMAGE.fits", "STUB_TABLE.fits", "STUB_CUBE.fits", "STUB_RESULT.fits"}
+
+        # The products of the first recipe are handed over as they are, without copies
+        received = StubConsumeImpl.received
+        image = recipe_chain.memory["STUB_IMAGE.fits"].planes
+        assert np.shares_memory(received['planes'].data, image.data)
+        assert not received['planes'].data.flags.writeable
+        assert np.allclose(received['planes'].data, 2 * np.arange(6.0).reshape(3, 2))
+        assert list(received['table']['WAVE']) == [3.5, 3.6]
+        assert received['grid'].shape == (4, 3, 2)
+        assert received['grid'].wavelengths[0] == pytest.approx(3.5)
+
+        # The unsaved inputs are recorded as the frames they were made from
+        assert received['dfs'] == [raw]
+
+        result = fits.getdata(saved[0][0], 0)
+        assert np.allclose(result, 2 * np.arange(6.0).reshape(3, 2) + 7.1)
+
+    def test_save_intermediate(self, chain, raw, tmp_path):
+        recipe_chain = chain(save_intermediate=True)
+        saved = recipe_chain.run([(raw, "STUB_RAW")])
+        assert [tag for _, tag in saved] == ["STUB_IMAGE", "STUB_TABLE", "STUB_CUBE", "STUB_RESULT"]
+        assert all((tmp_path / "out" / f"{tag}.fits").exists() for _, tag in saved)
+
+        # Saved or not, the inputs are still taken from memory
+        assert np.shares_memory(StubConsumeImpl.received['planes'].data,
+                                recipe_chain.memory["STUB_IMAGE.fits"].planes.data)
@@ -0,0 +1,61 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cpl
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.dataflow import executor
+from pymetis.dataflow.executor import collect_inputs
+
+WORKFLOW = Path(__file__).parents[4] / "workflows" / "metis" / "metis_lm_img_wkf.py"
+DARK = {"INSTRUME": "METIS", "HIERARCH ESO DPR CATG": "CALIB", "HIERARCH ESO DPR TYPE": "DARK",
+        "HIERARCH ESO DPR TECH": "IMAGE,LM"}
+
+
+class StubDark:
+    """ Stands in for the dark recipe: checks that its inputs can be opened from its working directory """
+    inputs = []
+
+    def run(self, frameset: cpl.ui.FrameSet, settings) -> cpl.ui.FrameSet:
+        for frame in frameset:
+            StubDark.inputs.append((frame.file, frame.tag, Path(frame.file).is_file()))
+        fits.PrimaryHDU(np.zeros((2, 2))).writeto("MASTER_DARK_2RG.fits")
+        products = cpl.ui.FrameSet()
+        products.append(cpl.ui.Frame("MASTER_DARK_2RG.fits", tag="MASTER_DARK_2RG"))
+        return products
+
+
+@pytest.fixture
+def data(tmp_path, monkeypatch):
+    """ Raw darks in `data`, relative to the working directory """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    for index in range(2):
+        header = fits.Header(DARK)
+        fits.PrimaryHDU(np.zeros((2, 2)), header=header).writeto(tmp_path / "data" / f"dark_{index}.fits")
+    return Path("data")
+
+
+def test_collect_inputs(data, tmp_path):
+    files = collect_inputs([data, data / "dark_0.fits"])
+    assert files == [tmp_path / "data" / "dark_0.fits", tmp_path / "data" / "dark_1.fits",
+                     tmp_path / "data" / "dark_0.fits"]
+
+
+def test_relative_input_directory(data, tmp_path, monkeypatch, capsys):
+    # Jobs run on threads here, so that the stub recipe is seen by them
+    monkeypatch.setattr(executor, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(executor, "load_recipe", lambda name: StubDark)
+    monkeypatch.setattr(sys, "argv", ["executor", str(WORKFLOW), str(data), "-o", "out", "-t", "metis_det_dark"])
+    StubDark.inputs = []
+
+    executor.main()
+
+    workdir = tmp_path / "out" / "metis_det_dark"
+    expected = [str(tmp_path / "data" / f"dark_{index}.fits") for index in range(2)]
+    assert StubDark.inputs == [(file, "DARK_LM_RAW", True) for file in expected]
+    assert (workdir / "metis_det_dark.sof").read_text() == "".join(f"{file} DARK_LM_RAW\n" for file in expected)
+    assert f"metis_det_dark\t{workdir / 'MASTER_DARK_2RG.fits'}\tMASTER_DARK_2RG" in capsys.readouterr().out
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.dataflow.index import HeaderIndex
+from pymetis.dataflow.rules import ClassificationRule
+
+
+def write_raw(path, dpr_type, mjd, *, dit=1.0, extra=None):
+    header = fits.Header({
+        'INSTRUME': 'METIS',
+        'MJD-OBS': mjd,
+        'HIERARCH ESO DPR CATG': 'CALIB',
+        'HIERARCH ESO DPR TYPE': dpr_type,
+        'HIERARCH ESO DPR TECH': 'IMAGE,LM',
+        'HIERARCH ESO DET DIT': dit,
+        **(extra or {}),
+    })
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(np.zeros((4, 4)))]).writeto(path, overwrite=True)
+    return path
+
+
+@pytest.fixture
+def archive(tmp_path):
+    root = tmp_path / "archive"
+    write_raw(root / "night1" / "dark1.fits", "DARK", 60000.1)
+    write_raw(root / "night1" / "dark2.fits", "DARK", 60000.2, dit=2.0)
+    write_raw(root / "night2" / "flat.fits", "FLAT,LAMP", 60001.1, extra={'HIERARCH ESO DRS FILTER': 'L'})
+    return root
+
+
+@pytest.fixture
+def index(tmp_path):
+    with HeaderIndex(tmp_path / "index.sqlite") as index:
+        yield index
+
+
+class TestHeaderIndex:
+    def test_update(self, archive, index):
+        assert index.update(archive, workers=2) == (3, 0)
+        assert len(index) == 3
+        assert index.header(archive / "night2" / "flat.fits")['ESO DRS FILTER'] == 'L'
+
+    def test_query(self, archive, index):
+        index.update(archive)
+        assert [os.path.basename(f) for f in index.query({'dpr.type': 'DARK'})] == ["dark1.fits", "dark2.fits"]
+        assert [os.path.basename(f) for f in index.query({'ESO DET DIT': 2.0})] == ["dark2.fits"]
+        assert [os.path.basename(f) for f in index.query(mjd=(60001, 60002))] == ["flat.fits"]
+        with pytest.raises(KeyError):
+            index.query({'drs.filter': 'L'})
+
+    def test_classify(self, archive, index):
+        index.update(archive)
+        assert len(index.classify(ClassificationRule("DARK_LM_RAW", {"instrume": "METIS", "dpr.type": "DARK"}))) == 2
+        # Not an indexed keyword: checked against the stored headers
+        assert len(index.classify(ClassificationRule("FLAT", {"instrume": "METIS", "drs.filter": "L"}))) == 1
+
+    def test_incremental(self, archive, index):
+        index.update(archive)
+        assert index.update(archive) == (0, 0)
+
+        changed = write_raw(archive / "night1" / "dark2.fits", "BIAS", 60000.2)
+        os.utime(changed, ns=(1, 1))
+        (archive / "night2" / "flat.fits").unlink()
+        write_raw(archive / "night3" / "dark3.fits", "DARK", 60002.1)
+        (archive / "night3" / "junk.fits").write_text("not a FITS file")
+
+        assert index.update(archive) == (2, 1)
+        assert [os.path.basename(f) for f in index.unreadable] == ["junk.fits"]
+        assert len(index) == 3
+        assert [os.path.basename(f) for f in index.query({'dpr.type': 'BIAS'})] == ["dark2.fits"]
+
+    def test_persistent(self, archive, tmp_path):
+        with HeaderIndex(tmp_path / "index.sqlite") as index:
+            index.update(archive)
+        with HeaderIndex(tmp_path / "index.sqlite") as index:
+            assert len(index) == 3
+            assert index.update(archive) == (0, 0)
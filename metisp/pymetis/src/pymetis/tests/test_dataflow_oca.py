@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.dataflow.oca import OcaClassifier, OcaSyntaxError, like
+
+REFLEX_RULES = Path(__file__).parents[4] / "reflex" / "metis_wkf.oca"
+INSTRUMENT_RULES = Path(__file__).parents[5] / "metisc" / "oca" / "metis.oca"
+
+
+def header(**keywords):
+    return fits.Header({f"HIERARCH ESO {keyword.replace('_', ' ')}": value for keyword, value in keywords.items()})
+
+
+class TestParser:
+    def test_like(self):
+        assert like("%SCIENCE%").fullmatch("SCIENCE,EXT")
+        assert like("IMAGE%").fullmatch("IMAGE,LM")
+        assert not like("IMAGE%").fullmatch("LM,IMAGE")
+        assert like("A.B").fullmatch("A.B") and not like("A.B").fullmatch("AxB")
+
+    def test_expressions(self):
+        classifier = OcaClassifier.from_text("""
+            // Comments are ignored
+            if (DPR.TYPE == "DARK" or DPR.TYPE == "BIAS") and not DET.DIT > 10 then { DO.CATG = "SHORT"; }
+            if INSTRUME != "METIS" then { DO.CATG = "OTHER"; QUALITY = 1; }
+            /* Multi-line
+               comment */
+            select execute(x) from inputFiles where DO.CATG == "SHORT" group by DET.DIT as (TPL_A, tpl);
+            action x { minRet = 1; select file as Y from calibFiles where PRO.CATG == "Y"; recipe x; }
+        """)
+        assert len(classifier.rules) == 2
+
+        short = header(DPR_TYPE="DARK", DET_DIT=1.5)
+        short['INSTRUME'] = 'METIS'
+        assert classifier.classify(short) == "SHORT"
+        assert classifier.classify(header(DPR_TYPE="DARK", DET_DIT=20.0)) is None
+
+        # A comparison with a missing keyword is false (so its negation is true)
+        assert classifier.classify(header(DPR_TYPE="BIAS")) == "SHORT"
+        assert classifier.classify(header(DET_DIT=1)) is None
+
+        # All matching rules assign, later rules override earlier ones
+        other = header(DPR_TYPE="BIAS", DET_DIT=1)
+        other['INSTRUME'] = 'OTHER'
+        assert classifier.assignments(other) == {'DO.CATG': "OTHER", 'QUALITY': 1}
+
+    def test_syntax_error(self):
+        with pytest.raises(OcaSyntaxError, match="line 2"):
+            OcaClassifier.from_text('if DPR.CATG == "A" then { DO.CATG = "B"; }\nif DPR.CATG = "A" then { }')
+
+
+class TestRepositoryRules:
+    def test_reflex(self):
+        classifier = OcaClassifier.load(REFLEX_RULES)
+        assert len(classifier.rules) == 3
+        assert classifier.classify(header(DPR_CATG="SCIENCE", DPR_TYPE="OBJECT")) == "RRRECIPE_DOCATG_RAW"
+        assert classifier.classify(header(DPR_CATG="CALIB", DPR_TECH="IMAGE,LM", DPR_TYPE="STD")) == \
+            "RRRECIPE_CALIB_DOCATG_RAW"
+        assert classifier.classify(header(PRO_CATG="LINE_INTMON_TABLE")) == "LINE_INTMON_TABLE"
+        assert classifier.assignments(header(DPR_CATG="SCIENCE", DPR_TYPE="OBJECT"))['REFLEX.TARGET'] == "T"
+        assert classifier.classify(header(DPR_CATG="CALIB", DPR_TYPE="DARK")) is None
+
+    def test_instrument(self):
+        classifier = OcaClassifier.load(INSTRUMENT_RULES)
+        assert classifier.classify(header(DPR_CATG="INS_MODE")) == "MODE"
+
+    def test_files(self, tmp_path):
+        files = []
+        for name, keywords in [("sci", dict(DPR_CATG="SCIENCE", DPR_TYPE="OBJECT")), ("dark", dict(DPR_TYPE="DARK"))]:
+            files.append(tmp_path / f"{name}.fits")
+            fits.HDUList([fits.PrimaryHDU(header=header(**keywords)), fits.ImageHDU(np.zeros((2, 2)))]) \
+                .writeto(files[-1])
+
+        classifier = OcaClassifier.load(REFLEX_RULES)
+        assert list(classifier.classify_files(files, workers=2)) == \
+            [(str(files[0]), "RRRECIPE_DOCATG_RAW"), (str(files[1]), None)]
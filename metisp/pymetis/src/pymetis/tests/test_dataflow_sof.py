@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.dataflow.rules import ClassificationRule, CompiledClassifier
+from pymetis.dataflow.sof import SofBuilder, detector
+from pymetis.dataflow.workflow import Workflow
+
+
+@pytest.fixture
+def workflow():
+    return Workflow.load(Path(__file__).parents[4] / "workflows" / "metis" / "metis_lm_img_wkf.py")
+
+
+def raw_header(dpr_catg, dpr_type, dpr_tech="IMAGE,LM"):
+    return fits.Header({
+        'INSTRUME': 'METIS',
+        'HIERARCH ESO DPR CATG': dpr_catg,
+        'HIERARCH ESO DPR TYPE': dpr_type,
+        'HIERARCH ESO DPR TECH': dpr_tech,
+    })
+
+
+def write_raw(path, header):
+    fits.HDUList([fits.PrimaryHDU(header=header), fits.ImageHDU(np.zeros((4, 4)))]).writeto(path)
+    return str(path)
+
+
+class TestCompiledClassifier:
+    def test_same_as_rules(self, workflow):
+        rules = list(workflow.rules.values())
+        classifier = CompiledClassifier(rules)
+        for header in [raw_header("CALIB", "DARK"), raw_header("CALIB", "FLAT,LAMP"),
+                       raw_header("SCIENCE", "OBJECT"), raw_header("SCIENCE", "OBJECT", "IMAGE,N"), {}]:
+            assert classifier.classify(header) == [rule.tag for rule in rules if rule.matches(header)]
+
+    def test_overlapping_rules(self):
+        classifier = CompiledClassifier([
+            ClassificationRule("ANY_METIS", {"instrume": "METIS"}),
+            ClassificationRule("DARK", {"instrume": "METIS", "dpr.type": "DARK"}),
+            ClassificationRule("ALSO_DARK", {"dpr.type": "DARK", "instrume": "METIS"}),
+        ])
+        assert classifier.classify({"INSTRUME": "METIS ", "ESO DPR TYPE": "DARK"}) == ["ANY_METIS", "DARK", "ALSO_DARK"]
+        assert classifier.classify({"INSTRUME": "METIS"}) == ["ANY_METIS"]
+
+
+class TestSofBuilder:
+    def test_detector(self):
+        assert detector(raw_header("CALIB", "DARK")) == "2RG"
+        assert detector(raw_header("CALIB", "DARK", "IMAGE,N")) == "GEO"
+        assert detector({}) is None
+
+    def test_write(self, workflow, tmp_path):
+        darks = [write_raw(tmp_path / f"dark{i}.fits", raw_header("CALIB", "DARK")) for i in range(3)]
+        flat = write_raw(tmp_path / "flat.fits", raw_header("CALIB", "FLAT,LAMP"))
+        write_raw(tmp_path / "other.fits", raw_header("CALIB", "BIAS"))
+
+        builder = SofBuilder(workflow)
+        classified = builder.classify(sorted(tmp_path.glob("*.fits")), workers=2)
+        assert classified == {"DARK_LM_RAW": darks, "LM_FLAT_LAMP_RAW": [flat]}
+
+        written = builder.write(tmp_path / "sof")
+        assert sorted(path.name for path in written) == ["metis_det_dark_2RG.sof", "metis_lm_img_flat_2RG.sof"]
+
+        lines = (tmp_path / "sof" / "metis_lm_img_flat_2RG.sof").read_text().splitlines()
+        assert lines[-1] == f"{flat} LM_FLAT_LAMP_RAW"
+        assert any("metis_det_dark" in line for line in lines if line.startswith('#'))
+
+        lines = (tmp_path / "sof" / "metis_det_dark_2RG.sof").read_text().splitlines()
+        assert [line for line in lines if not line.startswith('#')] == [f"{dark} DARK_LM_RAW" for dark in darks]
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+from pymetis.dataflow.rules import ClassificationRule, header_keyword
+from pymetis.dataflow.workflow import Workflow
+
+
+@pytest.fixture
+def workflow():
+    return Workflow.load(Path(__file__).parents[4] / "workflows" / "metis" / "metis_lm_img_wkf.py")
+
+
+class TestRules:
+    def test_header_keyword(self):
+        assert header_keyword("instrume") == "INSTRUME"
+        assert header_keyword("dpr.catg") == "ESO DPR CATG"
+
+    def test_matches(self):
+        rule = ClassificationRule("DARK_LM_RAW", {"instrume": "METIS", "dpr.type": "DARK"})
+        assert rule.matches({"INSTRUME": "METIS  ", "ESO DPR TYPE": "DARK"})
+        assert not rule.matches({"INSTRUME": "METIS", "ESO DPR TYPE": "FLAT,LAMP"})
+        assert not rule.matches({"INSTRUME": "METIS"})
+
+
+class TestWorkflow:
+    def test_rules(self, workflow):
+        assert {rule.tag for rule in workflow.rules.values()} >= {"DARK_LM_RAW", "LM_IMAGE_SCI_RAW"}
+
+    def test_tasks(self, workflow):
+        assert workflow.tasks['metis_det_detlin'].recipe == 'metis_det_lingain'
+        assert workflow.tasks['metis_lm_img_flat'].main_input.tags == ["LM_FLAT_LAMP_RAW"]
+        assert [dep.name for dep in workflow.tasks['metis_lm_img_flat'].dependencies] == ['metis_det_dark']
+
+    def test_order(self, workflow):
+        order = [task.name for task in workflow.required_tasks(['SCIENCE'])]
+        assert order[0] == 'metis_det_dark'
+        assert order[-1] == 'metis_lm_basic_reduce'
+
+    def test_classify(self, workflow):
+        header = {"INSTRUME": "METIS", "ESO DPR CATG": "CALIB", "ESO DPR TYPE": "DARK", "ESO DPR TECH": "IMAGE,LM"}
+        assert workflow.classify(header) == ["DARK_LM_RAW"]
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms import distortion
+from pymetis.algorithms.distortion import PinholeTable
+
+NY, NX = 64, 200
+SPAXELS = 10
+POSITIONS = [1.5, 5.0, 8.5]
+
+
+def true_row(index, u, x):
+    """ Detector row of position `u` along slice `index`: three rows per spaxel, with a slight tilt """
+    return 32 * index + 1 + 3 * u + 0.01 * (x - 100)
+
+
+@pytest.fixture
+def pinholes():
+    return PinholeTable(np.repeat([1, 2], len(POSITIONS)), np.tile(POSITIONS, 2), SPAXELS)
+
+
+@pytest.fixture
+def image():
+    y, x = np.mgrid[0:NY, 0:NX]
+    image = np.random.default_rng(5).normal(0, 1, (NY, NX))
+    for index in range(2):
+        for u in POSITIONS:
+            for cx in np.arange(15, NX, 20):
+                image += 500 * np.exp(-0.5 * ((x - cx) ** 2 + (y - true_row(index, u, cx)) ** 2) / 0.8 ** 2)
+    return image
+
+
+class TestSpots:
+    def test_centroids(self):
+        y, x = np.mgrid[0:50, 0:50]
+        image = (100 * np.exp(-0.5 * ((x - 10.3) ** 2 + (y - 30.6) ** 2))
+                 + 100 * np.exp(-0.5 * ((x - 40) ** 2 + (y - 5.5) ** 2)))
+        image += np.random.default_rng(1).normal(0, 0.1, image.shape)
+        spots = distortion.detect_spots(image)
+        order = np.argsort(spots.x)
+        assert np.allclose(spots.x[order], [10.3, 40], atol=0.05)
+        assert np.allclose(spots.y[order], [30.6, 5.5], atol=0.05)
+
+    def test_hot_pixel_rejected(self):
+        image = np.random.default_rng(1).normal(0, 1, (30, 30))
+        image[10, 10] = 1000
+        assert len(distortion.detect_spots(image).x) == 0
+
+    def test_assign(self):
+        y = np.array([10.0, 30.2, 10.5, 50.0, 29.8])
+        assert distortion.assign_pinholes(y, 3).tolist() == [0, 1, 0, 2, 1]
+
+    def test_too_few_spots(self):
+        with pytest.raises(ValueError):
+            distortion.assign_pinholes(np.array([1.0, 2.0]), 3)
+
+
+class TestSolve:
+    def test_solution(self, image, pinholes):
+        result = distortion.solve(image, pinholes, degree=2)
+        table = result.table
+        assert result.spots == 2 * len(POSITIONS) * 10
+        assert result.rms < 0.02
+
+        for index in range(2):
+            x = np.array([15.0, 100.0, 185.0])
+            for u in [0.5, 4.0, 9.0]:
+                assert np.allclose(table.evaluate(index, x, true_row(index, u, x)), u, atol=0.05)
+
+        # Spaxel 0..10 covers rows 1..31 of the first slice (and 33..63 of the second), tilted by +-1 row
+        assert table.rows[0, 0] == 0
+        assert table.rows[0, 1] == pytest.approx(32, abs=1)
+        assert table.rows[1, 0] == pytest.approx(32, abs=1)
+        assert table.rows[1, 1] == NY - 1
+
+    def test_too_few_pinholes(self, image, pinholes):
+        with pytest.raises(ValueError):
+            distortion.solve(image, pinholes, degree=3)
+
+
+def test_load_pinholes(tmp_path):
+    filename = tmp_path / "pinholes.fits"
+    hdu = fits.BinTableHDU.from_columns([fits.Column(name='SLICE', format='J', array=[1, 1]),
+                                         fits.Column(name='U', format='D', array=[2.5, 7.5])])
+    hdu.header['NSPAX'] = 10
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename)
+
+    pinholes = PinholeTable.load(filename)
+    assert pinholes.spaxels == 10
+    assert pinholes.positions.tolist() == [2.5, 7.5]
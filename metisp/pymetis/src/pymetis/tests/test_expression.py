@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.expression import Source, lazy
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+
+def random_planes(seed: int, shape=(37, 11)) -> Planes:
+    rng = np.random.default_rng(seed)
+    return Planes(rng.normal(100, 10, shape), rng.uniform(0.5, 2, shape), rng.integers(0, 2, shape, dtype=np.int32))
+
+
+@pytest.fixture
+def combined():
+    return random_planes(1)
+
+
+@pytest.fixture
+def dark():
+    return random_planes(2)
+
+
+@pytest.fixture
+def flat():
+    flat = random_planes(3)
+    flat.data[4, 4] = 0
+    return flat
+
+
+class TestExpression:
+    def test_matches_eager(self, combined, dark, flat):
+        eager = combined.copy().subtract(dark, scale=3).divide(flat)
+        result = ((lazy(combined) - lazy(dark) * 3) / lazy(flat)).evaluate(tile_pixels=50)
+
+        assert np.allclose(result.data, eager.data)
+        assert np.allclose(result.error, eager.error)
+        assert np.array_equal(result.quality, eager.quality)
+        assert result.quality[4, 4] & QualityFlag.ZERO_DIVISION
+
+    def test_in_place(self, combined, dark):
+        expected = combined.copy().subtract(dark)
+        result = (lazy(combined) - lazy(dark)).evaluate(out=combined, tile_pixels=30)
+
+        assert result is combined
+        assert np.allclose(combined.data, expected.data)
+
+    def test_leaves_operands(self, combined, dark):
+        original = combined.copy()
+        (lazy(combined) - lazy(dark)).evaluate()
+        assert np.array_equal(combined.data, original.data)
+
+    def test_shape_mismatch(self, combined):
+        with pytest.raises(ValueError):
+            lazy(combined) - lazy(random_planes(4, shape=(5, 5)))
+
+    def test_lazy_is_idempotent(self, combined):
+        expression = lazy(combined)
+        assert isinstance(expression, Source)
+        assert lazy(expression) is expression
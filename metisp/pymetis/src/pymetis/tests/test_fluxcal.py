@@ -0,0 +1,110 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms import fluxcal
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+SHIPPED_QE = Path(__file__).parents[5] / "metis-calib" / "spec" / "spec_quantum_efficiency.fits"
+
+
+def cube_header(start: float = 3.5, count: int = 50) -> fits.Header:
+    header = fits.Header()
+    header['NAXIS'] = 3
+    header['NAXIS1'], header['NAXIS2'], header['NAXIS3'] = 4, 3, count
+    header.update({
+        'CTYPE1': 'RA---TAN', 'CUNIT1': 'deg', 'CRPIX1': 2.5, 'CRVAL1': 10.0, 'CDELT1': -2e-6,
+        'CTYPE2': 'DEC--TAN', 'CUNIT2': 'deg', 'CRPIX2': 2.0, 'CRVAL2': -30.0, 'CDELT2': 2e-6,
+        'CTYPE3': 'WAVE', 'CUNIT3': 'um', 'CRPIX3': 1.0, 'CRVAL3': start, 'CDELT3': 0.002,
+    })
+    return header
+
+
+@pytest.fixture
+def throughput():
+    wavelengths = np.linspace(3.0, 4.5, 16)
+    return wavelengths, 0.5 + 0.1 * (wavelengths - 3.0)
+
+
+class TestResponseCache:
+    def test_resampled_once_per_grid(self):
+        wavelengths = np.linspace(3.4, 3.7, 100)
+        cache = fluxcal.ResponseCache(wavelengths, 2 * wavelengths)
+
+        first = cache.response(cube_header())
+        second = cache.response(cube_header())
+        assert second is first
+        assert cache.hits == 1
+
+        cache.response(cube_header(start=3.51))
+        assert len(cache) == 2
+        assert np.allclose(first, 2 * (3.5 + 0.002 * np.arange(50)))
+
+    def test_outside_without_throughput(self):
+        cache = fluxcal.ResponseCache(np.linspace(3.55, 3.7, 10), np.ones(10))
+        response = cache.response(cube_header())
+        assert np.isnan(response[0])
+        assert np.isfinite(response[-1])
+
+    def test_filled_by_throughput(self, throughput):
+        wavelengths = np.linspace(3.55, 3.7, 10)
+        conversion = 3 / np.interp(wavelengths, *throughput)
+        cache = fluxcal.ResponseCache(wavelengths, conversion, throughput)
+        assert cache.scale == pytest.approx(3)
+
+        grid = 3.5 + 0.002 * np.arange(50)
+        assert np.allclose(cache.response(cube_header()), 3 / np.interp(grid, *throughput), rtol=1e-3)
+
+
+def test_apply():
+    cube = Planes.from_data(np.ones((3, 2, 2)))
+    cube.error[:] = 0.1
+    fluxcal.apply(cube, np.array([2.0, np.nan, 4.0]))
+
+    assert np.allclose(cube.data[0], 2) and np.allclose(cube.data[2], 4)
+    assert np.allclose(cube.error[2], 0.4)
+    assert (cube.quality[1] & QualityFlag.NO_DATA).all()
+    assert not (cube.quality[0] & QualityFlag.NO_DATA).any()
+
+
+def test_read_throughput(tmp_path):
+    filename = tmp_path / "qe.fits"
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name='Wavelength', format='D', unit='m', array=[4e-6, 3e-6]),
+        fits.Column(name='Quantum_Efficiency', format='D', array=[0.5, 0.4]),
+        fits.Column(name='Grating_Efficiency', format='D', array=[0.5, 0.5]),
+    ], name='CHIP1')
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename)
+
+    wavelengths, throughput = fluxcal.read_throughput(filename, 'CHIP1')
+    assert np.allclose(wavelengths, [3, 4])
+    assert np.allclose(throughput, [0.2, 0.25])
+
+    with pytest.raises(KeyError):
+        fluxcal.read_throughput(filename, 'CHIP2')
+
+    with pytest.raises(KeyError):
+        fluxcal.read_throughput(filename, None)
+
+
+class TestShippedQuantumEfficiency:
+    """ The quantum efficiency shipped in metis-calib only describes VISIR detectors """
+
+    @pytest.mark.parametrize("chip", [None, "IFU", "HAWAII-2RG", "GEOSNAP"])
+    def test_no_metis_detector(self, chip):
+        with pytest.raises(KeyError, match="AQ_1024x1024"):
+            fluxcal.read_throughput(SHIPPED_QE, chip)
+
+    def test_fallback(self):
+        # The fallback itself works with the file, for the detector that it does describe
+        throughput = fluxcal.read_throughput(SHIPPED_QE, "AQ_1024x1024")
+        assert throughput[0][0] == pytest.approx(2.01439)
+        assert np.all(np.diff(throughput[0]) > 0)
+
+        wavelengths = np.linspace(3.55, 3.7, 10)
+        conversion = 3 / np.interp(wavelengths, *throughput)
+        response = fluxcal.ResponseCache(wavelengths, conversion, throughput).response(cube_header())
+        assert np.isfinite(response).all()
+        assert response[0] == pytest.approx(3 / np.interp(3.5, *throughput), rel=1e-3)
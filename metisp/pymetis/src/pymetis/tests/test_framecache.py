@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms.expression import lazy
+from pymetis.algorithms.stacking import Planes
+from pymetis.base.framecache import FrameCache
+
+
+@pytest.fixture
+def product(tmp_path):
+    rng = np.random.default_rng(5)
+    filename = tmp_path / "product.fits"
+    fits.HDUList([
+        fits.PrimaryHDU(rng.normal(10, 1, (6, 8)).astype(np.float32)),
+        fits.ImageHDU(rng.uniform(0.1, 1, (6, 8)), name="ERR"),
+        fits.ImageHDU(rng.integers(0, 2, (6, 8), dtype=np.int32), name="DQ"),
+    ]).writeto(filename)
+    return filename
+
+
+class TestFrameCache:
+    def test_shared_file_decoded_once(self, product, tmp_path):
+        # The same file in two roles, once through a relative path
+        cache = FrameCache([product, tmp_path / ".." / tmp_path.name / "product.fits"])
+        first, second = cache.data(product), cache.data(tmp_path / "." / "product.fits")
+        assert first is second
+        assert cache.decoded == 1
+        assert not first.flags.writeable
+
+    def test_single_file_not_kept(self, product):
+        cache = FrameCache([product])
+        assert cache.data(product) is not cache.data(product)
+        assert cache.decoded == 2
+
+    def test_extension_and_dtype(self, product):
+        cache = FrameCache([product, product])
+        assert cache.data(product, "err") is cache.data(product, 1)
+        assert cache.data(product, "DQ", np.int32).dtype == np.int32
+        assert cache.decoded == 2
+
+    def test_planes(self, product):
+        cache = FrameCache([product, product])
+        expected = Planes.load(product)
+        planes = cache.planes(product)
+        assert np.array_equal(planes.data, expected.data)
+        assert np.array_equal(planes.error, expected.error)
+        assert np.array_equal(planes.quality, expected.quality)
+        assert cache.planes(product).data is planes.data
+
+
+class TestCopyOnWrite:
+    def test_subtract(self, product):
+        cache = FrameCache([product, product])
+        planes, other = cache.planes(product), cache.planes(product)
+        shared = planes.data
+        planes.subtract(other)
+        assert np.allclose(planes.data, 0)
+        assert planes.data is not shared
+        assert np.array_equal(cache.planes(product).data, other.data) and other.data is shared
+
+    def test_evaluate_in_place(self, product):
+        cache = FrameCache([product, product])
+        flat = cache.planes(product)
+        result = (lazy(flat) * 2).evaluate(out=flat)
+        assert result is flat
+        assert np.allclose(flat.data, 2 * cache.planes(product).data)
+
+    def test_shared_views(self):
+        planes = Planes.from_data(np.ones((3, 4)))
+        view = planes.shared()
+        with pytest.raises(ValueError):
+            view.data += 1
+        view.writable().data += 1
+        assert np.all(planes.data == 1) and np.all(view.data == 2)
@@ -39,7 +39,7 @@ class TestRecipe:
                              "CPL_FRAME_GROUP_PRODUCT  CPL_FRAME_LEVEL_FINAL  ")
 
     def test_parameter_count(self):
-        assert len(Recipe.parameters) == 1
+        assert len(Recipe.parameters) == 6
 
 
 class TestInput(BaseInputTest):
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms.mosaic import ChipLayout, map_chips
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+
+def chip_hdu(value: float, x: int = None, y: int = None, shape=(4, 6)) -> fits.ImageHDU:
+    hdu = fits.ImageHDU(np.full(shape, value, dtype=np.float32))
+    if x is not None:
+        hdu.header['HIERARCH ESO DET CHIP X'] = x
+        hdu.header['HIERARCH ESO DET CHIP Y'] = y
+    return hdu
+
+
+@pytest.fixture
+def array_file(tmp_path):
+    """ A 2 x 2 array, with the chips stored in an order different from their positions """
+    filename = tmp_path / "raw.fits"
+    fits.HDUList([fits.PrimaryHDU(), chip_hdu(1, 1, 1), chip_hdu(2, 2, 1), chip_hdu(3, 2, 2), chip_hdu(4, 1, 2)]) \
+        .writeto(filename)
+    return filename
+
+
+class TestChipLayout:
+    def test_positions(self, array_file):
+        layout = ChipLayout.from_file(array_file)
+        assert layout.extensions == [1, 2, 3, 4]
+        assert layout.shape == (8, 12)
+
+        mosaic = layout.assemble([layout.read(array_file, chip) for chip in range(len(layout))])
+        assert mosaic[0, 0] == 1 and mosaic[0, -1] == 2 and mosaic[-1, -1] == 3 and mosaic[-1, 0] == 4
+
+    def test_side_by_side(self, tmp_path):
+        filename = tmp_path / "raw.fits"
+        fits.HDUList([fits.PrimaryHDU(), chip_hdu(1), chip_hdu(2)]).writeto(filename)
+        layout = ChipLayout.from_file(filename)
+        assert layout.shape == (4, 12)
+        assert layout.windows[1] == (slice(0, 4), slice(6, 12))
+
+    def test_single_chip(self, tmp_path):
+        filename = tmp_path / "raw.fits"
+        fits.HDUList([fits.PrimaryHDU(), chip_hdu(1)]).writeto(filename)
+        assert ChipLayout.from_file(filename).extensions == [1]
+
+    def test_split_and_assemble(self, array_file):
+        layout = ChipLayout.from_file(array_file)
+        planes = Planes.from_data(np.arange(96, dtype=np.float64).reshape(8, 12))
+        chips = [layout.split(planes, chip) for chip in range(len(layout))]
+        assert np.array_equal(layout.assemble_planes(chips).data, planes.data)
+
+    def test_gaps(self, tmp_path):
+        filename = tmp_path / "raw.fits"
+        fits.HDUList([fits.PrimaryHDU(), chip_hdu(1, 1, 1), chip_hdu(2, 2, 1, shape=(3, 6))]).writeto(filename)
+        layout = ChipLayout.from_file(filename)
+        planes = layout.assemble_planes([Planes.from_data(np.ones(window_shape))
+                                         for window_shape in [(4, 6), (3, 6)]])
+        assert planes.quality[3, 6] == QualityFlag.NO_DATA
+        assert planes.quality[0, 6] == QualityFlag.GOOD
+
+    def test_overlapping(self):
+        headers = [fits.Header({'NAXIS1': 2, 'NAXIS2': 2, 'HIERARCH ESO DET CHIP X': 1, 'HIERARCH ESO DET CHIP Y': 1})
+                   for _ in range(2)]
+        with pytest.raises(ValueError):
+            ChipLayout.from_headers([1, 2], headers)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_map_chips_order(workers):
+    assert map_chips(lambda chip: chip ** 2, 4, workers=workers) == [0, 1, 4, 9]
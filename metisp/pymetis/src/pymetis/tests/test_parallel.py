@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.backend import NumpyBackend
+from pymetis.algorithms.expression import lazy
+from pymetis.algorithms.parallel import SharedArray, TilePool
+from pymetis.algorithms.stacking import Planes, collapse, combine_planes
+
+
+@pytest.fixture(scope="module")
+def pool():
+    with TilePool(3) as pool:
+        yield pool
+
+
+@pytest.fixture
+def frames():
+    return np.random.default_rng(11).normal(50, 3, size=(9, 17, 5))
+
+
+def random_planes(seed: int, shape=(17, 5)) -> Planes:
+    rng = np.random.default_rng(seed)
+    return Planes(rng.normal(100, 10, shape), rng.uniform(0.5, 2, shape), rng.integers(0, 2, shape, dtype=np.int32))
+
+
+def test_bands(pool):
+    assert pool.bands(10) == [slice(0, 3), slice(3, 6), slice(6, 10)]
+    assert pool.bands(2) == [slice(0, 1), slice(1, 2)]
+
+
+class TestCollapse:
+    @pytest.mark.parametrize("method", ["median", "sigclip"])
+    def test_matches_serial(self, pool, frames, method):
+        expected = collapse(frames, method, NumpyBackend())
+        assert np.allclose(pool.collapse(frames, method, NumpyBackend(), rows=2), expected)
+
+    def test_list_is_emptied(self, pool, frames):
+        kept = list(frames)
+        assert np.allclose(pool.collapse(kept, "median", NumpyBackend()), np.median(frames, axis=0))
+        assert all(frame is None for frame in kept)
+
+    def test_memmap(self, pool, frames, tmp_path):
+        stack = np.lib.format.open_memmap(tmp_path / "stack.npy", mode='w+', dtype=np.float64,
+                                          shape=(12, *frames.shape[1:]))
+        stack[:len(frames)] = frames
+        shared = SharedArray.of_memmap(stack[1:len(frames)])
+        assert shared.file and np.array_equal(shared.attach(), frames[1:])
+        assert np.allclose(pool.collapse(stack[:len(frames)], "median", NumpyBackend()), np.median(frames, axis=0))
+
+    def test_combine_planes(self, pool, frames):
+        expected = combine_planes(iter(frames), "sigclip")
+        planes = combine_planes(iter(frames), "sigclip", pool=pool)
+        assert np.allclose(planes.data, expected.data)
+        assert np.allclose(planes.error, expected.error)
+
+
+def test_evaluate(pool):
+    combined, dark, flat = random_planes(1), random_planes(2), random_planes(3)
+    flat.data[4, 4] = 0
+    expression = (lazy(combined) - lazy(dark) * 3) / lazy(flat)
+    expected = expression.evaluate(tile_pixels=20)
+
+    result = expression.evaluate(out=combined, tile_pixels=20, pool=pool)
+    assert result is combined
+    assert np.allclose(result.data, expected.data)
+    assert np.allclose(result.error, expected.error)
+    assert np.array_equal(result.quality, expected.quality)
+
+
+def test_not_entered():
+    with pytest.raises(RuntimeError):
+        TilePool(2).collapse(np.zeros((3, 4, 4)), "median", NumpyBackend())
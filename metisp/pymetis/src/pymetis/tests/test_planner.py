@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms.mosaic import ChipLayout
+from pymetis.algorithms.planner import MiB, DEFAULT_TILE_PIXELS, FrameGeometry, plan_memory
+
+
+@pytest.fixture
+def geometry():
+    """ 100 frames of four 2048x2048 16-bit chips """
+    headers = [fits.Header({'NAXIS1': 2048, 'NAXIS2': 2048, 'HIERARCH ESO DET CHIP X': x, 'HIERARCH ESO DET CHIP Y': y})
+               for x, y in [(1, 1), (2, 1), (1, 2), (2, 2)]]
+    return FrameGeometry(ChipLayout.from_headers([1, 2, 3, 4], headers), 16, 100)
+
+
+class TestGeometry:
+    def test_from_files(self, tmp_path):
+        hdus = [fits.PrimaryHDU()]
+        for x in [1, 2]:
+            hdus.append(fits.ImageHDU(np.zeros((16, 32), dtype=np.int16)))
+            hdus[-1].header['HIERARCH ESO DET CHIP X'] = x
+            hdus[-1].header['HIERARCH ESO DET CHIP Y'] = 1
+        fits.HDUList(hdus).writeto(tmp_path / "raw.fits")
+
+        geometry = FrameGeometry.from_files([tmp_path / "raw.fits"] * 3)
+        assert geometry.count == 3
+        assert geometry.bitpix == 16
+        assert geometry.chips == [(16, 32)] * 2
+        assert geometry.layout.shape == (16, 64)
+
+    def test_single_image(self, tmp_path):
+        fits.PrimaryHDU(np.zeros((32, 64), dtype=np.float32)).writeto(tmp_path / "raw.fits")
+        geometry = FrameGeometry.from_files([tmp_path / "raw.fits"])
+        assert geometry.chips == [(32, 64)]
+        assert geometry.bitpix == 32
+
+
+class TestPlan:
+    def test_unlimited(self, geometry):
+        plan = plan_memory(geometry, "median", per_chip=True, cpus=8)
+        assert plan.workers == 4
+        assert plan.combine_rows is None and not plan.spill
+        assert plan.tile_pixels == DEFAULT_TILE_PIXELS
+        assert plan.within_budget
+
+    def test_running_statistics(self, geometry):
+        # Two chips' worth of running statistics fit, four do not
+        plan = plan_memory(geometry, "average", 900 * MiB, per_chip=True, cpus=8)
+        assert plan.workers == 2
+        assert plan.combine_rows is None
+        assert plan.within_budget
+
+    def test_banded_collapse(self, geometry):
+        # The stack of a chip (3.2 GiB) fits, collapsing it at once would not
+        plan = plan_memory(geometry, "sigclip", 5000 * MiB, per_chip=True, cpus=8)
+        assert plan.workers == 1 and not plan.spill
+        assert 1 <= plan.combine_rows < 2048
+        assert plan.within_budget
+
+    def test_spill(self, geometry):
+        plan = plan_memory(geometry, "median", 700 * MiB, per_chip=False)
+        assert plan.workers == 1 and plan.spill
+        assert plan.combine_rows is not None
+        assert plan.tile_pixels < DEFAULT_TILE_PIXELS
+        assert plan.within_budget
+
+    def test_impossible(self, geometry):
+        plan = plan_memory(geometry, "average", 100 * MiB)
+        assert not plan.within_budget
+        assert "cannot be met" in plan.report()[-1]
+
+    def test_report(self, geometry):
+        report = plan_memory(geometry, "median", 1000 * MiB).report()
+        assert report[0].startswith("100 frames of 4 chip(s)")
+        assert any("memory-mapped" in line for line in report)
+
+    def test_processes(self, geometry):
+        # Every process collapses its own band: the bands are narrower for the same budget
+        single = plan_memory(geometry, "median", 700 * MiB)
+        plan = plan_memory(geometry, "median", 700 * MiB, processes=4)
+        assert plan.processes == 4
+        assert plan.combine_rows < single.combine_rows
+        assert plan.estimates['combine'] <= plan.budget
+        assert "on 4 processes" in plan.report()[2]
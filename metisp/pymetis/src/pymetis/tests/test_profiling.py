@@ -0,0 +1,42 @@
+import time
+
+import numpy as np
+import pytest
+
+from pymetis.base.profiling import ProfilingOptions, profiled
+
+
+class TestOptions:
+    def test_off(self):
+        assert ProfilingOptions.from_environment({}) is None
+        assert ProfilingOptions.from_environment({'PYMETIS_PROFILE': ''}) is None
+
+    def test_parse(self, tmp_path):
+        options = ProfilingOptions.from_environment({
+            'PYMETIS_PROFILE': 'cProfile, rss',
+            'PYMETIS_PROFILE_SCOPE': 'run',
+            'PYMETIS_PROFILE_DIR': str(tmp_path),
+        })
+        assert options.profilers == ['cprofile', 'rss']
+        assert options.scope == 'run'
+        assert options.directory == tmp_path
+
+    @pytest.mark.parametrize('environ', [{'PYMETIS_PROFILE': 'perf'},
+                                         {'PYMETIS_PROFILE': 'rss', 'PYMETIS_PROFILE_SCOPE': 'save'}])
+    def test_invalid(self, environ):
+        with pytest.raises(ValueError):
+            ProfilingOptions.from_environment(environ)
+
+
+def test_profiled(tmp_path):
+    options = ProfilingOptions(['cprofile', 'tracemalloc', 'rss'], interval=0.01, directory=tmp_path / "profiles")
+    with profiled('metis_test', options) as outputs:
+        kept = [np.ones(1 << 18) for _ in range(4)]
+        time.sleep(0.05)
+
+    assert sorted(path.name for path in outputs) == \
+        ["metis_test.prof", "metis_test.pstats.txt", "metis_test.rss.txt", "metis_test.tracemalloc.txt"]
+    assert all(path.exists() for path in outputs)
+    assert "test_profiling.py" in (tmp_path / "profiles" / "metis_test.tracemalloc.txt").read_text()
+    assert len((tmp_path / "profiles" / "metis_test.rss.txt").read_text().splitlines()) > 3
+    assert len(kept) == 4
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.qc import QC_DICTIONARY_DEFAULT, QcDictionary, QcEngine, qc_dictionary
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(42)
+    # A fixed pattern with a different level in each channel, plus read noise of 10 ADU
+    pattern = np.repeat(np.arange(32, dtype=np.float64) * 100, 64)[np.newaxis, :] * np.ones((256, 1))
+    return [pattern + rng.normal(0, 10, pattern.shape) for _ in range(4)]
+
+
+class TestQcDictionary:
+    def test_load(self):
+        definition = qc_dictionary().lookup("QC RON MEAN")
+        assert definition.type == "double"
+        assert definition.unit == "ADU"
+
+    def test_indexed(self):
+        assert qc_dictionary().lookup("QC RON12").name == "QC RONi"
+        assert qc_dictionary().lookup("QC CHAN3 MED").name == "QC CHANi MED"
+
+    def test_unknown(self):
+        with pytest.raises(KeyError):
+            qc_dictionary().lookup("QC RONX")
+
+    def test_parse(self, tmp_path):
+        filename = tmp_path / "ESO-DFS-DIC.TEST"
+        filename.write_text("# comment\n"
+                            "Parameter Name:     QC NUMi\n"
+                            "Type:               int\n"
+                            "Comment Field:      Some number\n")
+        assert QcDictionary.load(filename).lookup("QC NUM1").comment == "Some number"
+
+    def test_environment(self, tmp_path, monkeypatch):
+        filename = tmp_path / "ESO-DFS-DIC.TEST"
+        filename.write_text("Parameter Name:     QC TEST\n")
+        monkeypatch.setenv("METIS_QC_DICTIONARY", str(filename))
+        assert QcDictionary.load().definitions[0].name == "QC TEST"
+
+    def test_missing(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("METIS_QC_DICTIONARY", str(tmp_path / "missing"))
+        with pytest.raises(FileNotFoundError, match="METIS_QC_DICTIONARY"):
+            QcDictionary.load()
+
+    def test_outside_source_tree(self, tmp_path, monkeypatch):
+        monkeypatch.delenv("METIS_QC_DICTIONARY", raising=False)
+        monkeypatch.setattr("pymetis.algorithms.qc.QC_DICTIONARY_DEFAULT", tmp_path / "missing")
+        with pytest.raises(FileNotFoundError, match="set METIS_QC_DICTIONARY"):
+            QcDictionary.load()
+        assert QC_DICTIONARY_DEFAULT.is_file()
+
+
+class TestQcEngine:
+    def test_ron(self, frames):
+        engine = QcEngine()
+        for frame in frames:
+            engine.feed(frame)
+
+        qc = engine.parameters()
+        assert len(engine.ron) == 3
+        assert qc["QC RON MEAN"] == pytest.approx(10, rel=0.05)
+        assert qc["QC RON3"] == engine.ron[2]
+
+    def test_channels(self, frames):
+        engine = QcEngine()
+        engine.feed(frames[0])
+        qc = engine.parameters()
+        assert qc["QC CHAN1 MED"] == pytest.approx(0, abs=2)
+        assert qc["QC CHAN32 MED"] == pytest.approx(3100, abs=2)
+
+    def test_merge(self, frames):
+        engines = [QcEngine(), QcEngine()]
+        for frame in frames:
+            engines[0].feed(frame[:, :1024])
+            engines[1].feed(frame[:, 1024:])
+
+        merged = QcEngine.merge(engines)
+        assert len(merged.ron) == 3
+        assert merged.ron[0] == pytest.approx(np.mean([engine.ron[0] for engine in engines]))
+        qc = merged.parameters()
+        assert qc["QC CHAN64 MED"] == pytest.approx(3100, abs=2)
+
+    def test_hot_pixels(self, frames):
+        combined = frames[0] - np.repeat(np.arange(32, dtype=np.float64) * 100, 64)
+        combined[10, 10:15] = 1000
+        qc = QcEngine(hot_sigma=10).parameters(combined=combined)
+        assert qc["QC HOTPIX NUM"] == 5
+        assert qc["QC MED"] == pytest.approx(0, abs=1)
+
+    def test_all_defined(self, frames):
+        engine = QcEngine()
+        for frame in frames:
+            engine.feed(frame)
+
+        for name in engine.parameters(combined=frames[0]):
+            qc_dictionary().lookup(name)
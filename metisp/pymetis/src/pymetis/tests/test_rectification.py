@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.rectification import (DistortionTable, WavelengthSolution, RectificationOperator,
+                                              file_digest)
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+NY, NX = 40, 64
+SPAXELS = 10
+
+
+def linear(constant: float, x: float = 0, y: float = 0) -> np.ndarray:
+    """ Coefficients of `constant + x * xn + y * yn` as a degree 1 polynomial """
+    return np.array([[constant, y], [x, 0]])
+
+
+@pytest.fixture
+def distortion():
+    # Two slices of 20 rows each, the spatial coordinate runs along the rows: u = (y - ymin) / 2
+    scale = (NY - 1) / 2 / 2
+    return DistortionTable(np.array([1, 2]),
+                           np.stack([linear((NY - 1) / 4 - ymin / 2, y=scale) for ymin in [0, 20]]),
+                           (NY, NX),
+                           rows=np.array([[0, 19], [20, 39]]),
+                           spaxels=SPAXELS)
+
+
+@pytest.fixture
+def wavecal():
+    # Wavelength grows along the columns by 0.001 um per pixel, the same in both slices
+    return WavelengthSolution(np.array([1, 2]),
+                              np.stack([linear(3.5 + 0.001 * (NX - 1) / 2, x=0.001 * (NX - 1) / 2)] * 2),
+                              (NY, NX),
+                              start=3.5, step=0.002, count=32)
+
+
+@pytest.fixture
+def operator(distortion, wavecal):
+    return RectificationOperator.build(distortion, wavecal)
+
+
+class TestRectification:
+    def test_shape(self, operator):
+        assert operator.cube_shape == (32, 2, SPAXELS)
+        assert operator.matrix.shape == (32 * 2 * SPAXELS, NY * NX)
+
+    def test_rows_normalized(self, operator):
+        total = np.asarray(operator.matrix.sum(axis=1)).ravel()
+        assert np.allclose(total[total > 0], 1)
+
+    def test_constant(self, operator):
+        cube = operator.rectify(np.full((NY, NX), 7.0))
+        assert np.allclose(cube[operator.coverage], 7)
+        assert np.isnan(cube[~operator.coverage]).all()
+
+    def test_wavelength(self, operator):
+        # An image equal to the wavelength of every pixel is reconstructed as the wavelength grid
+        image = np.broadcast_to(3.5 + 0.001 * np.arange(NX), (NY, NX))
+        cube = operator.rectify(image)
+        inner = cube[1:-1, :, 1:-1]
+        assert np.allclose(inner, operator.wavelengths[1:-1, np.newaxis, np.newaxis])
+
+    def test_propagation(self, operator):
+        planes = Planes.from_data(np.ones((NY, NX)))
+        planes.error[:] = 1
+        planes.quality[5, 10] |= QualityFlag.BAD_PIXEL
+
+        cube = operator.apply(planes)
+        assert (cube.error[operator.coverage] <= 1).all()
+        assert 0 < np.count_nonzero(cube.quality & QualityFlag.BAD_PIXEL) <= 4
+        assert ((cube.quality & QualityFlag.NO_DATA) != 0).sum() == np.count_nonzero(~operator.coverage)
+
+    def test_mismatched_image(self, operator):
+        with pytest.raises(ValueError):
+            operator.rectify(np.zeros((10, 10)))
+
+
+class TestCache:
+    @pytest.fixture
+    def files(self, tmp_path, distortion, wavecal):
+        distortion.to_hdu().writeto(tmp_path / "distortion.fits")
+        wavecal.to_hdu().writeto(tmp_path / "wavecal.fits")
+        return tmp_path / "distortion.fits", tmp_path / "wavecal.fits"
+
+    def test_roundtrip(self, files, distortion):
+        loaded = DistortionTable.load(files[0])
+        assert np.allclose(loaded.coefficients, distortion.coefficients)
+        assert loaded.spaxels == SPAXELS
+        assert WavelengthSolution.load(files[1]).count == 32
+
+    def test_cached(self, files, tmp_path, operator):
+        first, cached = RectificationOperator.cached(*files, tmp_path / "cache")
+        assert not cached
+        second, cached = RectificationOperator.cached(*files, tmp_path / "cache")
+        assert cached
+        assert (first.matrix != second.matrix).nnz == 0
+        assert np.allclose(second.matrix.toarray(), operator.matrix.toarray())
+
+    def test_not_cached_by_default(self, files, tmp_path, monkeypatch):
+        monkeypatch.delenv("PYMETIS_CACHE_DIR", raising=False)
+        monkeypatch.chdir(tmp_path)
+        for _ in range(2):
+            assert not RectificationOperator.cached(*files)[1]
+        assert not list(tmp_path.rglob("rectification-*"))
+
+    def test_cache_from_environment(self, files, tmp_path, monkeypatch):
+        monkeypatch.setenv("PYMETIS_CACHE_DIR", str(tmp_path / "env"))
+        RectificationOperator.cached(*files)
+        assert RectificationOperator.cached(*files)[1]
+        assert len(list((tmp_path / "env").glob("rectification-*.npz"))) == 1
+
+    def test_digest(self, files):
+        assert file_digest(files[0]) != file_digest(files[1])
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.refpix import ReferencePixelCorrector, running_mean
+
+
+@pytest.fixture
+def corrector():
+    return ReferencePixelCorrector()
+
+
+def frame_with(sky: np.ndarray, offsets: np.ndarray, rows: np.ndarray, border: int = 4) -> np.ndarray:
+    """ A raw frame: sky on the active pixels only, channel offsets (channel, parity) and row noise everywhere """
+    ny, nx = sky.shape
+    frame = np.zeros_like(sky)
+    frame[border:-border, border:-border] = sky[border:-border, border:-border]
+    frame += np.repeat(offsets[:, np.newaxis, :], nx // offsets.size, axis=1).reshape(nx)
+    return frame + rows[:, np.newaxis]
+
+
+@pytest.fixture
+def sky():
+    return np.random.default_rng(3).normal(100, 5, (64, 256))
+
+
+@pytest.fixture
+def offsets():
+    return np.random.default_rng(4).normal(1000, 50, (32, 2))
+
+
+def test_running_mean():
+    assert np.allclose(running_mean(np.arange(7.0), 3), [0.5, 1, 2, 3, 4, 5, 5.5])
+
+
+class TestCorrection:
+    def test_channel_offsets(self, corrector, sky, offsets):
+        frame = frame_with(sky, offsets, np.zeros(64))
+        assert np.allclose(corrector.channel_offsets(frame), offsets)
+        corrected = corrector.correct(frame)
+        assert np.allclose(corrected[4:-4, 4:-4], sky[4:-4, 4:-4])
+
+    def test_row_noise(self, corrector, sky, offsets):
+        # A slow drift is followed exactly by the running mean, except near the ends of the frame
+        rows = np.linspace(-20, 20, 64)
+        corrected = corrector.correct(frame_with(sky, offsets, rows))
+        assert np.allclose(corrected[8:-8, 4:-4], sky[8:-8, 4:-4])
+
+    def test_without_odd_even(self, sky, offsets):
+        offsets = offsets[:, :1]
+        corrector = ReferencePixelCorrector(odd_even=False)
+        corrected = corrector.correct(frame_with(sky, offsets, np.zeros(64)))
+        assert np.allclose(corrected[4:-4, 4:-4], sky[4:-4, 4:-4])
+
+    def test_in_place(self, corrector, sky, offsets):
+        frame = frame_with(sky, offsets, np.zeros(64))
+        expected = corrector.correct(frame)
+        assert corrector.correct(frame, out=frame) is frame
+        assert np.allclose(frame, expected)
+
+    def test_integer_frame(self, corrector, offsets):
+        frame = frame_with(np.full((64, 256), 100.0), offsets.round(), np.zeros(64)).astype(np.uint16)
+        corrected = corrector.correct(frame)
+        assert corrected.dtype == np.float64
+        assert np.allclose(corrected[4:-4, 4:-4], 100)
+
+    @pytest.mark.parametrize("shape", [(64, 100), (8, 256), (256,)])
+    def test_shape(self, corrector, shape):
+        assert not corrector.applies(shape)
+        with pytest.raises(ValueError):
+            corrector.correct(np.zeros(shape))
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms.accumulator import WelfordAccumulator
+from pymetis.algorithms.stacking import Planes, QualityFlag, combine_planes
+
+
+@pytest.fixture
+def frames():
+    return np.random.default_rng(7).normal(50, 3, size=(8, 10, 6))
+
+
+class TestCombinePlanes:
+    @pytest.mark.parametrize("method", ["add", "average", "median"])
+    def test_data(self, frames, method):
+        expected = {"add": np.sum, "average": np.mean, "median": np.median}[method](frames, axis=0)
+        planes = combine_planes(iter(frames), method)
+        assert np.allclose(planes.data, expected)
+
+    def test_sigclip_rejects_outliers(self):
+        # A single outlier can only deviate by (n - 1) / sqrt(n) standard deviations: enough frames are needed
+        frames = np.random.default_rng(7).normal(50, 3, size=(20, 10, 6))
+        frames[3, 2, 2] = 1e4
+        planes = combine_planes(iter(frames), "sigclip")
+        assert planes.data[2, 2] == pytest.approx(np.delete(frames[:, 2, 2], 3).mean())
+        assert np.abs(planes.data - 50).max() < 5
+
+    def test_error_of_mean(self, frames):
+        planes = combine_planes(iter(frames), "average")
+        assert np.allclose(planes.error, frames.std(axis=0, ddof=1) / np.sqrt(len(frames)))
+        assert not planes.quality.any()
+
+    def test_quality_is_ored(self, frames):
+        frames[2, 1, 1] = np.nan
+        frames[5, 3, 4] = np.inf
+        planes = combine_planes(iter(frames), "average")
+        assert planes.quality[1, 1] & QualityFlag.NON_FINITE
+        assert planes.quality[3, 4] & QualityFlag.NON_FINITE
+        assert planes.quality.astype(bool).sum() == 2
+
+    def test_single_frame_has_no_error(self, frames):
+        planes = combine_planes(iter(frames[:1]), "average")
+        assert (planes.quality & QualityFlag.NO_ERROR).all()
+
+    def test_continues_accumulator(self, frames):
+        accumulator = WelfordAccumulator()
+        combine_planes(iter(frames[:5]), "average", accumulator=accumulator)
+        planes = combine_planes(iter(frames[5:]), "average", accumulator=accumulator)
+        assert np.allclose(planes.data, frames.mean(axis=0))
+
+    def test_unknown_method(self, frames):
+        with pytest.raises(ValueError):
+            combine_planes(iter(frames), "mode")
+
+    @pytest.mark.parametrize("method", ["median", "sigclip"])
+    def test_banded_collapse(self, frames, method):
+        expected = combine_planes(iter(frames), method)
+        stack = np.empty(frames.shape)
+        planes = combine_planes(iter(frames), method, rows=3, stack=stack)
+        assert np.allclose(planes.data, expected.data)
+        assert np.allclose(planes.error, expected.error)
+        assert np.array_equal(stack, frames)
+
+
+class TestPlanesArithmetic:
+    def test_subtract(self):
+        a = Planes(np.full((2, 2), 10.0), np.full((2, 2), 3.0), np.zeros((2, 2), dtype=np.int32))
+        b = Planes(np.full((2, 2), 4.0), np.full((2, 2), 4.0), np.array([[0, 1], [0, 0]], dtype=np.int32))
+        a.subtract(b, scale=2)
+        assert np.allclose(a.data, 2.0)
+        assert np.allclose(a.error, np.hypot(3, 8))
+        assert a.quality[0, 1] == QualityFlag.BAD_PIXEL
+
+    def test_divide(self):
+        a = Planes(np.full((1, 2), 6.0), np.full((1, 2), 0.6), np.zeros((1, 2), dtype=np.int32))
+        b = Planes(np.array([[2.0, 0.0]]), np.array([[0.2, 0.0]]), np.zeros((1, 2), dtype=np.int32))
+        a.divide(b)
+        assert a.data[0, 0] == pytest.approx(3.0)
+        assert a.error[0, 0] == pytest.approx(3.0 * np.hypot(0.1, 0.1))
+        assert a.quality[0, 1] & QualityFlag.ZERO_DIVISION
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from pymetis.algorithms import telluric
+from pymetis.algorithms.stacking import Planes, QualityFlag
+
+
+@pytest.fixture
+def wavelengths():
+    return np.linspace(3.5, 3.6, 200)
+
+
+@pytest.fixture
+def absorption(wavelengths):
+    """ Transmission with two absorption lines """
+    return 1 - 0.6 * np.exp(-0.5 * ((wavelengths - 3.53) / 0.001) ** 2) \
+             - 0.4 * np.exp(-0.5 * ((wavelengths - 3.57) / 0.002) ** 2)
+
+
+@pytest.fixture
+def std_cube(wavelengths, absorption):
+    """ A point source with a sloped continuum in the middle of the cube """
+    continuum = 1000 * (1 + 2 * (wavelengths - 3.5))
+    y, x = np.mgrid[0:9, 0:11]
+    profile = np.exp(-0.5 * ((x - 5) ** 2 + (y - 4) ** 2) / 1.5 ** 2)
+    cube = Planes.from_data((continuum * absorption)[:, np.newaxis, np.newaxis] * profile)
+    cube.error[:] = 1
+    return cube
+
+
+class TestTelluric:
+    def test_extract(self, std_cube):
+        spectrum, error, aperture = telluric.extract_spectrum(std_cube)
+        assert aperture[4, 5]
+        assert not aperture[0, 0]
+        assert spectrum.shape == (200,)
+        assert (error > 0).all()
+
+    def test_transmission(self, wavelengths, absorption, std_cube):
+        spectrum, error, _ = telluric.extract_spectrum(std_cube)
+        transmission, _, _ = telluric.transmission(wavelengths, spectrum, error)
+        assert np.allclose(transmission, absorption, atol=0.02)
+
+    def test_correct(self, wavelengths, absorption, std_cube):
+        expected = std_cube.data / absorption[:, np.newaxis, np.newaxis]
+        corrected = telluric.correct(std_cube, wavelengths, wavelengths, absorption, minimum=0.0)
+        assert np.allclose(corrected.data, expected)
+
+    def test_resampled(self, wavelengths, absorption, std_cube):
+        # A slightly shifted grid of the transmission is interpolated
+        shifted = wavelengths + 1e-5
+        expected = std_cube.data / absorption[:, np.newaxis, np.newaxis]
+        corrected = telluric.correct(std_cube, wavelengths, shifted, np.interp(shifted, wavelengths, absorption))
+        inner = slice(1, -1)
+        assert np.allclose(corrected.data[inner], expected[inner], rtol=0.05)
+        assert (corrected.quality[0] & QualityFlag.LOW_TRANSMISSION).all()
+
+    def test_low_transmission(self, wavelengths, std_cube):
+        transmission = np.ones_like(wavelengths)
+        transmission[10] = 0.01
+        corrected = telluric.correct(std_cube, wavelengths, wavelengths, transmission)
+        assert (corrected.quality[10] & QualityFlag.LOW_TRANSMISSION).all()
+        assert not (corrected.quality[11] & QualityFlag.LOW_TRANSMISSION).any()
+
+    def test_blackbody(self):
+        # Rayleigh-Jeans: B_nu scales as nu^2 far from the peak
+        ratio = telluric.blackbody(np.array([1000.0]), 10000) / telluric.blackbody(np.array([2000.0]), 10000)
+        assert ratio[0] == pytest.approx(4, rel=1e-3)
@@ -0,0 +1,135 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from pymetis.algorithms import wavecal
+from pymetis.algorithms.rectification import DistortionTable
+
+NY, NX = 40, 512
+START, DISPERSION = 3.5, 0.0002
+
+SHIPPED_CATALOGUE = Path(__file__).parents[5] / "metis-calib" / "spec" / "line_catalog_thar_setup1.fits"
+# The first guess of the metis_ifu_wavecal recipe
+DEFAULT_CENTRAL, DEFAULT_DISPERSION = 3.8, 0.00025
+
+
+def true_wavelength(x, y, start=START):
+    """ A slightly curved dispersion with a small tilt of the lines, different in both slices """
+    slice_offset = np.where(y >= 20, 0.0003, 0.0)
+    return start + DISPERSION * x + 1e-8 * (x - 256) ** 2 + 2e-5 * (y % 20) / 20 + slice_offset
+
+
+def arc_image(catalogue, start=START):
+    y, x = np.mgrid[0:NY, 0:NX]
+    wavelength = true_wavelength(x, y, start)
+    sigma = 1.2 * DISPERSION
+    image = np.zeros((NY, NX))
+    for line in catalogue[(catalogue > wavelength.min() - 0.01) & (catalogue < wavelength.max() + 0.01)]:
+        image += 1000 * np.exp(-0.5 * ((wavelength - line) / sigma) ** 2)
+    return image + np.random.default_rng(3).normal(10, 1, (NY, NX))
+
+
+@pytest.fixture
+def catalogue():
+    rng = np.random.default_rng(7)
+    return np.sort(rng.uniform(START - 0.002, START + DISPERSION * NX + 0.004, 40))
+
+
+@pytest.fixture
+def distortion():
+    return DistortionTable(np.array([1, 2]), np.zeros((2, 2, 2)), (NY, NX),
+                           rows=np.array([[0, 19], [20, 39]]), spaxels=10)
+
+
+@pytest.fixture
+def arc(catalogue):
+    return arc_image(catalogue)
+
+
+class TestPeaks:
+    def test_subpixel(self):
+        x = np.arange(100)
+        spectra = np.stack([np.exp(-0.5 * ((x - centre) / 1.5) ** 2) for centre in [20.3, 61.8]])
+        rows, columns, heights = wavecal.find_peaks(spectra, threshold=3)
+        assert rows.tolist() == [0, 1]
+        assert np.allclose(columns, [20.3, 61.8], atol=0.05)
+
+
+class TestMatching:
+    def test_nearest_within_tolerance(self):
+        catalogue = np.array([1.0, 2.0, 3.0])
+        matched, lines = wavecal.match_lines(np.array([1.05, 2.4, 2.98]), catalogue, 0.1, np.zeros(3, dtype=int))
+        assert matched.tolist() == [0, 2]
+        assert lines.tolist() == [0, 2]
+
+    def test_ambiguous_dropped(self):
+        catalogue = np.array([1.0, 1.1])
+        matched, _ = wavecal.match_lines(np.array([1.05]), catalogue, 0.2, np.zeros(1, dtype=int))
+        assert len(matched) == 0
+
+    def test_one_detection_per_line_and_row(self):
+        catalogue = np.array([1.0, 2.0])
+        matched, lines = wavecal.match_lines(np.array([1.02, 0.99, 1.01]), catalogue, 0.1, np.array([0, 0, 1]))
+        assert matched.tolist() == [1, 2]
+        assert lines.tolist() == [0, 0]
+
+
+class TestCalibrate:
+    def test_solution(self, arc, distortion, catalogue):
+        result = wavecal.calibrate(arc, distortion, catalogue,
+                                   central=START + DISPERSION * (NX - 1) / 2, dispersion=DISPERSION,
+                                   degree=2, tolerance=5)
+        assert result.rms < 0.05 * DISPERSION
+
+        y, x = np.mgrid[0:NY, 0:NX:16]
+        for index in range(2):
+            rows = slice(20 * index, 20 * index + 20)
+            fitted = result.solution.evaluate(index, x[rows], y[rows])
+            assert np.allclose(fitted, true_wavelength(x[rows], y[rows]), atol=0.1 * DISPERSION)
+
+        assert result.solution.step == pytest.approx(DISPERSION, rel=0.05)
+        assert result.solution.start == pytest.approx(true_wavelength(0, 0), abs=0.1 * DISPERSION)
+        assert result.solution.wavelengths[-1] >= true_wavelength(NX - 1, 39) - result.solution.step
+
+    def test_bad_guess(self, arc, distortion, catalogue):
+        with pytest.raises(ValueError):
+            wavecal.calibrate(arc, distortion, catalogue, central=4.5, dispersion=DISPERSION, degree=2)
+
+    def test_catalogue_out_of_range(self, arc, distortion, catalogue):
+        with pytest.raises(ValueError, match="has 0 lines in the range of the first guess"):
+            wavecal.calibrate(arc, distortion, catalogue, central=5.0, dispersion=DISPERSION, degree=2)
+
+
+def test_read_catalogue(tmp_path):
+    filename = tmp_path / "catalogue.fits"
+    column = fits.Column(name='WAVE', format='E', unit='ANGSTROM', array=np.array([40000.0, 35000.0]))
+    fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([column])]).writeto(filename)
+    assert np.allclose(wavecal.read_catalogue(filename), [3.5, 4.0])
+
+
+class TestShippedCatalogue:
+    """ The ThAr catalogues shipped in metis-calib cover the visible (3304 to 9833 Angstrom), not the L band """
+
+    @pytest.fixture
+    def shipped(self):
+        return wavecal.read_catalogue(SHIPPED_CATALOGUE)
+
+    def test_read(self, shipped):
+        assert len(shipped) == 376
+        assert np.all(np.diff(shipped) >= 0)
+        assert shipped[0] == pytest.approx(0.3304238) and shipped[-1] == pytest.approx(0.9833423)
+
+    def test_default_guess_does_not_overlap(self, shipped, distortion):
+        with pytest.raises(ValueError, match="check the catalogue"):
+            wavecal.calibrate(arc_image(shipped), distortion, shipped,
+                              central=DEFAULT_CENTRAL, dispersion=DEFAULT_DISPERSION)
+
+    def test_matching_guess(self, shipped, distortion):
+        start = 0.7
+        result = wavecal.calibrate(arc_image(shipped, start), distortion, shipped,
+                                   central=start + DISPERSION * (NX - 1) / 2, dispersion=DISPERSION,
+                                   degree=2, tolerance=5)
+        assert result.rms < 0.05 * DISPERSION
+        assert result.solution.start == pytest.approx(true_wavelength(0, 0, start), abs=0.1 * DISPERSION)
@@ -4,6 +4,7 @@ from pymetis.recipes.img.metis_lm_basic_reduce import MetisLmBasicReduce
 from pymetis.recipes.img.metis_lm_img_flat import MetisLmImgFlat
 from pymetis.recipes.img.metis_n_img_flat import MetisNImgFlat
 from pymetis.recipes.ifu.metis_ifu_distortion import MetisIfuDistortion
+from pymetis.recipes.ifu.metis_ifu_wavecal import MetisIfuWavecal
 from pymetis.recipes.ifu.metis_ifu_calibrate import MetisIfuCalibrate
 from pymetis.recipes.ifu.metis_ifu_postprocess import MetisIfuPostprocess
 from pymetis.recipes.ifu.metis_ifu_reduce import MetisIfuReduce
@@ -16,6 +17,7 @@ __all__ = [
     MetisLmImgFlat,
     MetisNImgFlat,
     MetisIfuDistortion,
+    MetisIfuWavecal,
     MetisIfuCalibrate,
     MetisIfuPostprocess,
     MetisIfuReduce,